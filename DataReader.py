@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
-import datetime, itertools, re, math
+import array, bisect, datetime, itertools, re, math, sys
+import numpy as np
 
 
 RegZoneField = "RegZone"
+DefaultChunkSize = 65536        # TDataStream records per chunk
 
 class DataReaderException(Exception):
     pass
@@ -29,82 +31,183 @@ class FieldError(DataReaderException):
     def __str__(self):
         return ("Field error: " + self.description)
 
+# raw_data list which counts its modifications,
+# so the hash indexes built over it know when they are stale
+class TRecordList(list):
+    modifications = 0
+
+def _counting(method):
+    def counting_method(self, *args, **kwargs):
+        self.modifications += 1
+        return method(self, *args, **kwargs)
+    return counting_method
+
+for _name in ("append", "extend", "insert", "pop", "remove", "clear",
+              "sort", "reverse", "__setitem__", "__delitem__",
+              "__iadd__", "__imul__"):
+    setattr(TRecordList, _name, _counting(getattr(list, _name)))
+
+# Patterns are compiled once for all the files
+field_separator = "\t"
+field_name_pattern = re.compile(r"^[^0-9]\S*$")
+string_pattern = re.compile(
+    r"""^(?P<string>\S+)$""")
+int_number_pattern = re.compile(
+    r"""^(?P<number>[-+]?[0-9]+)$""")
+float_number_pattern = re.compile(
+    r"""^(?P<number>                   # To create symbolic group
+          [-+]?[0-9]*[.]?[0-9]+        # Mantissa part
+          ([eE][-+]?[0-9]+)?)$         # Optional exponent
+    """, re.VERBOSE)
+datetime_pattern = re.compile(
+    r"""^(?P<day>[0-9]{1,2})[.]        # Day
+         (?P<month>[0-9]{2})[.]        # Month
+         (?P<year>[0-9]{4})[ ]         # Year
+         (?P<hour>[0-9]{1,2})[:]       # Hours
+         (?P<min>[0-9]{2})[:]          # Minutes
+         (?P<sec>[0-9]{2})$            # Seconds
+     """, re.VERBOSE)
+
+def parse_float(data_string):
+    if float_number_pattern.match(data_string) is None:
+        raise ValueError(data_string)
+    return float(data_string)
+
+def parse_datetime(data_string):
+    datetime_match = datetime_pattern.match(data_string)
+    if datetime_match is None:
+        raise ValueError(data_string)
+    return datetime.datetime(
+        year = int(datetime_match.group("year")),
+        month = int(datetime_match.group("month")),
+        day = int(datetime_match.group("day")),
+        hour = int(datetime_match.group("hour")),
+        minute = int(datetime_match.group("min")),
+        second = int(datetime_match.group("sec")),
+        microsecond = 0)
+
+def parse_value(data_string):
+    """ Tries float, datetime and string one by one,
+        result is None if data_string is none of them
+    """
+    # int matching is disabled for a while
+    # because float is good enough
+    if float_number_pattern.match(data_string) is not None:
+        return float(data_string)
+    try:
+        return parse_datetime(data_string)
+    except ValueError:
+        pass
+    if string_pattern.match(data_string) is not None:
+        return sys.intern(data_string)
+    return None
+
+SecondsEpoch = datetime.datetime(1970, 1, 1)
+
+def seconds_array(datetimes):
+    # Naive datetimes as float seconds, for the interpolation only
+    return np.array([(dt - SecondsEpoch).total_seconds() for dt in datetimes])
+
+# Value parsers for the known column type
+type_parsers = {float:parse_float, datetime.datetime:parse_datetime}
+
+# Whole line patterns for the known columns types
+float_value = r"[-+]?[0-9]*[.]?[0-9]+(?:[eE][-+]?[0-9]+)?"
+datetime_value = r"[0-9]{1,2}[.][0-9]{2}[.][0-9]{4}[ ][0-9]{1,2}[:][0-9]{2}[:][0-9]{2}"
+line_value_patterns = {
+    float:"(" + float_value + ")",
+    datetime.datetime:r"([0-9]{1,2})[.]([0-9]{2})[.]([0-9]{4})[ ]"
+                      r"([0-9]{1,2})[:]([0-9]{2})[:]([0-9]{2})",
+    str:r"(?!(?:" + float_value + "|" + datetime_value + r")(?:\t|\Z))(\S+)"}
+
+def make_line_parser(data_types):
+    """ Parser of the data line having exactly data_types values,
+        result is the values tuple or None if the line doesn't fit
+    """
+    line_pattern = re.compile("\t".join(line_value_patterns[data_type]
+                                        for data_type in data_types) + r"\Z")
+    converters = list()
+    group = 0
+    for data_type in data_types:
+        if data_type is datetime.datetime:
+            converters.append((group, 6, lambda g: datetime.datetime(
+                year = int(g[2]), month = int(g[1]), day = int(g[0]),
+                hour = int(g[3]), minute = int(g[4]), second = int(g[5]),
+                microsecond = 0)))
+            group += 6
+        elif data_type is float:
+            converters.append((group, 1, lambda g: float(g[0])))
+            group += 1
+        else:
+            converters.append((group, 1, lambda g: sys.intern(g[0])))
+            group += 1
+
+    def parse_line(line):
+        line_match = line_pattern.match(line)
+        if line_match is None:
+            return None
+        groups = line_match.groups()
+        return tuple([convert(groups[first:first+count])
+                      for first, count, convert in converters])
+    return parse_line
+
 class TDataReader(object):
 
     def __init__(self, data_file_name):
         """ Reads data file trying to understand fields
-            names and data types
+            names and data types.
+            Data types are recognized by the first data line
+        """
+        self._init_state()
+        self.raw_data = list(self._read_records(data_file_name))
+
+    def _init_state(self):
+        self._field_indexes = dict()    # find_field_index() cache
+        self._hash_indexes = dict()     # field index -> (raw_data state, index)
+        self._sorted_keys = None        # (field index, raw_data state, keys)
+        self.fields = list()
+        self.data_types = tuple()
+        self.data_lines = int(0)
+        self.line_no = int(0)
+        self.raw_data = list()
+
+    def _read_records(self, data_file_name):
+        """ Generator of the data file records (tuples).
+            self.fields is known once the first record is yielded,
+            self.data_types is extended while reading
         """
 
         # This is a local function for line parsing
         # provided separators are tabs
         def parse_line(line):
-            field_pattern = r"[\t\n]"
-            fields_list = re.split(field_pattern, line)[:-1]
-            return fields_list
+            return line.split(field_separator)
 
         # This is a local function for first line parsing
         # wich expected to be field names
         def parse_first_line(record):
-            string_pattern = re.compile(r"^[^0-9]\S*$")
             fields = record
-            if not all(string_pattern.match(field) is not None
+            if not all(field_name_pattern.match(field) is not None
                        for field in fields):
                 fields = list()
             return fields
 
-        # This is a local function for data line parsing
+        # This is a local function for data line parsing,
+        # known columns types are tried first
         def parse_data_line(record):
-            string_pattern = re.compile(
-                r"""^(?P<string>\S+)$""")
-            int_number_pattern = re.compile(
-                r"""^(?P<number>[-+]?[0-9]+)$""")
-            float_number_pattern = re.compile(
-                r"""^(?P<number>                   # To create symbolic group
-                      [-+]?[0-9]*[.]?[0-9]+        # Mantissa part
-                      ([eE][-+]?[0-9]+)?)$         # Optional exponent
-                """, re.VERBOSE)
-            datetime_pattern = re.compile(
-                r"""^(?P<day>[0-9]{1,2})[.]        # Day
-                     (?P<month>[0-9]{2})[.]        # Month
-                     (?P<year>[0-9]{4})[ ]         # Year
-                     (?P<hour>[0-9]{1,2})[:]       # Hours
-                     (?P<min>[0-9]{2})[:]          # Minutes
-                     (?P<sec>[0-9]{2})$            # Seconds
-                 """, re.VERBOSE)
-
-            data_tuple = tuple()
-
-            for data_string in record:
-                int_num_match   = int_number_pattern.match(data_string)
-                float_num_match = float_number_pattern.match(data_string)
-                datetime_match  = datetime_pattern.match(data_string)
-                string_match    = string_pattern.match(data_string)
-                # int matching is disabled for a while
-                # because float is good enough
-                #if int_num_match is not None:
-                #    data_value = int(int_num_match.group("number"))
-                if float_num_match is not None:
-                    data_value = float(float_num_match.group("number"))
-                elif datetime_match is not None:
-                    day     = int(datetime_match.group("day"))
-                    month   = int(datetime_match.group("month"))
-                    year    = int(datetime_match.group("year"))
-                    hours   = int(datetime_match.group("hour"))
-                    minutes = int(datetime_match.group("min"))
-                    seconds = int(datetime_match.group("sec"))
-                    data_value = datetime.datetime(
-                        year = year, month = month, day = day,
-                        hour = hours, minute = minutes, second = seconds,
-                        microsecond = 0)
-                elif string_match is not None:
-                    data_value = str(string_match.group("string"))
-                else:
-                    raise IncorrectFileFormat(data_file_name, line_no,
+            data_list = list()
+            for data_string, parser in itertools.zip_longest(record, parsers):
+                if data_string is None:
+                    break
+                try:
+                    data_value = parser(data_string)
+                except (ValueError, TypeError):
+                    # Type differs from expected (or not known yet)
+                    data_value = parse_value(data_string)
+                if data_value is None:
+                    raise IncorrectFileFormat(data_file_name, self.line_no,
                                               "error parsing " + data_string)
-                data_tuple += (data_value,)
-
-            return data_tuple
+                data_list.append(data_value)
+            return tuple(data_list)
 
         # This is a local function for data line type checking
         # against theinstanse's self.data_types tuple.
@@ -113,7 +216,7 @@ class TDataReader(object):
         # is extended accordingly
         def check_data_type(data_tuple):
             if (len(data_tuple) > len(self.fields)) and (len(self.fields) > 0):
-                raise IncorrectFileFormat(data_file_name, line_no,
+                raise IncorrectFileFormat(data_file_name, self.line_no,
                         "{fld_no:d} fields but {vals:d} data values ".format(
                             fld_no = len(self.fields), vals = len(data_tuple)))
             if len(data_tuple) > len(self.data_types):
@@ -121,54 +224,95 @@ class TDataReader(object):
                 for data_item in itertools.islice(data_tuple,
                                     len(self.data_types), None):
                     self.data_types += (type(data_item),)
+                    parsers.append(type_parsers.get(type(data_item),
+                                                    parse_value))
             for (data_item,data_type) in zip(data_tuple,self.data_types):
                 if type(data_item) is not data_type:
-                    raise IncorrectFileFormat(data_file_name, line_no,
+                    raise IncorrectFileFormat(data_file_name, self.line_no,
             "type mismatch: {item:s} has type {dtype:s} but {exp:s} expected".format(
                                            item = str(data_item),
                                            dtype = str(type(data_item)),
                                            exp = str(data_type)))
 
-
-        # This is __init__ function itself body
-        self.fields = list()
-        self.data_types = tuple()
-        self.data_lines = int(0)
-        self.raw_data = list()
+        parsers = list()                # Value parser for every column
+        line_parser = None              # Whole line parser for data_types
         with open(file=data_file_name,
                   mode='r',
                   encoding='utf8') as data_file_object:
-            line_no = 1
+            self.line_no = 1
 
             # Skip the comment lines
             check_comment = True
             while check_comment:
                 file_pos = data_file_object.tell()
                 first_line = data_file_object.readline()
-                line_no += 1
+                self.line_no += 1
                 if not first_line.startswith("#"):
                     check_comment = False
-                    line_no -=1
+                    self.line_no -=1
                     break
 
             # Analyze the first meaningful line first :-)
-            record = parse_line(first_line)
+            record = parse_line(first_line.rstrip("\r\n"))
             self.fields = parse_first_line(record)
             if len(self.fields) > 0:
-                line_no += 1
+                self.line_no += 1
             else:
                 # First line contains ordinary data
                 data_file_object.seek(file_pos)
 
             for line in data_file_object:
-                record = parse_line(line)
-                data_tuple = parse_data_line(record)
-                check_data_type(data_tuple)
-                self.raw_data.append(data_tuple)
-                line_no += 1
+                if line.isspace():
+                    self.line_no += 1
+                    continue
+                line = line.rstrip("\r\n")
+                data_tuple = None
+                if line_parser is not None:
+                    # Line of already known types, the usual case
+                    data_tuple = line_parser(line)
+                if data_tuple is None:
+                    record = parse_line(line)
+                    data_tuple = parse_data_line(record)
+                    types_known = len(self.data_types)
+                    check_data_type(data_tuple)
+                    if line_parser is None or len(self.data_types) > types_known:
+                        line_parser = make_line_parser(self.data_types)
+                yield data_tuple
+                self.line_no += 1
                 self.data_lines += 1
 
+    def column(self, field):
+        """ All the field values, array('d') for numbers
+            or list otherwise
+        """
+        field_index = self.find_field_index(field)
+        if self.data_types[field_index] is float:
+            return array.array('d', (rec[field_index] for rec in self.raw_data))
+        return [rec[field_index] for rec in self.raw_data]
+
+    @property
+    def raw_data(self):
+        return self._raw_data
+
+    @raw_data.setter
+    def raw_data(self, records):
+        if type(records) is not TRecordList:
+            records = TRecordList(records)
+        self._raw_data = records
+
     def find_field_index(self, field):
+        try:
+            return self._field_indexes[field]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable field, never mind
+            return self._find_field_index(field)
+        field_index = self._find_field_index(field)
+        self._field_indexes[field] = field_index
+        return field_index
+
+    def _find_field_index(self, field):
         if type(field) is str:
             try:
                 field_index = self.fields.index(field)
@@ -182,33 +326,97 @@ class TDataReader(object):
                                  fld = field))
         return field_index
 
+    def index_by_field(self, field):
+        """ Hash index of the field: dict {field value:first record
+            with that value}. It is built on the first request and
+            rebuilt after any raw_data modification (sort_data included)
+        """
+        field_index = self.find_field_index(field)
+        state = self._raw_data_state()
+        cached = self._hash_indexes.get(field_index)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+        index = dict()
+        for rec in self.raw_data:
+            index.setdefault(rec[field_index], rec)
+        self._hash_indexes[field_index] = (state, index)
+        return index
+
+    def invalidate_indexes(self):
+        self._hash_indexes.clear()
+        self._sorted_keys = None
+
     def sort_data(self, field):
         field_index = self.find_field_index(field)
         self.raw_data.sort(key = lambda x: x[field_index])
+        self.invalidate_indexes()
 
-    def interpolate_by_field(self, field, field_data):
+    def _raw_data_state(self):
+        return (id(self.raw_data), self.raw_data.modifications)
+
+    def sorted_keys(self, field):
+        """ Sorts raw_data by the field unless it is sorted already
+            and not modified since, result is the sorted field values
+            (array('d') or list) suitable for bisection
+        """
         field_index = self.find_field_index(field)
         if self.data_types[field_index] is str:
             raise FieldError(("Can't interpolate on {fld:s} " +
                              "field of string type").format(fld = field))
+        cached = self._sorted_keys
+        if (cached is not None and cached[0] == field_index and
+                cached[1] == self._raw_data_state()):
+            return cached[2]
+        self.sort_data(field_index)
+        keys = self.column(field_index)
+        self._sorted_keys = (field_index, self._raw_data_state(), keys)
+        return keys
+
+    def _interpolate(self, prev_data, next_data, k):
+        return [(prev_data_item + k * (next_data_item - prev_data_item))
+                if type(prev_data_item) is not str else 'string!'
+                for (prev_data_item, next_data_item) in zip(
+                     prev_data, next_data)]
 
-        self.sort_data(field)
-        for idx in range(len(self.raw_data)):
-            if field_data < self.raw_data[idx][field_index]: break
-        if idx == 0: idx = 1
-
-        prev_field = self.raw_data[idx-1][field_index]
-        next_field = self.raw_data[idx][field_index]
-        prev_data = self.raw_data[idx-1]
-        next_data = self.raw_data[idx]
+    def interpolate_by_field(self, field, field_data):
+        """ Record interpolated (or extrapolated by the first or last
+            two records) at field value field_data
+        """
+        keys = self.sorted_keys(field)
+        idx = min(max(bisect.bisect_right(keys, field_data), 1), len(keys) - 1)
 
+        prev_field = keys[idx-1]
+        next_field = keys[idx]
         k = (field_data - prev_field) / (next_field - prev_field)
-        value = [(prev_data_item + k * (next_data_item - prev_data_item))
-                 if type(prev_data_item) is not str else 'string!'
-                 for (prev_data_item, next_data_item) in zip(
-                      prev_data, next_data)]
-
-        return value
+        return self._interpolate(self.raw_data[idx-1], self.raw_data[idx], k)
+
+    def interpolate_many(self, field, field_data):
+        """ Vectorized interpolate_by_field: result is the float
+            matrix with the row for every field_data value and the
+            column for every field. Datetime values of field and
+            field_data are handled as seconds, columns of other
+            than float type are NaN
+        """
+        keys = self.sorted_keys(field)
+        field_index = self.find_field_index(field)
+        if self.data_types[field_index] is datetime.datetime:
+            keys = seconds_array(keys)
+            field_data = seconds_array(field_data)
+        else:
+            keys = np.asarray(keys, dtype=float)
+            field_data = np.asarray(field_data, dtype=float)
+        idx = np.clip(np.searchsorted(keys, field_data, side="right"),
+                      1, len(keys) - 1)
+        k = (field_data - keys[idx-1]) / (keys[idx] - keys[idx-1])
+
+        values = np.full((len(field_data), len(self.data_types)), np.nan)
+        for column_index, data_type in enumerate(self.data_types):
+            if data_type is not float:
+                continue
+            column = np.asarray(self.column(column_index), dtype=float)
+            prev_data = column[idx-1]
+            values[:, column_index] = prev_data + k * (column[idx] - prev_data)
+        return values
 
     def interpolate_by_rec_no(self, rec_no):
         ''' This function interpolates record by record number
@@ -220,39 +428,59 @@ class TDataReader(object):
             rec_no = 0.0
         if rec_no > (n_records - 1):
             rec_no = n_records - 1
-        idx = math.floor(rec_no)
-
-        prev_data = self.raw_data[idx]
-        next_data = self.raw_data[idx + 1]
+        if n_records == 1:
+            return self._interpolate(self.raw_data[0], self.raw_data[0], 0.0)
+        # The last record is the end of the last interval
+        idx = min(math.floor(rec_no), n_records - 2)
 
         k = rec_no - idx
-        value = [(prev_data_item + k * (next_data_item - prev_data_item))
-                 if type(prev_data_item) is not str else 'string!'
-                 for (prev_data_item, next_data_item) in zip(
-                      prev_data, next_data)]
-
-        return value
+        return self._interpolate(self.raw_data[idx], self.raw_data[idx + 1], k)
 
     def get_item_by_field(self, field_name, field_value):
-        field_index = self.find_field_index(field_name)
-        for rec in self.raw_data:
-            if rec[field_index] == field_value:
-                return rec
-        raise KeyError
+        try:
+            return self.index_by_field(field_name)[field_value]
+        except TypeError:
+            # Unhashable value can't be in the index
+            raise KeyError(field_value)
 
     def __len__(self):
         return len(self.raw_data)
 
     def __contains__(self, RegZone):
-        field_index = self.find_field_index(RegZoneField)
-        for rec in self.raw_data:
-            if rec[field_index] == RegZone:
-                return True
-        return False
+        try:
+            return RegZone in self.index_by_field(RegZoneField)
+        except TypeError:
+            return False
 
     def __getitem__(self, RegZone):
-        field_index = self.find_field_index(RegZoneField)
-        for rec in self.raw_data:
-            if rec[field_index] == RegZone:
-                return rec
-        raise KeyError
+        return self.get_item_by_field(RegZoneField, RegZone)
+
+
+class TDataStream(TDataReader):
+    """ Reads the data file chunk by chunk instead of keeping
+        all the records in raw_data, for the files too long
+        to be held in memory. Fields and data types are
+        understood the same way TDataReader does
+    """
+
+    def __init__(self, data_file_name, chunk_size = DefaultChunkSize):
+        self._init_state()
+        self.data_file_name = data_file_name
+        self.chunk_size = chunk_size
+
+    def chunks(self):
+        # Generator of records lists, no more than chunk_size
+        # records each. Every call reads the file anew
+        self.data_lines = 0
+        chunk = list()
+        for data_tuple in self._read_records(self.data_file_name):
+            chunk.append(data_tuple)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = list()
+        if len(chunk) > 0:
+            yield chunk
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 
 import m_print
+import FileCache
 import datetime, re, os, string, math
+from collections.abc import Mapping
+import numpy as np
 
 TIME_FORMAT = '%d.%m.%Y %H:%M:%S'
 
 MCUGreenDirName = "TVS_Green"
+# Compiled Green's functions are kept next to MCUGreenDirName directory
+GreenCacheSuffix = ".cache.npz"
+GreenCacheVersion = 1
 
 # Structure is a series of nested dictionaries as
 # Greens[1..5] key is where the source is, values are
 #  IncGamma[Esrc] key is the source gamma-quantum energy, eV, values are
 #   RegZones[100..149] key is MCU reg zone, values are
 #    Fluxes[E] key is dissipated quantum energy, eV, values are fluxes, p/cm2*sec
+# readGreenFuncs() packs them into a dense TGreenTensor which still
+# can be walked the same way through its Mapping interface
 
 def ReadFIN(fn):
     def ParseDataLine(line):
@@ -127,12 +135,176 @@ def readFINsDir(dir_name):
             IncGamma[Esrc] = regZones
     return IncGamma
 
-def readGreenFuncs():
+def readGreenDicts():
     Greens = dict()
     for src in range(1,6):
         dir_name = f"TVS_{src:1d}"
         IncGamma = readFINsDir(dir_name)
         Greens[src] = IncGamma
     return Greens
-        
 
+def GreenSourceFiles():
+    # All the files readGreenDicts() depends on
+    fns = list()
+    for src in range(1,6):
+        folder = os.path.join(os.curdir, MCUGreenDirName, f"TVS_{src:1d}")
+        for filename in sorted(os.listdir(folder)):
+            if filename.startswith("TVS_N.FIN_S") or filename.startswith("STA"):
+                fns.append(os.path.join(folder, filename))
+    return fns
+
+def readGreenFuncs(use_cache = True):
+    """ Reads the Green's functions into TGreenTensor.
+        The tensor is saved into MCUGreenDirName + GreenCacheSuffix file
+        along with TVS_N.FIN_S* and STA* files fingerprints and is read
+        from there until any of those files changes
+    """
+    if not use_cache:
+        return TGreenTensor.from_dicts(readGreenDicts())
+
+    cache_fn = os.path.join(os.curdir, MCUGreenDirName + GreenCacheSuffix)
+    source_fns = GreenSourceFiles()
+    meta, arrays = FileCache.LoadNPZ(cache_fn)
+    if (meta is not None and meta.get("version") == GreenCacheVersion
+            and FileCache.FingerprintsMatch(meta["sources"], source_fns)):
+        return TGreenTensor(arrays["srcs"], arrays["Esrcs"], arrays["zones"],
+                            arrays["ERegs"], arrays["data"])
+
+    Greens = TGreenTensor.from_dicts(readGreenDicts())
+    meta = {"version":GreenCacheVersion,
+            "sources":FileCache.FingerprintsOf(source_fns)}
+    try:
+        FileCache.SaveNPZ(cache_fn, meta, srcs = Greens.srcs,
+                          Esrcs = Greens.Esrcs, zones = Greens.zones,
+                          ERegs = Greens.ERegs, data = Greens.data)
+        m_print.m_print(f"Green's functions cache {cache_fn} saved")
+    except OSError as ex:
+        m_print.m_print(f"Green's functions cache {cache_fn} not saved: {ex}")
+    return Greens
+
+
+# Thin read-only views over the TGreenTensor data array,
+# each level behaves like the corresponding nested dictionary
+class TGreenAxisView(Mapping):
+    def __init__(self, keys, index, values):
+        self._keys = keys        # sorted axis values
+        self._index = index      # axis value -> array index
+        self._values = values    # array index -> value or next level view
+
+    def __getitem__(self, key):
+        return self._values(self._index[key])
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+class TGreenTensor(Mapping):
+    """ Dense Green's functions array
+        data[src, Esrc, zone, E] is the flux, p/cm2*sec, where
+            src  - source span 1..5 (self.srcs)
+            Esrc - incident gamma energy, eV (self.Esrcs)
+            zone - MCU reg zone 100..149 (self.zones)
+            E    - registered gamma energy, eV (self.ERegs)
+        All the axes are sorted ascending.
+        Greens[src][Esrc][zone][E] works as with the old nested dicts.
+    """
+
+    def __init__(self, srcs, Esrcs, zones, ERegs, data):
+        self.srcs = np.asarray(srcs, dtype=int)
+        self.Esrcs = np.asarray(Esrcs, dtype=float)
+        self.zones = np.asarray(zones, dtype=int)
+        self.ERegs = np.asarray(ERegs, dtype=float)
+        self.data = np.ascontiguousarray(data, dtype=float)
+        expected = (len(self.srcs), len(self.Esrcs),
+                    len(self.zones), len(self.ERegs))
+        if self.data.shape != expected:
+            raise ValueError(f"Green's data shape {self.data.shape}, "
+                             f"{expected} expected")
+        self._src_index = {int(v):n for n,v in enumerate(self.srcs)}
+        self._Esrc_index = {float(v):n for n,v in enumerate(self.Esrcs)}
+        self._zone_index = {int(v):n for n,v in enumerate(self.zones)}
+        self._E_index = {float(v):n for n,v in enumerate(self.ERegs)}
+        self._span_indices = dict()
+
+    @classmethod
+    def from_dicts(cls, Greens):
+        srcs = sorted(Greens)
+        Esrcs = sorted({Esrc for src in srcs for Esrc in Greens[src]})
+        zones = sorted({zone for src in srcs for Esrc in Greens[src]
+                             for zone in Greens[src][Esrc]})
+        ERegs = sorted({E for src in srcs for Esrc in Greens[src]
+                          for zone in Greens[src][Esrc]
+                          for E in Greens[src][Esrc][zone]})
+        data = np.zeros((len(srcs), len(Esrcs), len(zones), len(ERegs)))
+        Esrc_index = {v:n for n,v in enumerate(Esrcs)}
+        zone_index = {v:n for n,v in enumerate(zones)}
+        E_index = {v:n for n,v in enumerate(ERegs)}
+        for i_src, src in enumerate(srcs):
+            for Esrc, RegZones in Greens[src].items():
+                i_Esrc = Esrc_index[Esrc]
+                for zone, Fluxes in RegZones.items():
+                    i_zone = zone_index[zone]
+                    for E, flux in Fluxes.items():
+                        data[i_src, i_Esrc, i_zone, E_index[E]] = flux
+        return cls(srcs, Esrcs, zones, ERegs, data)
+
+    def zone_indices(self, zones):
+        return np.array([self._zone_index[int(zone)] for zone in zones],
+                        dtype=int)
+
+    def span_indices(self, zones, n_spans):
+        """ Maps FA spans 0..n_spans-1 onto the tensor for given reg zones.
+            The upper half of the FA mirrors the lower one, so the span
+            with source index src > n_spans//2 uses Green's functions
+            of the span (n_spans + 1 - src) and the reg zone is mirrored
+            by height: zone 10*R + H -> 10*R + (n_spans - H - 1).
+            Returns src_idx[span] and zone_idx[span, zone] index arrays,
+            they are computed once per zones set.
+        """
+        key = (tuple(int(zone) for zone in zones), n_spans)
+        if key in self._span_indices:
+            return self._span_indices[key]
+        src_idx = np.empty(n_spans, dtype=int)
+        zone_idx = np.empty((n_spans, len(zones)), dtype=int)
+        for span in range(n_spans):
+            src = span + 1
+            if src <= n_spans // 2:
+                src_idx[span] = self._src_index[src]
+                reg_zones = zones
+            else:
+                src_idx[span] = self._src_index[n_spans + 1 - src]
+                reg_zones = [10 * (zone // 10) + (n_spans - zone % 10 - 1)
+                             for zone in zones]
+            zone_idx[span] = self.zone_indices(reg_zones)
+        self._span_indices[key] = (src_idx, zone_idx)
+        return src_idx, zone_idx
+
+    def span_block(self, zones, n_spans):
+        """ Green's functions gathered by FA span,
+            the result is array[span, zone, Esrc, E]
+        """
+        src_idx, zone_idx = self.span_indices(zones, n_spans)
+        return self.data[src_idx[:, None], :, zone_idx, :]
+
+    # Compatibility view: Greens[src][Esrc][zone][E]
+    def __getitem__(self, src):
+        i_src = self._src_index[src]
+        return TGreenAxisView(self.Esrcs.tolist(), self._Esrc_index,
+                    lambda i_Esrc: self._zones_view(i_src, i_Esrc))
+
+    def _zones_view(self, i_src, i_Esrc):
+        return TGreenAxisView(self.zones.tolist(), self._zone_index,
+                    lambda i_zone: self._fluxes_view(i_src, i_Esrc, i_zone))
+
+    def _fluxes_view(self, i_src, i_Esrc, i_zone):
+        fluxes = self.data[i_src, i_Esrc, i_zone]
+        return TGreenAxisView(self.ERegs.tolist(), self._E_index,
+                              lambda i_E: float(fluxes[i_E]))
+
+    def __iter__(self):
+        return iter(self.srcs.tolist())
+
+    def __len__(self):
+        return len(self.srcs)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Helpers for the compiled caches of the text input files:
+# source files fingerprints and atomic cache files writing
+
+import hashlib, json, os, tempfile, zipfile
+import numpy as np
+
+HASH_CHUNK = 1 << 20
+
+def ContentHash(fn):
+    hasher = hashlib.sha1()
+    with open(file = fn, mode='rb') as file_object:
+        for chunk in iter(lambda: file_object.read(HASH_CHUNK), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def FileFingerprint(fn):
+    stat = os.stat(fn)
+    return {"size":stat.st_size, "mtime_ns":stat.st_mtime_ns,
+            "sha1":ContentHash(fn)}
+
+def FingerprintsOf(fns):
+    # Result is a dict {file name:fingerprint}
+    return {fn:FileFingerprint(fn) for fn in fns}
+
+def FingerprintsMatch(stored, fns):
+    """ Checks the stored {file name:fingerprint} dict against files fns.
+        Size and mtime match is enough, if only mtime differs
+        the content hash decides
+    """
+    if set(stored) != set(fns):
+        return False
+    for fn in fns:
+        try:
+            stat = os.stat(fn)
+        except OSError:
+            return False
+        fp = stored[fn]
+        if stat.st_size != fp["size"]:
+            return False
+        if stat.st_mtime_ns != fp["mtime_ns"] and ContentHash(fn) != fp["sha1"]:
+            return False
+    return True
+
+def AtomicWrite(fn, write):
+    # write(file_object) fills the temporary file which then
+    # replaces fn, so readers never see a partially written file
+    dir_name = os.path.dirname(os.path.abspath(fn))
+    fd, tmp_fn = tempfile.mkstemp(dir = dir_name,
+                                  prefix = os.path.basename(fn) + ".")
+    try:
+        with os.fdopen(fd, mode='wb') as file_object:
+            write(file_object)
+        os.chmod(tmp_fn, 0o644)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+
+def SaveNPZ(fn, meta, **arrays):
+    # meta is any JSON-serializable object kept along with the arrays
+    AtomicWrite(fn, lambda file_object: np.savez(
+                    file_object, meta = np.array(json.dumps(meta)), **arrays))
+
+def LoadNPZ(fn):
+    # Result is (meta, arrays dict) or (None, None) if there is no
+    # readable cache file
+    try:
+        with np.load(fn, allow_pickle = False) as npz:
+            arrays = {key:npz[key] for key in npz.files}
+        meta = json.loads(str(arrays.pop("meta")))
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        return None, None
+    return meta, arrays
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# MCU .FIN file tallies reader.
+# Tally sections like
+#  NUCLIDE:          MIXT, REACTION:            3, ENERGY:    0.00000E+00
+#          Zone          Mean        StdDev
+#             1   1.47590E-01   8.80587E-03
+#             ...
+# are located by byte offsets in the memory mapped file
+# and every numeric block is parsed in bulk
+
+import json, mmap, os, re
+import numpy as np
+
+ZonesSection = "ZONES"
+ObjectsSection = "OBJECTS"
+IndexSuffix = ".idx.json"
+IndexVersion = 1
+
+SECTION_LINES = {ZonesSection:b"\n -- ZONES --", ObjectsSection:b"\n -- OBJECTS --"}
+TALLY_LINE = b"\n NUCLIDE:"
+hdr_pattern = re.compile(rb"[ \t]+(Zone|Object)[ \t]+Mean[ \t]+StdDev")
+tally_pattern = re.compile(
+    rb"""^\sNUCLIDE:\s+(?P<nuclide>[^,]*?)\s*,   # Nuclide name, e.g. U235
+         \s+(?P<kind>[A-Z_]+):                  # REACTION or CRS_SECT
+         \s+(?P<number>[0-9]+),                 # Reaction number
+         \s+ENERGY:\s+(?P<energy>\S+)           # Energy
+    """, re.VERBOSE)
+block_end_pattern = re.compile(rb"\n[ \t]*\r?\n|\n[^ \t\r\n]|\n[ \t]+[^ \t0-9]")
+
+class MCUReaderException(Exception):
+    pass
+
+class TallyNotFound(MCUReaderException):
+    def __init__(self, file_name, tally):
+        super().__init__()
+        self.file_name = file_name
+        self.tally = tally
+
+    def __str__(self):
+        return (f"File {self.file_name} has no tally " +
+                "{nuclide} {kind} {number} in {section} section".format(
+                    **self.tally))
+
+class TFINReader(object):
+    """ Reads tallies of MCU .FIN file fn.
+        Only the part of the file up to the requested tally is scanned
+        unless the whole tallies index is built (build_index = True)
+        or read from the fn + IndexSuffix sidecar file.
+        Index is a list of dicts {section, nuclide, kind, number,
+        energy, offset}, offset is the tally header line position
+    """
+
+    def __init__(self, fn, build_index = False, save_index = False):
+        self.fn = fn
+        self.index = None
+        self._scanned = list()       # Tallies found while scanning
+        self._scan_pos = 0
+        self._section = None
+        with open(file = fn, mode='rb') as file_object:
+            self._mm = mmap.mmap(file_object.fileno(), 0,
+                                 access = mmap.ACCESS_READ)
+        self.index = self.load_index()
+        if self.index is None and (build_index or save_index):
+            self.build_index()
+            if save_index:
+                self.save_index()
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _index_fingerprint(self):
+        stat = os.stat(self.fn)
+        return {"size":stat.st_size, "mtime_ns":stat.st_mtime_ns}
+
+    def load_index(self):
+        try:
+            with open(file = self.fn + IndexSuffix, mode='r',
+                      encoding='utf8') as index_object:
+                stored = json.load(index_object)
+        except (OSError, ValueError):
+            return None
+        if (stored.get("version") != IndexVersion or
+                stored.get("source") != self._index_fingerprint()):
+            return None
+        return stored["tallies"]
+
+    def save_index(self):
+        stored = {"version":IndexVersion,
+                  "source":self._index_fingerprint(),
+                  "tallies":self.index}
+        with open(file = self.fn + IndexSuffix, mode='w',
+                  encoding='utf8') as index_object:
+            json.dump(stored, index_object, indent = 1)
+
+    def build_index(self):
+        while self._scan_next() is not None:
+            pass
+        self.index = list(self._scanned)
+        return self.index
+
+    def _scan_next(self):
+        # Finds the next tally header, keeping track of
+        # ZONES/OBJECTS sections. Result is the tally dict or None
+        mm = self._mm
+        while True:
+            pos = mm.find(TALLY_LINE, self._scan_pos)
+            # Sections switched before that tally?
+            last_section_pos = -1
+            for section, line in SECTION_LINES.items():
+                section_pos = mm.rfind(line, self._scan_pos,
+                                       len(mm) if pos == -1 else pos)
+                if section_pos > last_section_pos:
+                    last_section_pos = section_pos
+                    self._section = section
+            if pos == -1:
+                self._scan_pos = len(mm)
+                return None
+            line_end = mm.find(b"\n", pos + 1)
+            if line_end == -1:
+                line_end = len(mm)
+            self._scan_pos = line_end
+            match = tally_pattern.match(mm[pos+1:line_end])
+            if match is None:
+                continue
+            tally = {"section":self._section,
+                     "nuclide":match.group("nuclide").decode(),
+                     "kind":match.group("kind").decode(),
+                     "number":int(match.group("number")),
+                     "energy":float(match.group("energy")),
+                     "offset":pos + 1}
+            self._scanned.append(tally)
+            return tally
+
+    def find_tally(self, nuclide, number, kind = "REACTION",
+                   section = ZonesSection, energy = 0.0):
+        def fits(tally):
+            return (tally["section"] == section and
+                    tally["nuclide"] == nuclide and
+                    tally["kind"] == kind and
+                    tally["number"] == number and
+                    tally["energy"] == energy)
+
+        known = self.index if self.index is not None else self._scanned
+        for tally in known:
+            if fits(tally):
+                return tally
+        if self.index is None:
+            # Scan further, but no more than needed
+            tally = self._scan_next()
+            while tally is not None:
+                if fits(tally):
+                    return tally
+                tally = self._scan_next()
+        raise TallyNotFound(self.fn, {"nuclide":nuclide, "kind":kind,
+                                      "number":number, "section":section})
+
+    def read_tally(self, nuclide, number, kind = "REACTION",
+                   section = ZonesSection, energy = 0.0):
+        """ Result is (zones, means, stdevs) arrays of the tally,
+            by default it is the tally of the first ZONES section,
+            for OBJECTS section tallies zones are objects numbers
+        """
+        tally = self.find_tally(nuclide, number, kind, section, energy)
+        mm = self._mm
+        pos = mm.find(b"\n", tally["offset"]) + 1
+        if hdr_pattern.match(mm, pos) is not None:
+            pos = mm.find(b"\n", pos) + 1
+        block_end = block_end_pattern.search(mm, pos - 1)
+        end = len(mm) if block_end is None else block_end.start() + 1
+        values = np.array(mm[pos:end].split(), dtype=float).reshape(-1, 3)
+        return values[:, 0].astype(int), values[:, 1], values[:, 2]
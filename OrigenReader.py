@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+# ORIGEN .out file time-dependent gamma tables reader.
+# Tables like
+# =   Gamma source intensity (1/s) as a function of time for case 'decay' (#2/2)  =
+# -------------------------------------------------------------------------------
+#      boundaries (MeV)     10043.0hr   10044.8hr   10046.2hr ...
+#  1.191E+01 - 8.090E+00    9.6554E-04  9.6554E-04  9.6554E-04 ...
+#  ...
+#   --------------------
+#                  total    8.0904E+07  1.6946E+07  1.2306E+07 ...
+# are all read in one pass over the file, every numeric block in bulk.
+# Parsed tables can be saved into the fn + ParsedSuffix sidecar file
+# and are read from there until the .out file changes.
+#
+# ORIGEN .f71 binary file (SCALE 6.2) is F71Magic header followed by
+# positions (time steps), each one is a typed block
+#   0x1b <uint16 length> {TagManager block, aux block, values...}
+# TagManager block holds the tag names, values follow in the same order.
+# Value types: 0x01 uint8, 0x04 float32, 0x08 float64,
+# 0x31 int32 array (uint16 byte length), 0x33/0x34 float64 array
+# (uint8/uint16 byte length), 0x14 string, 0x1a/0x29 blocks (uint8 length).
+# Numbers are stored in the smallest type keeping the value exactly
+
+import mmap, re, struct
+import numpy as np
+import FileCache
+
+IntensityTable = "intensity"    # Gamma source intensity (1/s)
+EnergyTable = "energy"          # Gamma energy release rate (MeV/s)
+ParsedSuffix = ".cache.npz"
+ParsedVersion = 1
+F71Magic = b"ORIGEN_F71"
+F71Suffix = ".f71"
+
+TABLE_KINDS = {b"Gamma source intensity":IntensityTable,
+               b"Gamma energy release rate":EnergyTable}
+TITLE_TEXT = b" as a function of time for case "
+title_pattern = re.compile(
+    rb"""^=\s+(?P<kind>Gamma\ source\ intensity|Gamma\ energy\ release\ rate)
+         \s+\((?P<unit>[^)]*)\)                 # Unit, e.g. 1/s
+         \s+as\ a\ function\ of\ time\ for\ case
+         \s+'(?P<case>[^']*)'                   # Case name, e.g. decay
+    """, re.VERBOSE | re.MULTILINE)
+hdr_pattern = re.compile(rb"^\s+boundaries \(MeV\)(?P<times>[^\r\n]*)",
+                         re.MULTILINE)
+time_pattern = re.compile(rb"(\S+)hr")
+# Band lines block ends with the "  -----" line before the total
+block_end_pattern = re.compile(rb"^\s*-+\s*$", re.MULTILINE)
+total_pattern = re.compile(rb"^\s+total(?P<values>[^\r\n]*)", re.MULTILINE)
+
+# .f71 value types: dtype or (array dtype, length size) or length size
+F71_SCALARS = {0x01:struct.Struct("<B"), 0x04:struct.Struct("<f"),
+               0x08:struct.Struct("<d")}
+F71_ARRAYS = {0x31:(np.dtype("<i4"), 2), 0x33:(np.dtype("<f8"), 1),
+              0x34:(np.dtype("<f8"), 2)}
+F71_STRING = 0x14
+F71_BLOCKS = {F71_STRING:1, 0x1a:1, 0x29:1, 0x1b:2}
+F71_POSITION = 0x1b
+# Position attributes by .f71 tags
+F71_TAGS = {"time":"ti",                # s
+            "power":"po",               # MW
+            "flux":"fl",                # n/cm2-s
+            "fluence":"fluence",        # n/cm2
+            "burnup":"bu",              # MWd
+            "case":"cn", "step":"sn", "libpos":"lp",
+            "nuclides":"ni",            # IZZZAAA + 10000000 * sublibrary
+            "concentrations":"co",      # gram-atoms
+            "gamma_bounds":"ge",        # MeV
+            "gamma_spectrum":"gs",      # 1/s
+            "volume":"vo"}
+
+class OrigenReaderException(Exception):
+    pass
+
+class F71FormatError(OrigenReaderException):
+    def __init__(self, file_name, offset, reason):
+        # The args make it picklable, it is raised in worker processes
+        super().__init__(file_name, offset, reason)
+        self.file_name = file_name
+        self.offset = offset
+        self.reason = reason
+
+    def __str__(self):
+        return f"File {self.file_name}, offset {self.offset}: {self.reason}"
+
+class OrigenTableNotFound(OrigenReaderException):
+    def __init__(self, file_name, kind, case):
+        # The args make it picklable, it is raised in worker processes
+        super().__init__(file_name, kind, case)
+        self.file_name = file_name
+        self.kind = kind
+        self.case = case
+
+    def __str__(self):
+        return (f"File {self.file_name} has no gamma {self.kind} table "
+                f"for case '{self.case}'")
+
+class TOrigenTable(object):
+    """ ORIGEN table of one kind (IntensityTable or EnergyTable) and case:
+        Emin, Emax are band boundaries, eV, in the file order,
+        times are the time headers, hours,
+        values is array[band, time], total is array[time]
+    """
+
+    def __init__(self, kind, case, unit, Emin, Emax, times, values, total):
+        self.kind = kind
+        self.case = case
+        self.unit = unit
+        self.Emin = Emin
+        self.Emax = Emax
+        self.times = times
+        self.values = values
+        self.total = total
+
+    @property
+    def bands(self):
+        # (Emin, Emax) tuples, eV
+        return list(zip(self.Emin.tolist(), self.Emax.tolist()))
+
+    def as_dict(self):
+        # Table as a dict {(Emin, Emax):list of values by time}
+        return dict(zip(self.bands, self.values.tolist()))
+
+    def extend(self, other):
+        # Appends the time columns of the table continuation
+        self.times = np.concatenate((self.times, other.times))
+        self.values = np.concatenate((self.values, other.values), axis = 1)
+        self.total = np.concatenate((self.total, other.total))
+
+
+def FindTitles(data):
+    # Titles are located by plain search, the regex checks their lines only
+    pos = data.find(TITLE_TEXT)
+    while pos != -1:
+        title = title_pattern.match(data, data.rfind(b"\n", 0, pos) + 1)
+        if title is not None:
+            yield title
+        pos = data.find(TITLE_TEXT, pos + len(TITLE_TEXT))
+
+def ParseTables(data):
+    # Result is a dict {(kind, case):TOrigenTable} of data bytes tables
+    tables = dict()
+    for title in FindTitles(data):
+        hdr = hdr_pattern.search(data, title.end())
+        if hdr is None:
+            break
+        times = np.array(time_pattern.findall(hdr.group("times")),
+                         dtype=float)
+        start = hdr.end() + 1
+        block_end = block_end_pattern.search(data, start)
+        end = len(data) if block_end is None else block_end.start()
+        # "1.191E+01 - 8.090E+00" boundaries are two numbers
+        block = data[start:end].replace(b" - ", b" ")
+        values = np.array(block.split(), dtype=float).reshape(-1, 2 + len(times))
+        total = np.full(len(times), np.nan)
+        if block_end is not None:
+            total_match = total_pattern.match(data, block_end.end() + 1)
+            if total_match is not None:
+                total = np.array(total_match.group("values").split(),
+                                 dtype=float)
+        bounds = 1e6 * values[:, 0:2]       # eV
+        table = TOrigenTable(TABLE_KINDS[title.group("kind")],
+                             title.group("case").decode(),
+                             title.group("unit").decode(),
+                             bounds.min(axis = 1), bounds.max(axis = 1),
+                             times, values[:, 2:], total)
+        key = (table.kind, table.case)
+        if key in tables:
+            tables[key].extend(table)
+        else:
+            tables[key] = table
+    return tables
+
+def LoadParsed(fn):
+    # Tables from the fn sidecar or None if it is missing or outdated
+    meta, arrays = FileCache.LoadNPZ(fn + ParsedSuffix)
+    if (meta is None or meta.get("version") != ParsedVersion
+            or not FileCache.FingerprintsMatch({fn:meta["source"]}, [fn])):
+        return None
+    tables = dict()
+    pos = 0
+    data = arrays["data"]
+    for table in meta["tables"]:
+        n_bands, n_times = table["shape"]
+        parts = list()
+        for size in (n_bands, n_bands, n_times, n_bands * n_times, n_times):
+            parts.append(data[pos:pos+size])
+            pos += size
+        parts[3] = parts[3].reshape(n_bands, n_times)
+        tables[(table["kind"], table["case"])] = TOrigenTable(
+                table["kind"], table["case"], table["unit"], *parts)
+    return tables
+
+def SaveParsed(fn, tables):
+    # All the tables numbers are packed into the single data array,
+    # one array is read much faster than a lot of small ones
+    meta = {"version":ParsedVersion,
+            "source":FileCache.FileFingerprint(fn),
+            "tables":[{"kind":table.kind, "case":table.case,
+                       "unit":table.unit, "shape":table.values.shape}
+                      for table in tables.values()]}
+    data = np.concatenate([np.concatenate((table.Emin, table.Emax,
+                                           table.times, table.values.ravel(),
+                                           table.total))
+                           for table in tables.values()] + [np.empty(0)])
+    FileCache.SaveNPZ(fn + ParsedSuffix, meta, data = data)
+
+def ReadOrigenOut(fn, use_sidecar = True, write_sidecar = False):
+    """ All the gamma tables of ORIGEN output fn as a dict
+        {(kind, case):TOrigenTable}, kind is IntensityTable or EnergyTable.
+        With use_sidecar the tables are taken from the fn + ParsedSuffix
+        file if it is up to date. With write_sidecar a parsed fn is
+        saved there, so only the writer of fn should ask for it
+    """
+    if use_sidecar:
+        tables = LoadParsed(fn)
+        if tables is not None:
+            return tables
+    with open(file = fn, mode='rb') as file_object:
+        with mmap.mmap(file_object.fileno(), 0,
+                       access = mmap.ACCESS_READ) as mm:
+            tables = ParseTables(mm)
+    if write_sidecar:
+        try:
+            SaveParsed(fn, tables)
+        except OSError:
+            # Read-only directory, the tables are parsed next time again
+            pass
+    return tables
+
+def ReadOrigenTable(fn, kind = IntensityTable, case = "decay",
+                    use_sidecar = True, write_sidecar = False):
+    tables = ReadOrigenOut(fn, use_sidecar, write_sidecar)
+    if (kind, case) not in tables:
+        raise OrigenTableNotFound(fn, kind, case)
+    return tables[(kind, case)]
+
+
+class TF71Position(object):
+    """ Values of one .f71 position by tag, see F71_TAGS for the
+        attribute names, e.g. position.time or position.gamma_spectrum.
+        Arrays are read-only views of the file memory
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getattr__(self, name):
+        if name not in F71_TAGS:
+            raise AttributeError(name)
+        return self.values.get(F71_TAGS[name])
+
+class TF71Reader(object):
+    """ Reads ORIGEN .f71 file fn positions.
+        Only the positions offsets are found when the file is opened,
+        a position is decoded when it is requested. Nothing is copied:
+        arrays are views of the memory mapped file, so they are
+        to be dropped (or copied) before the reader is closed
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._tags = dict()          # TagManager block -> tag names
+        self._case_runs = None
+        with open(file = fn, mode='rb') as file_object:
+            self._mm = mmap.mmap(file_object.fileno(), 0,
+                                 access = mmap.ACCESS_READ)
+        magic = self._mm.find(F71Magic, 0, 64)
+        if magic == -1:
+            self.close()
+            raise F71FormatError(fn, 0, "no ORIGEN_F71 header")
+        self.offsets = list()        # (start, end) of the positions blocks
+        pos = magic + len(F71Magic)
+        while pos < len(self._mm):
+            start, end = self._block(pos, F71_POSITION)
+            self.offsets.append((start, end))
+            pos = end
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, no):
+        return self.position(no)
+
+    def _block(self, pos, kind):
+        # Result is (start, end) of the kind block contents at pos
+        if self._mm[pos] != kind:
+            raise F71FormatError(self.fn, pos, f"block {kind:#x} expected")
+        size = F71_BLOCKS[kind]
+        start = pos + 1 + size
+        end = start + int.from_bytes(self._mm[pos+1:start], "little")
+        if end > len(self._mm):
+            raise F71FormatError(self.fn, pos, "block exceeds the file")
+        return start, end
+
+    def _value(self, pos):
+        # Result is (value, next value position)
+        kind = self._mm[pos]
+        if kind in F71_SCALARS:
+            scalar = F71_SCALARS[kind]
+            return scalar.unpack_from(self._mm, pos + 1)[0], pos + 1 + scalar.size
+        if kind in F71_ARRAYS:
+            dtype, size = F71_ARRAYS[kind]
+            start = pos + 1 + size
+            length = int.from_bytes(self._mm[pos+1:start], "little")
+            return (np.frombuffer(self._mm, dtype, length // dtype.itemsize,
+                                  start), start + length)
+        if kind in F71_BLOCKS:
+            start, end = self._block(pos, kind)
+            if kind == F71_STRING:
+                return self._mm[start:end].decode(), end
+            return None, end
+        raise F71FormatError(self.fn, pos, f"unknown value type {kind:#x}")
+
+    def tags(self, pos):
+        # Tag names of TagManager block at pos and the next item position
+        start, end = self._block(pos, 0x29)
+        key = self._mm[start:end]
+        if key not in self._tags:
+            count = int.from_bytes(key[0:2], "little")
+            names = list()
+            item = start + 2
+            for no in range(count):
+                name, item = self._value(item)
+                names.append(name)
+            # The first name is the block type
+            self._tags[key] = names[1:]
+        return self._tags[key], end
+
+    def position(self, no):
+        start, end = self.offsets[no]
+        tags, pos = self.tags(start)
+        # Aux block is not needed
+        value, pos = self._value(pos)
+        values = dict()
+        for tag in tags:
+            values[tag], pos = self._value(pos)
+        if pos != end:
+            raise F71FormatError(self.fn, pos, "position size mismatch")
+        return TF71Position(values)
+
+    def case_runs(self):
+        """ {case number:its positions numbers}, 1 is the first case.
+            SCALE appends to an existing .f71, so only the last run
+            of the case positions is taken
+        """
+        if self._case_runs is None:
+            self._case_runs = dict()
+            previous_case = None
+            for no in range(len(self)):
+                case = self.position(no).case
+                if case != previous_case:
+                    # The case run starts (again)
+                    self._case_runs[case] = list()
+                self._case_runs[case].append(no)
+                previous_case = case
+        return self._case_runs
+
+    def case_positions(self, case):
+        return [self.position(no) for no in self.case_runs().get(case, [])]
+
+    def gamma_table(self, case):
+        # Case gamma source intensity as TOrigenTable
+        positions = self.case_positions(case)
+        if len(positions) == 0:
+            raise OrigenTableNotFound(self.fn, IntensityTable, str(case))
+        # Bounds are float32 values of the input decimals
+        bounds = 1e6 * np.array([float(f"{E:.7g}")
+                                 for E in positions[0].gamma_bounds.tolist()])
+        values = np.stack([position.gamma_spectrum
+                           for position in positions], axis = 1)
+        return TOrigenTable(IntensityTable, str(case), "1/s",
+                            np.minimum(bounds[1:], bounds[:-1]),
+                            np.maximum(bounds[1:], bounds[:-1]),
+                            np.array([position.time for position in positions])
+                            / 3600, values, values.sum(axis = 0))
+
+    def concentrations(self, case):
+        # Result is (nuclides ids, array[nuclide, time]), gram-atoms
+        positions = self.case_positions(case)
+        return (np.array(positions[0].nuclides),
+                np.stack([position.concentrations
+                          for position in positions], axis = 1))
+
+def ReadF71GammaTable(fn, case):
+    with TF71Reader(fn) as reader:
+        return reader.gamma_table(case)
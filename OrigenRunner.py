@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# ORIGEN (SCALE scalerte) decks runner.
+# Decks are run concurrently by a bounded pool: every worker thread waits
+# for its own scalerte process, so no more than workers processes
+# are running at once. stdout/stderr of every run go to files
+# next to the deck instead of memory.
+# Every computation works in its own TOrigenJob scratch directory,
+# its useful results are published to the shared directory by os.replace.
+# TOrigenCache keeps ORIGEN outputs by the hash of the deck text.
+
+import concurrent.futures, hashlib, os, shutil, subprocess, tempfile, time
+
+StdoutSuffix = ".stdout.txt"
+StderrSuffix = ".stderr.txt"
+JobsDIRName = "jobs"            # Scratch directories inside the shared one
+CacheDIRName = "cache"          # TOrigenCache directory inside the shared one
+CachedSuffixes = (".f71", ".out")   # .out is the last one written
+
+class OrigenRunnerException(Exception):
+    pass
+
+class OrigenFailed(OrigenRunnerException):
+    def __init__(self, failed):
+        # The args make it picklable, it is raised in worker processes
+        super().__init__(failed)
+        self.failed = failed        # List of failed TOrigenResult
+
+    def __str__(self):
+        return "ORIGEN failed for " + ", ".join(
+                    f"{result.task_fn} ({result.reason()})"
+                    for result in self.failed)
+
+class OrigenNotCached(OrigenRunnerException):
+    def __init__(self, decks):
+        super().__init__(decks)
+        self.decks = decks
+
+    def __str__(self):
+        return ("No cached ORIGEN results for " + ", ".join(self.decks) +
+                ", ORIGEN has to be run")
+
+class TOrigenResult(object):
+    def __init__(self, task_fn):
+        self.task_fn = task_fn
+        self.stdout_fn = task_fn + StdoutSuffix
+        self.stderr_fn = task_fn + StderrSuffix
+        self.returncode = None
+        self.timed_out = False
+        self.error = None           # OSError text if the command can't start
+        self.attempts = 0
+        self.elapsed = 0.0          # Seconds, all the attempts
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def reason(self):
+        if self.error is not None:
+            return self.error
+        if self.timed_out:
+            return "timed out"
+        return f"exit code {self.returncode}"
+
+class TOrigenPool(object):
+    """ Runs ORIGEN decks: command + [deck file name].
+        command is the scalerte path or a list of arguments, so any
+        stand-in executable or script may take its place.
+        workers is the concurrency limit (0 is os.cpu_count()),
+        timeout is seconds per attempt (None is no limit),
+        a failed or timed out deck is rerun up to retries times
+    """
+
+    def __init__(self, command, workers = 0, timeout = None, retries = 0,
+                 cwd = None):
+        self.cwd = cwd
+        if isinstance(command, (list, tuple)):
+            self.command = list(command)
+        else:
+            self.command = [command]
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.timeout = timeout
+        self.retries = retries
+
+    def run_one(self, task_fn):
+        result = TOrigenResult(task_fn)
+        start = time.monotonic()
+        while result.attempts <= self.retries:
+            result.attempts += 1
+            result.timed_out = False
+            with open(result.stdout_fn, mode='wb') as stdout_object, \
+                 open(result.stderr_fn, mode='wb') as stderr_object:
+                try:
+                    result.returncode = subprocess.run(
+                            self.command + [task_fn],
+                            stdout = stdout_object, stderr = stderr_object,
+                            timeout = self.timeout, cwd = self.cwd).returncode
+                except subprocess.TimeoutExpired:
+                    # subprocess.run() has killed it already
+                    result.returncode = None
+                    result.timed_out = True
+                except OSError as ex:
+                    # No sense to retry if the command can't be started
+                    result.error = str(ex)
+                    break
+            if result.ok:
+                break
+        result.elapsed = time.monotonic() - start
+        return result
+
+    def run(self, task_fns):
+        # Result is a dict {task_fn:TOrigenResult} in task_fns order.
+        # A repeated deck is run once: concurrent runs of one deck
+        # would write the same output files
+        task_fns = list(dict.fromkeys(task_fns))
+        if len(task_fns) == 0:
+            return dict()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers = min(self.workers, len(task_fns))) as executor:
+            results = list(executor.map(self.run_one, task_fns))
+        return dict(zip(task_fns, results))
+
+
+class TOrigenJob(object):
+    """ Scratch directory shared_dir/jobs/<name>.XXXX of one computation
+        with a copy of the template file. The directory is removed
+        when the job is left normally or by OrigenNotCached (nothing
+        was run) and kept for inspection if it is left by another exception
+    """
+
+    def __init__(self, shared_dir, name, template_fn = None):
+        self.shared_dir = shared_dir
+        jobs_dir = os.path.join(shared_dir, JobsDIRName)
+        os.makedirs(jobs_dir, exist_ok = True)
+        self.dir = tempfile.mkdtemp(dir = jobs_dir, prefix = name + ".")
+        if template_fn is not None:
+            shutil.copyfile(os.path.join(shared_dir, template_fn),
+                            os.path.join(self.dir, template_fn))
+
+    def path(self, fn):
+        return os.path.join(self.dir, fn)
+
+    def publish(self, bases):
+        """ Moves every job file named base.* to the shared directory.
+            Each file replaces the shared one atomically, so readers
+            see either the previous or the new file, never a partial one
+        """
+        published = list()
+        for fn in sorted(os.listdir(self.dir)):
+            if any(fn.startswith(base + ".") for base in bases):
+                os.replace(self.path(fn), os.path.join(self.shared_dir, fn))
+                published.append(fn)
+        return published
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None or issubclass(exc_type, OrigenNotCached):
+            shutil.rmtree(self.dir, ignore_errors = True)
+
+
+def DeckKey(deck_text):
+    # Cache key of the fully substituted deck text (bytes)
+    return hashlib.sha1(deck_text).hexdigest()
+
+class TOrigenCache(object):
+    """ ORIGEN outputs (CachedSuffixes files) by DeckKey of the deck:
+        cache_dir/<key>.out etc. Files are written to temporary names
+        and renamed, so the cache may be shared by processes.
+        Entries not used for max_age seconds are evicted, then
+        the least recently used ones while the cache is over max_bytes
+    """
+
+    def __init__(self, cache_dir, max_bytes = None, max_age = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def fetch(self, key, base):
+        """ Copies the cached outputs of key to base + suffix files,
+            result is False if there is no such entry
+        """
+        try:
+            for suffix in reversed(CachedSuffixes):
+                if os.path.exists(self.path(key, suffix)):
+                    shutil.copyfile(self.path(key, suffix), base + suffix)
+                elif suffix == ".out":
+                    return False
+            # Mark the entry as used recently
+            os.utime(self.path(key, ".out"))
+        except FileNotFoundError:
+            # Evicted meanwhile
+            return False
+        return True
+
+    def store(self, key, base):
+        # Caches base + suffix outputs, .out is the last one
+        for suffix in CachedSuffixes:
+            if not os.path.exists(base + suffix):
+                continue
+            fd, tmp_fn = tempfile.mkstemp(dir = self.cache_dir,
+                                          prefix = key + suffix + ".")
+            os.close(fd)
+            try:
+                shutil.copyfile(base + suffix, tmp_fn)
+                os.chmod(tmp_fn, 0o644)
+                os.replace(tmp_fn, self.path(key, suffix))
+            except BaseException:
+                if os.path.exists(tmp_fn):
+                    os.remove(tmp_fn)
+                raise
+
+    def evict(self):
+        # Result is the number of evicted entries
+        entries = dict()            # key -> [last use, size]
+        for fn in os.listdir(self.cache_dir):
+            key, suffix = os.path.splitext(fn)
+            if suffix not in CachedSuffixes:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, fn))
+            except FileNotFoundError:
+                continue
+            entry = entries.setdefault(key, [0.0, 0])
+            if suffix == ".out":
+                entry[0] = stat.st_mtime
+            entry[1] += stat.st_size
+        by_use = sorted(entries.items(), key = lambda item: item[1][0])
+        total = sum(size for last_use, size in entries.values())
+        now = time.time()
+        evicted = 0
+        for key, (last_use, size) in by_use:
+            too_old = self.max_age is not None and now - last_use > self.max_age
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            if not (too_old or too_big):
+                continue
+            for suffix in reversed(CachedSuffixes):
+                try:
+                    os.remove(self.path(key, suffix))
+                except FileNotFoundError:
+                    pass
+            total -= size
+            evicted += 1
+        return evicted
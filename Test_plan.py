@@ -2,8 +2,13 @@
 
 import DataReader
 import FA_Gamma
+import FileCache
+import MCUReader
+import OrigenReader
+import OrigenRunner
 import m_print
-import datetime, re, os, math, subprocess, string
+import array, bisect, datetime, functools, re, os, math, subprocess
+import numpy as np
 
 TIME_FORMAT = '%d.%m.%Y %H:%M:%S'
 
@@ -14,6 +19,7 @@ detectors_eff_fn = "detectors_eff.txt"
 MCU_FA_spans = 0     # Will be adjusted during MCU_FAs_fn file parsing
 
 NEED_HISTRORY_FILES = False
+SAVE_FIN_INDEX = False   # Write MCU .FIN tallies index next to FIN files
 EXECUTE_NOW = False
 INIT_ONLY = True
 
@@ -25,13 +31,13 @@ maxW_fn = "maxW_history.txt"
 maxW2_fn = "maxW2_history.txt"
 
 MCUDIRName = "MCU_FIN"
-ZoneKey = "MCU zone"
+# Compiled algorithms are kept next to MCUDIRName directory
+AlgorithmsCacheSuffix = ".cache.npz"
+AlgorithmsCacheVersion = 1
 CellKey = "Cell"
 ChannelKey = "Channel"
 PitchKey = "Pitch"
 MeanKey = "Mean"
-StdevKey = "Stdev"
-RecUsefullKey = "Usefull"
 
 # Fields related to MCU_FAs.txt file
 R18CellField = "Cell"
@@ -48,6 +54,15 @@ NFAsField = "FAs"
 FINFileName = "FileName"
 ReferenceField = "Reference"
 
+# Fields related to the core history (test plan) file
+HistoryTimeField = "t"
+HistoryPowerField = "N(W)"
+HistoryAlgField = "Algorithm"
+HistoryFAsField = "FAs"
+HISTORY_CHUNK = 65536          # History records read at once
+LAST_HOURS = 2                 # "Last hours" burnup window, default
+SLIDING_CHUNK = 1024           # Sliding windows contracted at once
+
 # Fields related to detectors_eff.txt file
 RefDetChannelField = "Channel"
 RefDetEffectivenessField = "Eff"
@@ -55,7 +70,20 @@ RefDetEffectivenessField = "Eff"
 # ORIGEN-related constants
 OrigenDIRName = "Origens"
 template_file_name = "Origen_template.inp"
-scale_bin = "d:\\SCALE-6.2.4\\bin\\scalerte.exe"
+scale_bin = "d:\\SCALE-6.2.4\\bin\\scalerte.exe"  # Or a list of arguments
+ORIGEN_WORKERS = 0             # Concurrent ORIGEN runs, 0 is os.cpu_count()
+ORIGEN_TIMEOUT = None          # Seconds per ORIGEN run, None is no limit
+ORIGEN_RETRIES = 1             # Reruns of a failed ORIGEN deck
+ORIGEN_CACHE = True            # Keep ORIGEN outputs by the deck text hash
+ORIGEN_CACHE_MAX_BYTES = 2 << 30
+ORIGEN_CACHE_MAX_AGE = 90 * 24 * 3600     # Seconds since the last use
+ORIGEN_USE_F71 = False         # Read spectra from a fresh .f71 instead of .out
+ORIGEN_MULTI_CASE = False      # All the histories of a computation in one deck
+OrigenTemplateCases = 2        # Cases of the Origen template (irrad, decay)
+OrigenDecayCase = 2            # 'decay' case number of the Origen template
+OrigenCoreDeck = "core"        # InvokeOrigen multi-case deck name
+ORIGEN_SUPERPOSITION = False   # FA spans sources by TSourceBasis, not own runs
+SUPERPOSITION_CHECK = True     # Check the source basis against direct runs
 MARKER_T = "t=[ 1234567890987654321.1234567890987654321 ]"
 MARKER_PWR = "power = [ 1234567890987654321.1234567890987654321e38 ]"
 MARKER_TREG = "tt=[ 12 34 56 78 90 98 76 54 32 10 ]"
@@ -69,14 +97,31 @@ ResultsDIRName = "Core_FAs"
 class CoreProcException(Exception):
     pass
 
+class OrigenBandsMismatch(CoreProcException):
+    def __init__(self, unmatched):
+        super().__init__()
+        self.unmatched = unmatched
+
+    def __str__(self):
+        return ("No ORIGEN band for Green's energies " +
+                ", ".join(f"{E:.4e}" for E in self.unmatched) + " eV")
+
 class CoreHistoryInvalid(CoreProcException):
     def __init__(self, _why):
-        super().__init()
+        super().__init__()
         self.why = _why
 
     def __str__(self):
         return ("Core history file invalid: " + self.why)
 
+class OrigenTemplateInvalid(CoreProcException):
+    def __init__(self, _why):
+        super().__init__()
+        self.why = _why
+
+    def __str__(self):
+        return (f"Origen template {template_file_name} invalid: " + self.why)
+
 def write_data_file(fn, *arrays):
     with open(file = fn,
          mode='w', encoding='utf8') as file_object:
@@ -85,9 +130,20 @@ def write_data_file(fn, *arrays):
                                     for data_field in data_fields)
             file_object.write(data_string + '\n')
 
-def MakeOrigenFile(Origen_fn, str_t, str_power, str_treg):
-    fn = os.path.join(os.curdir, OrigenDIRName, Origen_fn)
-    template_fn = os.path.join(os.curdir, OrigenDIRName, template_file_name)
+def OrigenDIR():
+    # The shared ORIGEN directory
+    return os.path.join(os.curdir, OrigenDIRName)
+
+def OrigenJob(name):
+    # Scratch directory for ORIGEN runs of one computation
+    return OrigenRunner.TOrigenJob(OrigenDIR(), name, template_file_name)
+
+def MakeOrigenFile(Origen_fn, str_t, str_power, str_treg, origen_dir = None):
+    # origen_dir is a job directory, the shared one by default.
+    # Result is the deck cache key
+    origen_dir = OrigenDIR() if origen_dir is None else origen_dir
+    fn = os.path.join(origen_dir, Origen_fn)
+    template_fn = os.path.join(origen_dir, template_file_name)
     with open(file = template_fn,
              mode='r', encoding='cp1251') as template_file_object:
         entire_file = template_file_object.read()
@@ -105,95 +161,147 @@ def MakeOrigenFile(Origen_fn, str_t, str_power, str_treg):
     with open(file = fn, mode='w', encoding='cp1251') as origen_file_object:
         origen_file_object.write(treg_corrected)
     m_print.m_print(f"File {fn} saved")
+    return OrigenRunner.DeckKey(treg_corrected.encode('cp1251'))
+
+origen_case_pattern = re.compile(r"(case\s*\(\s*)(\w+)(\s*\))")
+origen_end_pattern = re.compile(r"^end\s*$", re.MULTILINE)
+origen_mat_pattern = re.compile(r"\bmat\s*\{")
+origen_time_pattern = re.compile(r"\btime\s*=?\s*\{")
+origen_start_pattern = re.compile(r"\bstart\s*=")
+
+def OrigenCaseName(case, no, n_histories):
+    # Name of the template case for history no of a deck of n_histories
+    return case if n_histories == 1 else f"{case}{no}"
+
+def FreshOrigenCases(cases):
+    """ The template cases text as the start of a history of
+        a multi-case deck. ORIGEN starts a case from the composition
+        and the time at the end of the previous one, so the first case
+        must have its mat block and gets start=0 if its time block
+        has no start
+    """
+    case_starts = [match.start() for match in
+                   origen_case_pattern.finditer(cases)] + [len(cases)]
+    first, others = cases[:case_starts[1]], cases[case_starts[1]:]
+    if origen_mat_pattern.search(first) is None:
+        raise OrigenTemplateInvalid("no mat block in the first case")
+    time = origen_time_pattern.search(first)
+    if time is None:
+        raise OrigenTemplateInvalid("no time block in the first case")
+    if origen_start_pattern.search(first, time.end(),
+                                   first.find("}", time.end())) is None:
+        first = first[:time.end()] + " start=0" + first[time.end():]
+    return first + others
+
+def MakeOrigenCasesFile(Origen_fn, params, str_treg, origen_dir = None):
+    """ Multi-case deck: the template cases are repeated for every
+        (str_t, str_power) of params, the cases of the history no
+        are renamed by OrigenCaseName. Every history starts from
+        the fresh material at time 0, see FreshOrigenCases. In ORIGEN
+        case numbers the decay case of history no is
+        no * OrigenTemplateCases + OrigenDecayCase.
+        Result is the deck cache key
+    """
+    origen_dir = OrigenDIR() if origen_dir is None else origen_dir
+    fn = os.path.join(origen_dir, Origen_fn)
+    template_fn = os.path.join(origen_dir, template_file_name)
+    with open(file = template_fn,
+             mode='r', encoding='cp1251') as template_file_object:
+        entire_file = template_file_object.read()
+    first_case = origen_case_pattern.search(entire_file).start()
+    *_, last_end = origen_end_pattern.finditer(entire_file)
+    cases = FreshOrigenCases(entire_file[first_case:last_end.start()])
+
+    deck = [entire_file[:first_case]]
+    for no, (str_t, str_power) in enumerate(params):
+        history_cases = cases.replace(MARKER_T, str_t).replace(
+            MARKER_PWR, str_power).replace(MARKER_TREG, str_treg)
+        deck.append(origen_case_pattern.sub(
+            lambda match: match.group(1) +
+                OrigenCaseName(match.group(2), no, len(params)) +
+                match.group(3), history_cases))
+    deck.append(entire_file[last_end.start():])
+    deck_text = "".join(deck)
 
-def RunOrigen(task_fn):
-    origen_fn = os.path.join(os.curdir, OrigenDIRName, task_fn)
-    call_args = [scale_bin, origen_fn]
-    try:
-        result = subprocess.run(call_args, check=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                encoding='utf-8')
-        if result.returncode == 0:
-            m_print.m_print("Origen was run successfully")
+    with open(file = fn, mode='w', encoding='cp1251') as origen_file_object:
+        origen_file_object.write(deck_text)
+    m_print.m_print(f"File {fn} with {len(params)} histories saved")
+    return OrigenRunner.DeckKey(deck_text.encode('cp1251'))
+
+def RunOrigens(task_fns, origen_dir = None):
+    # Runs ORIGEN decks task_fns of origen_dir (the shared ORIGEN
+    # directory by default) concurrently, result is a dict
+    # {task_fn:OrigenRunner.TOrigenResult}. A deck named more than
+    # once is run once, every its name gets the same result
+    origen_dir = OrigenDIR() if origen_dir is None else origen_dir
+    pool = OrigenRunner.TOrigenPool(scale_bin, workers = ORIGEN_WORKERS,
+                                    timeout = ORIGEN_TIMEOUT,
+                                    retries = ORIGEN_RETRIES,
+                                    cwd = origen_dir)
+    origen_fns = [os.path.abspath(os.path.join(origen_dir, task_fn))
+                  for task_fn in task_fns]
+    pool_results = pool.run(origen_fns)
+    results = {task_fn:pool_results[origen_fn]
+               for task_fn, origen_fn in zip(task_fns, origen_fns)}
+    for task_fn, result in results.items():
+        if result.ok:
+            m_print.m_print(f"Origen was run successfully for {task_fn}, "
+                            f"{result.elapsed:.1f} s")
         else:
-            m_print.m_print(f"Origen's exit code was {result.returncode}")
-    except subprocess.CalledProcessError as ex:
-        m_print.m_print("Exception while Origen-ing")
-        m_print.m_print("Exit status = {}".format(ex.returncode))
-        m_print.m_print("Invokation string was {}".format(ex.cmd))
-        m_print.m_print("scalerte stdout was {}".format(ex.stdout))
-        m_print.m_print("scalerte stderr was {}".format(ex.stderr))
-
-def ReadLine(line):
-    line_pattern = re.compile(
-            r"""^\s+                           # Any number of spaces
-                 (?P<zone>[0-9]+)              # Integer Zone no
-                  \s+                          # Any number of spaces
-                 (?P<mean>                     # Mean flux
-                  [-+]?[0-9]*[.]?[0-9]+        # Mantissa part
-                  ([eE][-+]?[0-9]+)?)          # Optional exponent
-                  \s+                          # Any number of spaces
-                  (?P<StdDev>                  # Flux standard deviation
-                  [-+]?[0-9]*[.]?[0-9]+        # Mantissa part
-                  ([eE][-+]?[0-9]+)?)          # Optional exponent
-                  [\r\n]$                      # End of line
-            """, re.VERBOSE)
-    triple_num_match = line_pattern.match(line)
-    if triple_num_match is None:
-        details = {ZoneKey:-1, MeanKey:float("NaN"), StdevKey:float("NaN")}
-        return False, details
-    zone = int(triple_num_match.group("zone"))
-    mean = float(triple_num_match.group("mean"))
-    stdev = float(triple_num_match.group("StdDev"))
-    details = {ZoneKey:zone, MeanKey:mean, StdevKey:stdev}
-    return True, details
-
-def ReadR18Line(FAs_reader, line):
-    data_line_OK, data_dict = ReadLine(line)
-
-    zone = data_dict[ZoneKey]
-    cell_idx = FAs_reader.find_field_index(R18CellField)
-    pitch_idx = FAs_reader.find_field_index(R18PitchField)
-
+            m_print.m_print(f"Exception while Origen-ing {task_fn}: "
+                            f"{result.reason()} after {result.attempts} attempts")
+            m_print.m_print("Invokation string was {}".format(
+                            pool.command + [result.task_fn]))
+            m_print.m_print(f"scalerte stdout is in {result.stdout_fn}")
+            m_print.m_print(f"scalerte stderr is in {result.stderr_fn}")
+    return results
+
+def RunOrigen(task_fn, origen_dir = None):
+    return RunOrigens([task_fn], origen_dir)[task_fn]
+
+def FreshF71(out_fn):
+    # The .f71 next to ORIGEN output out_fn if it is not older than
+    # out_fn, else None: SCALE appends to an existing .f71, a .f71 left
+    # by an earlier run of another deck is older than the .out
+    f71_fn = os.path.splitext(out_fn)[0] + OrigenReader.F71Suffix
     try:
-        FAspan = FAs_reader[zone]
-        cell = str(FAspan[cell_idx])
-        pitch = int(FAspan[pitch_idx])
-
-        FAspanD = {ZoneKey:zone, CellKey:cell, PitchKey:pitch,
-                   MeanKey:data_dict[MeanKey],
-                   StdevKey:data_dict[StdevKey],
-                   RecUsefullKey:True}
-        # print_dict(FAspanD)
-    except KeyError:
-        # print(f"Zone {zone} was not found in MCU_FAs.txt")
-        FAspanD = {ZoneKey:zone, CellKey:"-", PitchKey:-1,
-                   MeanKey:float("NaN"), StdevKey:float("NaN"), RecUsefullKey:False}
-
-    return data_line_OK, FAspanD
-
-def ReadR3Line(MCU_detectors_reader, line):
-    data_line_OK, data_dict = ReadLine(line)
-
-    zone = data_dict[ZoneKey]
-    channel_idx = MCU_detectors_reader.find_field_index(R3ChannelField)
-
-    try:
-        det_channel = MCU_detectors_reader[zone]
-        channel = int(det_channel[channel_idx])
-
-        detector = {ZoneKey:zone, ChannelKey:channel,
-                   MeanKey:data_dict[MeanKey],
-                   StdevKey:data_dict[StdevKey],
-                   RecUsefullKey:True}
-        # print_dict(detector)
-    except KeyError:
-        # print(f"Zone {zone} was not found in MCU_detectors.txt")
-        detector = {ZoneKey:zone, ChannelKey:-1,
-                   MeanKey:float("NaN"), StdevKey:float("NaN"), RecUsefullKey:False}
-
-    return data_line_OK, detector
+        if os.path.getmtime(f71_fn) >= os.path.getmtime(out_fn):
+            return f71_fn
+    except FileNotFoundError:
+        pass
+    return None
+
+def OrigenCache():
+    return OrigenRunner.TOrigenCache(
+                os.path.join(OrigenDIR(), OrigenRunner.CacheDIRName),
+                ORIGEN_CACHE_MAX_BYTES, ORIGEN_CACHE_MAX_AGE)
+
+def RunOrigenDecks(decks, origen_dir, run_origen = True):
+    """ decks is a dict {deck name without .inp:MakeOrigenFile key}.
+        Outputs of the decks known to the ORIGEN cache are taken
+        from it, other decks are run and their outputs cached.
+        If run_origen is False every deck must be in the cache.
+        Raises OrigenRunner.OrigenFailed if any deck fails, before
+        its outputs are used
+    """
+    cache = OrigenCache() if ORIGEN_CACHE else None
+    to_run = [fn for fn, key in decks.items() if cache is None or
+              not cache.fetch(key, os.path.join(origen_dir, fn))]
+    if len(to_run) < len(decks):
+        m_print.m_print(f"{len(decks) - len(to_run)} of {len(decks)} "
+                        "Origen results were taken from the cache")
+    if len(to_run) > 0 and not run_origen:
+        raise OrigenRunner.OrigenNotCached(to_run)
+    results = RunOrigens([fn + ".inp" for fn in to_run], origen_dir)
+    if cache is not None and len(to_run) > 0:
+        for fn in to_run:
+            if results[fn + ".inp"].ok:
+                cache.store(decks[fn], os.path.join(origen_dir, fn))
+        cache.evict()
+    failed = [result for result in results.values() if not result.ok]
+    if failed:
+        raise OrigenRunner.OrigenFailed(failed)
+    return results
 
 # Calculated FAs - there ara whole core of them in each TAlgorithm
 class TCalcFA(object):
@@ -207,12 +315,6 @@ class Tdetector(object):
 
 class TAlgorithm(object):
 
-    zones_line = " -- ZONES --"
-    objects_line = " -- OBJECTS --"
-    hdr_line = "         Zone          Mean        StdDev"
-    R3_line  = " NUCLIDE:          MIXT, REACTION:            3, ENERGY:    0.00000E+00"
-    R18_line = " NUCLIDE:          MIXT, REACTION:           18, ENERGY:    0.00000E+00"
-
     def __init__(self, FAs_reader, detectors_eff_reader, MCU_detectors_reader,
                  HCrit, NFAs, FINfn, isRefAlg):
 
@@ -236,66 +338,29 @@ class TAlgorithm(object):
             if data_dict[PitchKey] + 1 > MCU_FA_spans:
                 MCU_FA_spans = data_dict[PitchKey] + 1
 
-        # Read MCU .fin file
+        # MCU reg zone -> detector channel and FA span records
+        channel_idx = MCU_detectors_reader.find_field_index(R3ChannelField)
+        detector_zones = MCU_detectors_reader.index_by_field(
+                                                DataReader.RegZoneField)
+        cell_idx = FAs_reader.find_field_index(R18CellField)
+        pitch_idx = FAs_reader.find_field_index(R18PitchField)
+        FA_zones = FAs_reader.index_by_field(DataReader.RegZoneField)
+
+        # Read MIXT R3 and R18 tallies of MCU .fin file
         fn = os.path.join(MCUDIRName, FINfn)
-        R3Lines2find = 3
-        R18Lines2find = 3
-        R3Records = 0; R18Records = 0
-        R3Over = False; R18Over = False
-        with open(file = fn, mode='r', encoding='utf8') as FINfileObject:
-            finLineNo = 0
-            for finLine in FINfileObject:
-                finLineNo += 1
-                if finLine.startswith(type(self).zones_line):
-                    # print("ZONES found")
-                    R3Lines2find -= 1
-                    R18Lines2find -= 1
-                    continue
-                if finLine.startswith(type(self).objects_line):
-                    # print("OBJECTS found")
-                    R3Lines2find += 10
-                    R18Lines2find += 10
-                    continue
-                if finLine.startswith(type(self).R3_line):
-                    # print("MIX R3 found")
-                    R3Lines2find -= 1
-                    continue
-                if finLine.startswith(type(self).R18_line):
-                    # print("MIX R18 found")
-                    R18Lines2find -= 1
-                    continue
-                if R3Lines2find == 1 and finLine.startswith(type(self).hdr_line):
-                    R3Lines2find -= 1
-                    continue
-                if R3Lines2find == 0:
-                    # Read MIX R3 info
-                    # print(f"Reading R3, line no = {finLineNo}")
-                    data_line_OK, data_dict = ReadR3Line(MCU_detectors_reader, finLine)
-                    if not data_line_OK:
-                        # Finished reading R3 array
-                        R3Lines2find += 10
-                        R3Over = True
-                    elif data_dict[RecUsefullKey]:
-                        # print_dict(data_dict)
-                        add_detector(data_dict)
-                        R3Records += 1
-                if R18Lines2find == 1 and finLine.startswith(type(self).hdr_line):
-                    R18Lines2find -= 1
-                    continue
-                if R18Lines2find == 0:
-                    # Read MIX R18 info
-                    # print(f"Reading R18, line no = {finLineNo}")
-                    data_line_OK, data_dict = ReadR18Line(FAs_reader, finLine)
-                    if not data_line_OK:
-                        # Finished reading R18 array
-                        R18Lines2find += 10
-                        R18Over = True
-                    elif data_dict[RecUsefullKey]:
-                        # print_dict(data_dict)
-                        add_mod_FA(data_dict)
-                        R18Records += 1
-                if R3Over and R18Over:
-                    break
+        with MCUReader.TFINReader(fn, save_index = SAVE_FIN_INDEX) as FINreader:
+            zones, means, _ = FINreader.read_tally("MIXT", 3)
+            for zone, mean in zip(zones.tolist(), means.tolist()):
+                if zone in detector_zones:
+                    channel = int(detector_zones[zone][channel_idx])
+                    add_detector({ChannelKey:channel, MeanKey:mean})
+            zones, means, _ = FINreader.read_tally("MIXT", 18)
+            for zone, mean in zip(zones.tolist(), means.tolist()):
+                if zone in FA_zones:
+                    FAspan = FA_zones[zone]
+                    add_mod_FA({CellKey:str(FAspan[cell_idx]),
+                                PitchKey:int(FAspan[pitch_idx]),
+                                MeanKey:mean})
 
         # Calculate total core fissions
         self.total_fissions = float(0)
@@ -308,6 +373,49 @@ class TAlgorithm(object):
             for span in FA.fissions:
                 FA.fissions[span] /= self.total_fissions
 
+    def to_arrays(self):
+        # Everything read from the FIN file as arrays:
+        # cells[cell], fissions[cell, span] (NaN if there is no such span),
+        # channels[detector], R3[detector], total_fissions
+        cells = list(self.FAs)
+        spans = max(max(FA.fissions) for FA in self.FAs.values()) + 1
+        fissions = np.full((len(cells), spans), np.nan)
+        for n, cell in enumerate(cells):
+            for span, fraction in self.FAs[cell].fissions.items():
+                fissions[n, span] = fraction
+        channels = list(self.detectors)
+        return {"cells":np.array(cells, dtype=str),
+                "fissions":fissions,
+                "channels":np.array(channels, dtype=int),
+                "R3":np.array([self.detectors[ch].R3 for ch in channels]),
+                "total_fissions":np.array(self.total_fissions)}
+
+    @classmethod
+    def from_arrays(cls, arrays, HCrit, isRefAlg):
+        # Restores TAlgorithm from to_arrays() result
+        global MCU_FA_spans
+        alg = cls.__new__(cls)
+        alg.FAs = dict()
+        alg.detectors = dict()
+        alg.Hcrit = float(HCrit)
+        alg.isReference = bool(isRefAlg)
+        for cell, fissions in zip(arrays["cells"].tolist(),
+                                  arrays["fissions"].tolist()):
+            alg.FAs[cell] = TCalcFA()
+            for span, fraction in enumerate(fissions):
+                if not math.isnan(fraction):
+                    alg.FAs[cell].fissions[span] = fraction
+                    if span + 1 > MCU_FA_spans:
+                        MCU_FA_spans = span + 1
+        for channel, R3 in zip(arrays["channels"].tolist(),
+                               arrays["R3"].tolist()):
+            detector = Tdetector()
+            detector.channel = channel
+            detector.R3 = R3
+            alg.detectors[channel] = detector
+        alg.total_fissions = float(arrays["total_fissions"])
+        return alg
+
 
 # Actual FAs
 class TFA(object):
@@ -325,6 +433,10 @@ class TFAspanHistory(object):
             self.ref_hrs = hrs
         self.history.append((hrs, pwr))
 
+    def add_points(self, hrs, pwrs):
+        for point in zip(hrs, pwrs):
+            self.add_point(*point)
+
     def save_into_file(self, result_fn):
         fn = os.path.join(os.curdir, ResultsDIRName, result_fn)
         with open(file = fn, mode='wt',
@@ -469,6 +581,277 @@ class TEnvelopeFAspanHistory(object):
 
 
 
+# Core history file read chunk by chunk
+class THistoryStream(object):
+    def __init__(self, fn, chunk_size = HISTORY_CHUNK):
+        self.fn = fn
+        self.stream = DataReader.TDataStream(fn, chunk_size)
+
+    @property
+    def fields(self):
+        return self.stream.fields
+
+    @property
+    def records(self):
+        # Records read so far
+        return self.stream.data_lines
+
+    def chunks(self):
+        # Generator of (t, N, algorithm, FAs) records lists
+        indexes = None
+        for chunk in self.stream.chunks():
+            if indexes is None:
+                indexes = [self.stream.find_field_index(field) for field in
+                           (HistoryTimeField, HistoryPowerField,
+                            HistoryAlgField, HistoryFAsField)]
+                it, ipwr, ialg, iFAs = indexes
+            yield [(rec[it], rec[ipwr], rec[ialg], int(rec[iFAs]))
+                   for rec in chunk]
+
+# Compact core history: time, power and algorithm of every record
+class THistoryTrace(object):
+    def __init__(self):
+        self.times = array.array('d')
+        self.powers = array.array('d')
+        self.alg_nos = array.array('i')
+        self.alg_keys = list()          # (alg_name, FAs) by alg_no
+        self._alg_nos = dict()
+
+    def add_point(self, hrs, pwr, alg_key):
+        alg_no = self._alg_nos.get(alg_key)
+        if alg_no is None:
+            alg_no = len(self.alg_keys)
+            self._alg_nos[alg_key] = alg_no
+            self.alg_keys.append(alg_key)
+        self.times.append(hrs)
+        self.powers.append(pwr)
+        self.alg_nos.append(alg_no)
+
+    def add_points(self, hrs, pwrs, alg_keys):
+        for point in zip(hrs, pwrs, alg_keys):
+            self.add_point(*point)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        # (hrs, pwr, alg_key) records
+        alg_keys = self.alg_keys
+        for hrs, pwr, alg_no in zip(self.times, self.powers, self.alg_nos):
+            yield hrs, pwr, alg_keys[alg_no]
+
+# Cumulative energy generated under every algorithm, kept separately
+# for every algorithm at the end times of its own history steps,
+# so the energy of any time window takes a bisection per algorithm
+class TEnergyPrefix(object):
+    def __init__(self, n_algs):
+        self.times = [array.array('d') for code in range(n_algs)]
+        self.energies = [array.array('d') for code in range(n_algs)]
+
+    def add_points(self, times, burnups, codes):
+        # burnups[n] W*hr generated under algorithm codes[n]
+        # by the step ending at times[n]
+        for code in np.unique(codes).tolist():
+            step = codes == code
+            energies = np.cumsum(burnups[step])
+            if len(self.energies[code]) > 0:
+                energies += self.energies[code][-1]
+            self.times[code].extend(times[step].tolist())
+            self.energies[code].extend(energies.tolist())
+
+    def _by(self, code, t):
+        # Energy of the algorithm by the time t (None is the history end)
+        energies = self.energies[code]
+        if t is None:
+            n = len(energies)
+        else:
+            n = bisect.bisect_right(self.times[code], t)
+        return energies[n - 1] if n > 0 else 0.0
+
+    def window(self, t1 = None, t2 = None):
+        # Energies of the steps ending in (t1, t2], None is the
+        # history start or end. Result is array[algorithm]
+        return np.array([self._by(code, t2) -
+                         (0.0 if t1 is None else self._by(code, t1))
+                         for code in range(len(self.energies))])
+
+    def windows(self, t1s, t2s):
+        # Vectorized window(): result is array[window, algorithm]
+        result = np.zeros((len(t2s), len(self.energies)))
+        for code, (times, energies) in enumerate(zip(self.times,
+                                                     self.energies)):
+            if len(energies) == 0:
+                continue
+            times = np.frombuffer(times, dtype = float)
+            energies = np.concatenate(([0.0], energies))
+            result[:, code] = (
+                energies[np.searchsorted(times, t2s, side = "right")] -
+                energies[np.searchsorted(times, t1s, side = "right")])
+        return result
+
+# Algorithms fission fractions packed into array[algorithm, cell, span],
+# algorithms are coded by their order in alg_keys
+class TFissionTensor(object):
+    def __init__(self, algorithms, cells, n_spans):
+        self.alg_keys = list(algorithms)
+        self.codes = {alg_key:code for code, alg_key in enumerate(self.alg_keys)}
+        self.cells = list(cells)
+        self.cell_idx = {cell:n for n, cell in enumerate(self.cells)}
+        self.fissions = np.zeros((len(self.alg_keys), len(self.cells), n_spans))
+        for code, alg_key in enumerate(self.alg_keys):
+            FAs = algorithms[alg_key].FAs
+            for n, cell in enumerate(self.cells):
+                for FAspan, K in FAs[cell].fissions.items():
+                    self.fissions[code, n, FAspan] = K
+        self.NFAs = np.array([alg_key[1] for alg_key in self.alg_keys],
+                             dtype = float)
+        # Max fission fraction of every algorithm and its cell and span
+        flat = self.fissions.reshape(len(self.alg_keys), -1)
+        max_idx = flat.argmax(axis = 1)
+        self.max_K = flat.max(axis = 1)
+        self.max_cells = [self.cells[idx // n_spans] for idx in max_idx.tolist()]
+        self.max_spans = [idx % n_spans for idx in max_idx.tolist()]
+
+    def codes_of(self, alg_keys):
+        # Raises KeyError for unknown algorithm like self.algorithms does
+        return np.array([self.codes[alg_key] for alg_key in alg_keys],
+                        dtype = int)
+
+    def max_span_of(self, burnups):
+        # (cell, span, burnup) of the max positive burnups[cell, span]
+        # element, ("", -1, 0.0) if there is no positive one
+        idx = np.unravel_index(burnups.argmax(), burnups.shape)
+        if burnups[idx] > 0.0:
+            return self.cells[idx[0]], int(idx[1]), burnups[idx].item()
+        return "", -1, 0.0
+
+    def max_cell_of(self, FA_burnups):
+        # (cell, burnup) of the max positive FA_burnups[cell] element
+        idx = FA_burnups.argmax()
+        if FA_burnups[idx] > 0.0:
+            return self.cells[idx], FA_burnups[idx].item()
+        return "", 0.0
+
+# ORIGEN bands to Green's incident energies mapping
+class TBandMap(object):
+    """ bands is the ORIGEN energy bands sequence [(Emin, Emax), ...], eV
+        Esrcs is the Green's incident energies array, eV
+        band_idx[Esrc] is the index of the first band holding Esrc
+        or -1, such energies are listed in unmatched
+    """
+
+    def __init__(self, bands, Esrcs):
+        self.bands = list(bands)
+        self.Esrcs = np.array(Esrcs, dtype=float)
+        self.band_idx = np.full(len(self.Esrcs), -1, dtype=int)
+        for n, Esrc in enumerate(self.Esrcs.tolist()):
+            for b, (Emin, Emax) in enumerate(self.bands):
+                if Emin <= Esrc <= Emax:
+                    self.band_idx[n] = b
+                    break
+        self.matched = self.band_idx >= 0
+        self.unmatched = self.Esrcs[~self.matched].tolist()
+
+    def gather(self, spectra):
+        # spectra is array[..., band, time],
+        # result is array[..., Esrc, time], no band - no source
+        by_Esrc = np.take(spectra, self.band_idx, axis=-2)
+        by_Esrc[..., ~self.matched, :] = 0.0
+        return by_Esrc
+
+# Flux to dose rate conversion
+class TDoseResponse(object):
+    """ NRB-99 dose weights on the registered energy grid ERegs:
+        dose rate, Sv/sec = sum(weights[E] * flux[E]), flux in p/cm2*sec
+        interpolation is
+            "bins"   - every NRB energy adds its constant to the upper
+                       boundary of the ERegs interval it falls into
+                       (the way the dose was always calculated)
+            "loglog" - every ERegs interval gets the NRB constant
+                       log-log interpolated at the interval geometric
+                       center, out of the NRB range constants are clamped.
+                       NRB constants must be positive, ValueError
+                       is raised otherwise
+    """
+
+    def __init__(self, ERegs, NRB, interpolation = "bins"):
+        ERegs = [float(E) for E in ERegs]
+        self.ERegs = np.array(ERegs)
+        self.interpolation = interpolation
+        self.weights = np.zeros(len(ERegs))
+        if interpolation == "bins":
+            for E_NRB in NRB:
+                for n, (Elow, EHigh) in enumerate(zip(ERegs[:-1], ERegs[1:])):
+                    if Elow <= E_NRB <= EHigh:
+                        self.weights[n+1] += NRB[E_NRB] * 1e-12
+        elif interpolation == "loglog":
+            E_NRB = sorted(NRB)
+            bad = [E for E in E_NRB if not NRB[E] > 0.0]
+            if bad:
+                # No logarithm, the weights would be 0 or nan
+                raise ValueError(f"NRB constants of {bad} eV are not positive")
+            log_E = np.log(E_NRB)
+            log_K = np.log([NRB[E] for E in E_NRB])
+            for n, (Elow, EHigh) in enumerate(zip(ERegs[:-1], ERegs[1:])):
+                E = math.sqrt(Elow * EHigh) if Elow > 0.0 else EHigh
+                self.weights[n+1] = math.exp(
+                    np.interp(math.log(E), log_E, log_K)) * 1e-12
+        else:
+            raise ValueError(f"Unknown NRB interpolation {interpolation}")
+
+    def apply(self, fluxes):
+        # fluxes is array[..., E], result is array[...] of dose rates
+        return fluxes @ self.weights
+
+
+def MaxRelativeError(diffs, totals):
+    # Max of diffs / totals over the times with positive totals,
+    # a zero total (empty span, cut-off table) gives no ratio, 0.0
+    # if there is no such time at all
+    ratios = np.divide(diffs, totals, out = np.zeros(np.shape(diffs)),
+                       where = totals > 0.0)
+    return ratios.max(initial = 0.0).item()
+
+# Decay gamma sources of the algorithms basis histories
+class TSourceBasis(object):
+    """ codes are fission tensor codes of the basis algorithms,
+        K_ref are their reference fission fractions, tables are ORIGEN
+        'decay' tables of TCoreHistory.BasisHistory of every code.
+        ORIGEN is taken as linear in the power history, which holds
+        while the burnup is low, so the source of a span with fission
+        fractions K[algorithm] is the sum of the basis spectra
+        weighted by K[code] / K_ref.
+        spectra is array[basis, band, time], errors is the list of
+        TCoreHistory.CheckSourceBasis results
+    """
+
+    def __init__(self, codes, K_ref, tables, max_reg_hours, tregs):
+        self.codes = np.array(codes, dtype = int)
+        self.K_ref = np.array(K_ref, dtype = float)
+        self.bands = tables[0].bands
+        self.max_reg_hours = max_reg_hours
+        self.tregs = list(tregs)
+        self.spectra = np.array([table.values for table in tables])
+        self.errors = list()
+
+    @property
+    def error(self):
+        # Max spectrum error of the checked spans, None if not checked
+        if len(self.errors) == 0:
+            return None
+        return max(error["spectrum_error"] for error in self.errors)
+
+    def weights(self, K):
+        # K is array[algorithm, ...] of fission fractions,
+        # result is array[basis, ...]
+        K = np.asarray(K)[self.codes]
+        return K / self.K_ref.reshape((-1,) + (1,) * (K.ndim - 1))
+
+    def sources(self, K):
+        # Sources of K fission fractions as array[..., band, time]
+        return np.tensordot(self.weights(K), self.spectra, axes = (0, 0))
+
+
 class TCoreHistory(object):
     history_fn = "Test_Plan.txt"
     Origen_fns = ["max_burnup", "max_2_hours", "envelope"]
@@ -478,355 +861,661 @@ class TCoreHistory(object):
            0.2e6:1.0,   0.3e6:1.51, 0.4e6:2.0,  0.5e6:2.47,  0.6e6:2.91,
            0.8e6:3.73,  1e6:4.48,   2e6:7.49,   4e6:12.0,    6e6:16.0,
            8e6:19.9,    10e6:23.8}
+    # How NRB constants are put onto the registered energies,
+    # see TDoseResponse
+    NRB_interpolation = "bins"
+    # TDoseResponse operators cache, key is (ERegs, NRB_interpolation)
+    dose_responses = dict()
+    # TBandMap cache, key is (ORIGEN bands, Green's Esrcs)
+    band_maps = dict()
+    # Raise OrigenBandsMismatch if some Green's incident energies
+    # have no ORIGEN band, otherwise they are reported and skipped
+    strict_bands = False
+    # Width of the "last hours" window of Wmax2_history, hours
+    Wmax2_hours = LAST_HOURS
 
 
     def append_history_rec(self, t, N, alg, FAs):
-        with open(file = type(self).history_fn, mode='at',
+        with open(file = self.history_path, mode='at',
                   encoding='utf8') as data_file_object:
-            rec = (t.strftime(TIME_FORMAT), str(N), str(alg), f"{FAs:d}")
+            if isinstance(t, datetime.datetime):
+                t = t.strftime(TIME_FORMAT)
+            rec = (str(t), str(N), str(alg), f"{FAs:d}")
             line = '\t'.join(rec) + '\n'
             data_file_object.write(line)
 
 
     def __init__(self, _algorithms, _Greens):
-        TimeField = "t"
-        PowerField = "N(W)"
-        AlgField = "Algorithm"
-        FAsField = "FAs"
-
+        """ Reads the core history. Burnups, max burnup spans and FAs,
+            their histories and the envelope are computed on the first
+            access (see history_products) and kept until
+            the history is appended
+        """
         self.algorithms = _algorithms
         self.Greens = _Greens
         # Find the reference algorithm
         for alg_key, alg in self.algorithms.items():
             if alg.isReference:
-                reference_algorithm = alg
-                ref_alg_key = alg_key
-
-        # Read the core test planned schedule
-        fn = os.path.join(os.curdir, ConfigDIRName, type(self).history_fn)
-        self.HistoryReader = DataReader.TDataReader(fn)
+                self.ref_alg_key = alg_key
+
+        # (t, N, algorithm) of every record for the histories
+        # of particular FA spans
+        self.history_trace = THistoryTrace()
+        # Algorithms fission fractions as array[algorithm, cell, span]
+        self.fission_tensor = TFissionTensor(
+                self.algorithms,
+                list(self.algorithms[self.ref_alg_key].FAs), MCU_FA_spans)
+        # for debugging/testing only
+        m_print.m_print(f"Totally {len(self.fission_tensor.cells)} FAs in the core")
+        # Cumulative energy generated under every algorithm, W*hr
+        self.energy_prefix = TEnergyPrefix(len(self.fission_tensor.alg_keys))
+        self.last_time = None
+        # Histories kept to be extended after the history is appended,
+        # name -> (FA span, history)
+        self._kept_histories = dict()
+
+        # Read the core test planned schedule chunk by chunk
+        self.history_path = os.path.join(os.curdir, ConfigDIRName,
+                                         type(self).history_fn)
+        history = THistoryStream(self.history_path)
+        for chunk in history.chunks():
+            self._add_records(chunk)
+
+        if self.last_time is None:
+            raise CoreHistoryInvalid("no records")
         m_print.m_print("Core test plan read successfully")
         m_print.m_print("Fields: ")
-        m_print.m_print(self.HistoryReader.fields)
-        m_print.m_print(f"Total {len(self.HistoryReader.raw_data)} data records")
-        self.TimeIndex = self.HistoryReader.find_field_index(TimeField)
-        self.PowerIndex = self.HistoryReader.find_field_index(PowerField)
-        self.AlgIndex = self.HistoryReader.find_field_index(AlgField)
-        self.FAsIndex = self.HistoryReader.find_field_index(FAsField)
-
-        # Check fist record power, must be zero
-        power0 = self.HistoryReader.raw_data[0][self.PowerIndex]
-        if power0 > 1e-15:
-            raise CoreHistoryInvalid("first record must have zero power")
-
-        # Create TWO fuel assemblies lists from the reference algorithm
-        # with zero burn-up
-        # first is for total burn-up accumulation, second for last 2 hours
-        self.FAs = dict()
-        self.FAs2 = dict()
-        for cell in reference_algorithm.FAs:
-            self.FAs[cell] = TFA()
-            self.FAs2[cell] = TFA()
-            for FAspan in reference_algorithm.FAs[cell].fissions:
-                self.FAs[cell].burnup[FAspan] = 0.0
-                self.FAs2[cell].burnup[FAspan] = 0.0
-        # for debugging/testing only
-        m_print.m_print(f"Totally {len(self.FAs)} FAs in the core")
-##        m_print.m_print("Following are FA cells with number of spans:")
-##        for FA in self.FAs:
-##            print(FA, len(self.FAs[FA].burnup))
-
-        # FA span with the maximun burnup
-        self.Wmax_history = TFAspanHistory()
-        # FA span with the maximun burnup for the last 2 hours
-        self.Wmax2_history = TFAspanHistory()
-        # Max burnup among every FA spans
-        self.Wenvelope_history = TEnvelopeFAspanHistory()
-        # Envelope axial energy generation distribution
-        # Dictionary of MCU_FA_spans elements
-        self.Wenvelope_axial = dict()
-
-        # Prev 2 hours
-        last_history_time = self.HistoryReader.raw_data[-1][self.TimeIndex]
-        last2hours = last_history_time - 2
-        # Calculate the burn-up for every FA span
-        prev_history_time = self.HistoryReader.raw_data[0][self.TimeIndex]
-        pwr0 = self.HistoryReader.raw_data[0][self.PowerIndex]   # must be zero!
-        self.Wenvelope_history.add_point(prev_history_time, pwr0, "", -1)
-        for rec in self.HistoryReader.raw_data[1::]:
-            time = rec[self.TimeIndex]
-            pwr = rec[self.PowerIndex]
-            alg_name = rec[self.AlgIndex]
-            alg_FAs = int(rec[self.FAsIndex])
-            dt = time - prev_history_time
-            burnup = pwr * dt              # W*hr
-            prev_history_time = time
-            max_burnup = 0.0
-            max_cell = ""
-            max_span = -1
-            max_K = 0.0
-            for FA in self.FAs:
-                for FAspan in self.FAs[FA].burnup:
-                    K = self.algorithms[(alg_name, alg_FAs)
-                                        ].FAs[FA].fissions[FAspan]
-                    # Accumulate the total burnup
-                    span_burnup = burnup * K
-                    self.FAs[FA].burnup[FAspan] += span_burnup
-                    # Find the maximum for envelope
-                    if span_burnup > max_burnup:
-                        max_burnup = span_burnup
-                        max_cell = FA
-                        max_span = FAspan
-                        max_K = K
-                    self.FAs[FA].FA_burnup += span_burnup   # W*hr
-            self.Wenvelope_history.add_point(
-                              time, pwr*max_K, max_cell, max_span)
-
-            for FA in self.FAs2:
-                for FAspan in self.FAs2[FA].burnup:
-                    K = self.algorithms[(alg_name, alg_FAs)
-                                        ].FAs[FA].fissions[FAspan]
-                    # Accumulate the burnup for last 2 hours
-                    if time > last2hours:
-                        self.FAs2[FA].burnup[FAspan] += burnup * K
-                        self.FAs2[FA].FA_burnup += burnup * K      # W*hr
-
-        # Now let's find the FA span with the maximum total burnup
-        max_cell = ""
-        max_span = -1
-        max_burnup = 0.0
-        for FA in self.FAs:
-            for FAspan in self.FAs[FA].burnup:
-                if self.FAs[FA].burnup[FAspan] > max_burnup:
-                    max_burnup = self.FAs[FA].burnup[FAspan]      # W*hr
-                    max_cell = FA
-                    max_span = FAspan
+        m_print.m_print(history.fields)
+        m_print.m_print(f"Total {history.records} data records")
+
+    # Derived products depending on the history
+    history_products = ("burnups", "burnups2", "FAs", "FAs2",
+                        "Wmax_span", "Wmax2_span", "Wmax_FA", "Wmax_FA2",
+                        "Wmax_history", "Wmax2_history", "Wenvelope_history",
+                        "source_basis")
+
+    def append_history(self, records, save = True):
+        """ Takes new (t, N, algorithm, FAs) records following the known
+            history. The energy accumulators are updated without
+            the history re-reading, derived products are recomputed
+            on the next access, the histories are only extended.
+            Records are appended to the history file if save is True
+        """
+        records = [(t, N, alg, int(FAs)) for t, N, alg, FAs in records]
+        if len(records) == 0:
+            return
+        prev_time = self.last_time
+        for t, N, alg, FAs in records:
+            if (alg, FAs) not in self.fission_tensor.codes:
+                raise CoreHistoryInvalid(f"unknown algorithm {alg} {FAs:d}")
+            if t < prev_time:
+                raise CoreHistoryInvalid(f"record at {t} is before {prev_time}")
+            prev_time = t
+        self._add_records(records)
+        for name in type(self).history_products:
+            self.__dict__.pop(name, None)
+        if save:
+            for rec in records:
+                self.append_history_rec(*rec)
+
+    def _add_records(self, records):
+        # Adds (t, N, algorithm, FAs) records to the trace
+        # and the energy accumulators
+        hrs, pwrs, alg_names, alg_FAs = zip(*records)
+        alg_keys = list(zip(alg_names, alg_FAs))
+        self.history_trace.add_points(hrs, pwrs, alg_keys)
+        times = np.array(hrs, dtype = float)
+        pwrs = np.array(pwrs, dtype = float)
+        codes = self.fission_tensor.codes_of(alg_keys)
+        first = 0
+        if self.last_time is None:
+            # Check fist record power, must be zero
+            if pwrs[0] > 1e-15:
+                raise CoreHistoryInvalid("first record must have zero power")
+            self.last_time = times[0].item()
+            first = 1
+        burnups = pwrs * np.diff(times, prepend = self.last_time)   # W*hr
+        self.last_time = times[-1].item()
+        self.energy_prefix.add_points(times[first:], burnups[first:],
+                                      codes[first:])
+
+    # Burn-up for every FA span, array[cell, span], W*hr
+    @functools.cached_property
+    def burnups(self):
+        return self.WindowBurnups()
+
+    # Burn-up for every FA span for the last Wmax2_hours
+    @functools.cached_property
+    def burnups2(self):
+        return self.WindowBurnups(self.last_time - type(self).Wmax2_hours)
+
+    def _FAs_of(self, burnups):
+        # dict {cell:TFA} of array[cell, span] burnups,
+        # spans are those of the reference algorithm
+        FAs = dict()
+        ref_FAs = self.algorithms[self.ref_alg_key].FAs
+        for cell, cell_burnups, FA_burnup in zip(
+                self.fission_tensor.cells, burnups.tolist(),
+                burnups.sum(axis = 1).tolist()):
+            FAs[cell] = TFA()
+            for FAspan in ref_FAs[cell].fissions:
+                FAs[cell].burnup[FAspan] = cell_burnups[FAspan]   # W*hr
+            FAs[cell].FA_burnup = FA_burnup                       # W*hr
+        return FAs
+
+    # Fuel assemblies with total burn-up
+    @functools.cached_property
+    def FAs(self):
+        return self._FAs_of(self.burnups)
+
+    # Fuel assemblies with burn-up for the last Wmax2_hours
+    @functools.cached_property
+    def FAs2(self):
+        return self._FAs_of(self.burnups2)
+
+    # (cell, span, burnup) of the FA span with the maximum total burnup
+    @functools.cached_property
+    def Wmax_span(self):
+        Wmax_span = self.fission_tensor.max_span_of(self.burnups)
         m_print.m_print("Overall maximum burnup was found for:")
-        m_print.m_print(f"cell {max_cell} span {max_span} burnup {max_burnup} W*hr")
-
-        # And FA span burnup envelope
-        self.Wenvelope_axial = {k:0.0 for k in range(MCU_FA_spans)}
-        for FA in self.FAs:
-            for alg in self.algorithms:
-                for FAspan in range(MCU_FA_spans):
-                    # alg is (alg_name, NFAs) tuple - key to self.algorithms dictionary
-                    span_fissions = self.algorithms[alg].FAs[FA].fissions[FAspan
-                                                 ] * MCU_FA_spans * alg[1]
-                    if span_fissions > self.Wenvelope_axial[FAspan]:
-                        self.Wenvelope_axial[FAspan] = span_fissions
-
+        m_print.m_print("cell {} span {} burnup {} W*hr".format(*Wmax_span))
+        return Wmax_span
+
+    # The same for the last Wmax2_hours
+    @functools.cached_property
+    def Wmax2_span(self):
+        Wmax2_span = self.fission_tensor.max_span_of(self.burnups2)
+        m_print.m_print(f"Maximum burnup for last {type(self).Wmax2_hours:g} hours was found for:")
+        m_print.m_print("cell {} span {} burnup {} W*hr".format(*Wmax2_span))
+        return Wmax2_span
+
+    # (cell, burnup) of FA with max burnup
+    @functools.cached_property
+    def Wmax_FA(self):
+        Wmax_FA = self.fission_tensor.max_cell_of(self.burnups.sum(axis = 1))
+        m_print.m_print(f"FA with max burnup is {Wmax_FA[0]}: {Wmax_FA[1]} W*hrs")
+        return Wmax_FA
+
+    # The same for the last Wmax2_hours
+    @functools.cached_property
+    def Wmax_FA2(self):
+        Wmax_FA2 = self.fission_tensor.max_cell_of(self.burnups2.sum(axis = 1))
+        m_print.m_print(f"FA with max burnup for last {type(self).Wmax2_hours:g} hours is {Wmax_FA2[0]}: {Wmax_FA2[1]} W*hrs")
+        return Wmax_FA2
+
+    def _kept_span_history(self, name, cell, FAspan):
+        # The history kept is extended if it is of the same span
+        kept = self._kept_histories.get(name)
+        history = kept[1] if kept is not None and kept[0] == (cell, FAspan) else None
+        history = self.SpanHistory(cell, FAspan, history)
+        self._kept_histories[name] = ((cell, FAspan), history)
+        return history
+
+    # FA span with the maximun burnup
+    @functools.cached_property
+    def Wmax_history(self):
+        return self._kept_span_history("Wmax", *self.Wmax_span[:2])
+
+    # FA span with the maximun burnup for the last Wmax2_hours
+    @functools.cached_property
+    def Wmax2_history(self):
+        return self._kept_span_history("Wmax2", *self.Wmax2_span[:2])
+
+    # Max burnup among every FA spans
+    @functools.cached_property
+    def Wenvelope_history(self):
+        kept = self._kept_histories.get("Wenvelope")
+        history = self.EnvelopeHistory(None if kept is None else kept[1])
+        self._kept_histories["Wenvelope"] = (None, history)
+        return history
+
+    # Envelope axial energy generation distribution
+    # Dictionary of MCU_FA_spans elements
+    @functools.cached_property
+    def Wenvelope_axial(self):
+        tensor = self.fission_tensor
+        axial = (tensor.fissions * MCU_FA_spans *
+                 tensor.NFAs[:, None, None]).max(axis = (0, 1))
+        Wenvelope_axial = {FAspan:max(span_fissions, 0.0)
+                           for FAspan, span_fissions in
+                           enumerate(axial.tolist())}
         m_print.m_print("Axial relative burnup envelope:")
-        m_print.m_print(self.Wenvelope_axial)
-
-        # And the FA span with the maximum burnup for the last 2 hours
-        max_cell_2 = ""
-        max_span_2 = -1
-        max_burnup_2 = 0.0
-        for FA in self.FAs2:
-            for FAspan in self.FAs2[FA].burnup:
-                if self.FAs2[FA].burnup[FAspan] > max_burnup_2:
-                    max_burnup_2 = self.FAs2[FA].burnup[FAspan]
-                    max_cell_2 = FA
-                    max_span_2 = FAspan
-        m_print.m_print("Maximum burnup for last 2 hours was found for:")
-        m_print.m_print(f"cell {max_cell_2} span {max_span_2} burnup {max_burnup_2} W*hr")
-
-        # Now prepare the history for those two variants
-        for rec in self.HistoryReader.raw_data:
-            time = rec[self.TimeIndex]
-            pwr = rec[self.PowerIndex]
-            alg_name = rec[self.AlgIndex]
-            alg_FAs = int(rec[self.FAsIndex])
-            K = self.algorithms[(alg_name, alg_FAs)
-                                ].FAs[max_cell].fissions[max_span]
-            K2 = self.algorithms[(alg_name, alg_FAs)
-                                 ].FAs[max_cell_2].fissions[max_span_2]
-            self.Wmax_history.add_point(time, pwr*K)
-            self.Wmax2_history.add_point(time, pwr*K2)
-
-        # FA with max burnup
-        max_cell = ""
-        max_burnup = 0.0
-        for FA in self.FAs:
-            if self.FAs[FA].FA_burnup > max_burnup:
-                max_burnup = self.FAs[FA].FA_burnup
-                max_cell = FA
-        self.Wmax_FA = (max_cell, max_burnup)
-        m_print.m_print(f"FA with max burnup is {max_cell}: {max_burnup} W*hrs")
-
-        # FA with max burnup for last 2 hours
-        max_cell = ""
-        max_burnup = 0.0
-        for FA in self.FAs2:
-            if self.FAs2[FA].FA_burnup > max_burnup:
-                max_burnup = self.FAs2[FA].FA_burnup
-                max_cell = FA
-        self.Wmax_FA2 = (max_cell, max_burnup)
-        m_print.m_print(f"FA with max burnup for last 2 hours is {max_cell}: {max_burnup} W*hrs")
-
-    def ParseOrigenOut(self, Origen_fn, container):
-        def ParseOrigenLine(line):
-            clear_line = line.strip(string.whitespace)
-            separators = re.compile(
-                r"""\s-\s|\s+""")
-            val_str = separators.split(clear_line)
-            try:
-                vals = [float(v) for v in val_str]
-            except ValueError:
-                vals = None
-            return vals
-
-        def StoreOrigenEnergyBand(values):
-            Emin = 1e6 * min(values[0:2])  # eV
-            Emax = 1e6 * max(values[0:2])  # eV
-            container[(Emin, Emax)] = values[2:]
-
-
-        spectrum_line = "Gamma source intensity (1/s) as a function of time for case 'decay'"
-        hdr_line = "boundaries (MeV)"
-        Lines2Find = 3
-        srcRecords = 0
-        fn = os.path.join(os.curdir, OrigenDIRName, Origen_fn)
-        with open(file = fn, mode='r', encoding='cp1251') as OrigenfileObject:
-            OrigenLineNo = 0
-            for OrigenLine in OrigenfileObject:
-                OrigenLineNo += 1
-                if OrigenLine.find(spectrum_line) != -1:
-                    Lines2Find -= 1
-                    continue
-                if (Lines2Find == 2 and
-                    all(x=='-' for x in OrigenLine.strip(string.whitespace))):
-                    Lines2Find -= 1
-                    continue
-                if (Lines2Find == 1 and
-                    OrigenLine.find(hdr_line) != -1):
-                    Lines2Find -= 1
-                    continue
-                if Lines2Find == 0:
-                    # Read Origen spectrum part
-                    # m_print.m_print(f"Reading sources, line no = {OrigenLineNo}")
-                    values = ParseOrigenLine(OrigenLine)
-                    if values is None:
-                        # Finished reading sources
-                        break
-                    else:
-                        # m_print.m_print(values)
-                        StoreOrigenEnergyBand(values)
-                        srcRecords += 1
-
-        m_print.m_print(f"{srcRecords} Origen sources were read")
-
-    def InvokeOrigen(self, max_reg_hours):
+        m_print.m_print(Wenvelope_axial)
+        return Wenvelope_axial
+
+    def EnvelopeHistory(self, history = None):
+        """ Max burnup among every FA spans at every history step.
+            If history is given only the records it lacks are added to it
+        """
+        tensor = self.fission_tensor
+        if history is None:
+            history = TEnvelopeFAspanHistory()
+        first = len(history.history)
+        times, pwrs, codes = self.TraceArrays(max(first - 1, 0))
+        if first == 0:
+            history.add_point(times[0].item(), pwrs[0].item(), "", -1)
+        burnups = pwrs[1:] * np.diff(times)       # W*hr
+        hrs = times[1:].tolist()
+        pwrs = pwrs[1:]
+        codes = codes[1:]
+        # The span with max burnup of the step is the span
+        # with the max fission fraction of the step algorithm
+        max_K = tensor.max_K[codes]
+        found = (burnups * max_K > 0.0).tolist()
+        env_pwrs = (pwrs * np.where(found, max_K, 0.0)).tolist()
+        for n, code in enumerate(codes.tolist()):
+            if found[n]:
+                history.add_point(hrs[n], env_pwrs[n],
+                                  tensor.max_cells[code], tensor.max_spans[code])
+            else:
+                history.add_point(hrs[n], env_pwrs[n], "", -1)
+        return history
+
+    def SpanHistory(self, cell, FAspan, history = None):
+        """ Power history of the cell FAspan. If history of the same
+            span is given only the records it lacks are added to it
+        """
+        if history is None:
+            history = TFAspanHistory()
+        times, pwrs, codes = self.TraceArrays(len(history.history))
+        K = self.fission_tensor.fissions[
+                codes, self.fission_tensor.cell_idx[cell], FAspan]
+        history.add_points(times.tolist(), (pwrs*K).tolist())
+        return history
+
+    def TraceArrays(self, first = 0):
+        # History trace records from the first one
+        # as (times, powers, fission_tensor codes) arrays
+        trace = self.history_trace
+        codes = self.fission_tensor.codes_of(trace.alg_keys)
+        return (np.frombuffer(trace.times, dtype = float)[first:],
+                np.frombuffer(trace.powers, dtype = float)[first:],
+                codes[np.frombuffer(trace.alg_nos, dtype = np.int32)[first:]])
+
+    def WindowBurnups(self, t1 = None, t2 = None):
+        """ Burn-up of every FA span, array[cell, span], W*hr,
+            generated by the history steps ending in (t1, t2] hours.
+            None is the history start or end
+        """
+        return np.tensordot(self.energy_prefix.window(t1, t2),
+                            self.fission_tensor.fissions, 1)
+
+    def MaxBurnupSpan(self, t1 = None, t2 = None):
+        # (cell, span, burnup) of the FA span with
+        # the max burnup in (t1, t2] hours
+        return self.fission_tensor.max_span_of(self.WindowBurnups(t1, t2))
+
+    def MaxBurnupFA(self, t1 = None, t2 = None):
+        # (cell, burnup) of the FA with the max burnup in (t1, t2] hours
+        return self.fission_tensor.max_cell_of(
+                    self.WindowBurnups(t1, t2).sum(axis = 1))
+
+    def MaxSlidingWindow(self, hours):
+        """ The window of the given width with the max FA span burnup
+            over the whole history: (t1, t2, cell, span, burnup).
+            Windows ending at every record time are enough to be checked
+            since the steps are taken as a whole by their end time
+        """
+        tensor = self.fission_tensor
+        t2s = np.frombuffer(self.history_trace.times, dtype = float)[1:]
+        result = (None, None, "", -1, 0.0)
+        K = tensor.fissions.reshape(len(tensor.alg_keys), -1)
+        for first in range(0, len(t2s), SLIDING_CHUNK):
+            ends = t2s[first:first + SLIDING_CHUNK]
+            burnups = self.energy_prefix.windows(ends - hours, ends) @ K
+            idx = np.unravel_index(burnups.argmax(), burnups.shape)
+            if burnups[idx] > result[4]:
+                t2 = ends[idx[0]].item()
+                cell, span = divmod(int(idx[1]), K.shape[1] // len(tensor.cells))
+                result = (t2 - hours, t2, tensor.cells[cell], span,
+                          burnups[idx].item())
+        return result
+
+    def MaxBurnupHistory(self, t1 = None, t2 = None):
+        """ (cell, span, burnup, history) of the FA span with the max
+            burnup in (t1, t2] hours, history is its whole power history
+            to be fed to ORIGEN the way Wmax2_history is
+        """
+        cell, span, burnup = self.MaxBurnupSpan(t1, t2)
+        return cell, span, burnup, self.SpanHistory(cell, span)
+
+    def ParseOrigenOut(self, Origen_fn, container = None, origen_dir = None,
+                       write_sidecar = False):
+        """ 'decay' case gamma source intensity of ORIGEN output
+            as OrigenReader.TOrigenTable, values are array[band, time].
+            If ORIGEN_USE_F71 it is read from the binary .f71 next to the
+            .out when FreshF71 finds it written by the same run.
+            container, if given, gets it as a dict {(Emin, Emax):values}.
+            write_sidecar saves the parsed .out next to it, it is set
+            for the job outputs only, the shared Origens is not written
+        """
+        return self.ParseOrigenCases(Origen_fn, [container], origen_dir,
+                                     write_sidecar)[0]
+
+    def ParseOrigenCases(self, Origen_fn, containers, origen_dir = None,
+                         write_sidecar = False):
+        """ ParseOrigenOut of a MakeOrigenCasesFile deck output:
+            the list of the histories 'decay' cases tables, containers
+            are their dicts (or None) in the histories order
+        """
+        origen_dir = OrigenDIR() if origen_dir is None else origen_dir
+        fn = os.path.join(origen_dir, Origen_fn)
+        f71_fn = FreshF71(fn) if ORIGEN_USE_F71 else None
+        n_histories = len(containers)
+        if f71_fn is not None:
+            with OrigenReader.TF71Reader(f71_fn) as reader:
+                tables = [reader.gamma_table(no * OrigenTemplateCases +
+                                             OrigenDecayCase)
+                          for no in range(n_histories)]
+        else:
+            tables = [OrigenReader.ReadOrigenTable(fn,
+                            OrigenReader.IntensityTable,
+                            OrigenCaseName("decay", no, n_histories),
+                            write_sidecar = write_sidecar)
+                      for no in range(n_histories)]
+        for table, container in zip(tables, containers):
+            if container is not None:
+                container.update(table.as_dict())
+            m_print.m_print(f"{len(table.values)} Origen sources were read")
+        return tables
+
+    @staticmethod
+    def RegTimes(max_reg_hours):
+        # ORIGEN registration times up to max_reg_hours, result is
+        # (tregs, the ORIGEN input line of them)
         N_pts = 10
         precision = 1
         tmax_log = math.log(max_reg_hours)
-        self.tregs = [round(math.exp(n / N_pts * tmax_log), precision)
+        tregs = [round(math.exp(n / N_pts * tmax_log), precision)
                                            for n in range(1, N_pts+1)]
-        self.tregs = [0.0] + self.tregs
-        str_treg = "t = [" + " ".join(f"{v:.1f}" for v in self.tregs[1:]) + " ]"
-        # Create the containers for Origen spectrums
-        self.Wmax_src_spectrums = dict()
-        self.Wmax2_src_spectrums = dict()
-        self.Wenvelope_src_spectrums = dict()
-        containers = [self.Wmax_src_spectrums,
-                      self.Wmax2_src_spectrums,
-                      self.Wenvelope_src_spectrums]
+        tregs = [0.0] + tregs
+        str_treg = "t = [" + " ".join(f"{v:.1f}" for v in tregs[1:]) + " ]"
+        return tregs, str_treg
+
+    def RunOrigenHistories(self, name, fns, params, str_treg,
+                           containers, run_origen = True):
+        """ ORIGEN 'decay' sources of the histories given by their
+            build_origen_params computed in the job name: a deck per
+            history named by fns or, if ORIGEN_MULTI_CASE, one deck name.
+            containers are filled as by ParseOrigenCases.
+            Result is the list of OrigenReader.TOrigenTable
+        """
+        with OrigenJob(name) as job:
+            if ORIGEN_MULTI_CASE:
+                key = MakeOrigenCasesFile(name + ".inp", params, str_treg,
+                                          job.dir)
+                RunOrigenDecks({name:key}, job.dir, run_origen)
+                tables = self.ParseOrigenCases(name + ".out", containers,
+                                               job.dir, write_sidecar = True)
+                job.publish([name])
+            else:
+                decks = dict()
+                for fn, (str_t, str_power) in zip(fns, params):
+                    decks[fn] = MakeOrigenFile(fn + ".inp", str_t, str_power,
+                                               str_treg, job.dir)
+                RunOrigenDecks(decks, job.dir, run_origen)
+                tables = [self.ParseOrigenOut(fn + ".out", container, job.dir,
+                                              write_sidecar = True)
+                          for fn, container in zip(fns, containers)]
+                job.publish(fns)
+        return tables
+
+    def CoreOrigenParams(self):
+        # build_origen_params of the Wmax, Wmax2 and Wenvelope histories
+        return [history.build_origen_params() for history in
+                (self.Wmax_history, self.Wmax2_history, self.Wenvelope_history)]
+
+    def OrigenSources(self, max_reg_hours, params = None, run_origen = True):
+        """ ORIGEN spectra of the Wmax, Wmax2 and Wenvelope histories,
+            params are their CoreOrigenParams (taken from self if None).
+            self is not changed, result is (tregs, [3 spectra dicts])
+        """
+        params = self.CoreOrigenParams() if params is None else params
+        tregs, str_treg = self.RegTimes(max_reg_hours)
+        containers = [dict(), dict(), dict()]
         # Calls ORIGEN 3 times
-        methods = [self.Wmax_history.build_origen_params,
-                   self.Wmax2_history.build_origen_params,
-                   self.Wenvelope_history.build_origen_params]
-        for fn, method, container in zip(
-                    type(self).Origen_fns, methods, containers):
-            str_t, str_power = method()
-            MakeOrigenFile(fn + ".inp", str_t, str_power, str_treg)
-            RunOrigen(fn + ".inp")
-            self.ParseOrigenOut(fn + ".out", container)
-
-    def FACellDoseRate(self, cell, max_reg_hours):
-        N_pts = 10
-        precision = 1
-        tmax_log = math.log(max_reg_hours)
-        self.tregs = [round(math.exp(n / N_pts * tmax_log), precision)
-                                           for n in range(1, N_pts+1)]
-        self.tregs = [0.0] + self.tregs
-        str_treg = "t = [" + " ".join(f"{v:.1f}" for v in self.tregs[1:]) + " ]"
-
+        self.RunOrigenHistories(OrigenCoreDeck, type(self).Origen_fns,
+                                params, str_treg, containers, run_origen)
+        return tregs, containers
+
+    def InvokeOrigen(self, max_reg_hours, run_origen = True):
+        self.tregs, (self.Wmax_src_spectrums, self.Wmax2_src_spectrums,
+                     self.Wenvelope_src_spectrums) = self.OrigenSources(
+                                max_reg_hours, run_origen = run_origen)
+
+    def InvokeWindowOrigen(self, hours, max_reg_hours, run_origen = True):
+        """ Same as the Wmax2 case of InvokeOrigen for the last given
+            hours instead of Wmax2_hours: ORIGEN spectrum of the FA span
+            with the max burnup for that time
+        """
+        self.tregs, str_treg = self.RegTimes(max_reg_hours)
+        cell, span, burnup, history = self.MaxBurnupHistory(
+                                            self.last_time - hours)
+        m_print.m_print(f"Maximum burnup for last {hours:g} hours was found for:")
+        m_print.m_print(f"cell {cell} span {span} burnup {burnup} W*hr")
+        fn = f"max_{hours:g}_hours"
+        src_spectrums = dict()
+        self.RunOrigenHistories(fn, [fn], [history.build_origen_params()],
+                                str_treg, [src_spectrums], run_origen)
+        return src_spectrums
+
+    def CellOrigenParams(self, cell):
+        # build_origen_params of the cell spans histories
         cell_history = dict()
         for FA_span in range(MCU_FA_spans):
-            cell_history[FA_span] = TFAspanHistory()
-        # Prepare the history for the given cell
-        for rec in self.HistoryReader.raw_data:
-            time = rec[self.TimeIndex]
-            pwr = rec[self.PowerIndex]
-            alg_name = rec[self.AlgIndex]
-            alg_FAs = int(rec[self.FAsIndex])
-            for FA_span in range(MCU_FA_spans):
-                K = self.algorithms[(alg_name, alg_FAs)
-                                    ].FAs[cell].fissions[FA_span]
-                cell_history[FA_span].add_point(time, pwr*K)
+            cell_history[FA_span] = self.SpanHistory(cell, FA_span)
 ##        m_print.m_print(f"Cell {cell} history:")
 ##        for FA_span in range(MCU_FA_spans):
 ##            m_print.m_print(f"Span {FA_span}")
 ##            m_print.m_print(cell_history[FA_span].history)
-
+        return [cell_history[FA_span].build_origen_params()
+                for FA_span in range(MCU_FA_spans)]
+
+    def CellDoseRates(self, cell, max_reg_hours, zones=range(130,150),
+                      run_origen = True, params = None):
+        """ FACellDoseRate without changing self: params are the
+            CellOrigenParams of the cell (taken from self if None),
+            result is (tregs, {zone:doze rates list})
+        """
+        if ORIGEN_SUPERPOSITION:
+            # Spans sources are weighted sums of the source basis
+            basis = self.SourceBasis(max_reg_hours, run_origen)
+            return basis.tregs, {zone:series.tolist() for zone, series in
+                        zip(zones, self.CoreDoseRates(max_reg_hours, zones,
+                                                      [cell], run_origen)[cell])}
+
+        params = self.CellOrigenParams(cell) if params is None else params
+        tregs, str_treg = self.RegTimes(max_reg_hours)
+        fns = [f"{cell}_{FA_span:d}" for FA_span in range(MCU_FA_spans)]
         cell_src_spectrums = dict()
         for FA_span in range(MCU_FA_spans):
-            fn = f"{cell}_{FA_span:d}"
-            str_t, str_power = cell_history[FA_span].build_origen_params()
-            MakeOrigenFile(fn + ".inp", str_t, str_power, str_treg)
-            RunOrigen(fn + ".inp")
             cell_src_spectrums[FA_span] = dict()
-            self.ParseOrigenOut(fn + ".out", cell_src_spectrums[FA_span])
-
-        # Registered gamma energies
-        Zones0 = list(self.Greens[1].values())[0]
-        ERegs = list(list(Zones0.values())[0].keys())
-
-        # Iterate over registration zone
-        dose_arrays = dict()
-        reg_fluxes = dict()
-        for zone in range(130,150):
-            reg_fluxes[zone] = {k:[0.0]*len(self.tregs) for k in ERegs}
-
-            # Iterate over source span
-            for src in range(1, 1+MCU_FA_spans):
-                if src <= MCU_FA_spans // 2:
-                    IncGamma = self.Greens[src]
-                    reg_zone = zone
-                else:
-                    IncGamma = self.Greens[1+MCU_FA_spans - src]
-                    ZoneRemoteness = zone // 10
-                    ZoneHeight = zone % 10
-                    reg_zone = 10 * ZoneRemoteness + (MCU_FA_spans - ZoneHeight - 1)
-                # Iterate over incident energy
-                for Esrc in IncGamma:
-                    # Check whether the incident energy is in ORIGEN range
-                    for OrigenKey in cell_src_spectrums[0]:
-                        # OrigenKey is (Emin, Emax) like (1.191E+01, 8.090E+00)
-                        if OrigenKey[0] <= Esrc <= OrigenKey[1]:
-                            RegZone = IncGamma[Esrc][reg_zone]
-                            # Iterate over dissipated flux
-                            for flux in RegZone:
-                                # Accumulate gamma-flux in reg_fluxes
-                                # Iterate over registration time
-                                for n_pt, origen_out in enumerate(
-                                    cell_src_spectrums[src-1][OrigenKey]):
-                                    reg_fluxes[zone][flux][n_pt
-                                          ] += RegZone[flux] * origen_out
-                            break
-
-            # Now sum with the NRB weights to get the doze rate
-            dozeRates = [0.0] * len(self.tregs)
-            for E_NRB in type(self).NRB:
-                for Elow, EHigh in zip(ERegs[:-1], ERegs[1:]):
-                    if Elow <= E_NRB <= EHigh:
-                        # Iterate over reg time
-                        for n in range(len(dozeRates)):
-                            dozeRates[n] += reg_fluxes[zone][EHigh][n
-                                                ] * type(self).NRB[E_NRB] * 1e-12
-            dose_arrays[zone] = dozeRates
-        return dose_arrays
+        # All the spans in one deck named cell if ORIGEN_MULTI_CASE
+        self.RunOrigenHistories(cell, fns, params, str_treg,
+                [cell_src_spectrums[FA_span] for FA_span in range(MCU_FA_spans)],
+                run_origen)
+
+        dozeRates = self.FACellDoseRates(cell_src_spectrums, zones)
+        return tregs, {zone:series.tolist() for zone, series in zip(zones, dozeRates)}
+
+    def FACellDoseRate(self, cell, max_reg_hours, zones=range(130,150),
+                       run_origen = True):
+        # CellDoseRates with the registration times kept in self.tregs
+        self.tregs, dozeRates = self.CellDoseRates(cell, max_reg_hours, zones,
+                                                   run_origen)
+        return dozeRates
 
+    def BasisHistory(self, code):
+        """ Power history of the basis algorithm code: the core power
+            times the algorithm max fission fraction while the algorithm
+            is on, zero otherwise. Every span history is the sum of
+            these ones weighted by TSourceBasis.weights
+        """
+        history = TFAspanHistory()
+        times, pwrs, codes = self.TraceArrays()
+        K = np.where(codes == code, self.fission_tensor.max_K[code], 0.0)
+        history.add_points(times.tolist(), (pwrs*K).tolist())
+        return history
+
+    def InvokeBasisOrigen(self, max_reg_hours, run_origen = True):
+        """ Builds self.source_basis: ORIGEN is run once for every
+            algorithm with some burnup in the history instead of once
+            for every FA span. If SUPERPOSITION_CHECK the basis is
+            checked against direct runs, see CheckSourceBasis
+        """
+        tregs, str_treg = self.RegTimes(max_reg_hours)
+        tensor = self.fission_tensor
+        energies = self.energy_prefix.window()
+        codes = [code for code in range(len(tensor.alg_keys))
+                 if energies[code] > 0.0 and tensor.max_K[code] > 0.0]
+        if len(codes) == 0:
+            raise CoreHistoryInvalid("no burnup for the source basis")
+        fns = [f"basis_{code:d}" for code in codes]
+        tables = self.RunOrigenHistories(
+                    "basis", fns, [self.BasisHistory(code).build_origen_params()
+                                   for code in codes],
+                    str_treg, [None] * len(codes), run_origen)
+        self.source_basis = TSourceBasis(codes, tensor.max_K[codes], tables,
+                                         max_reg_hours, tregs)
+        m_print.m_print(f"Source basis of {len(codes)} algorithms is built")
+        if SUPERPOSITION_CHECK:
+            self.CheckSourceBasis(run_origen = run_origen)
+        return self.source_basis
+
+    def SourceBasis(self, max_reg_hours, run_origen = True):
+        # self.source_basis if it is built for the same registration
+        # times, otherwise it is built anew
+        basis = getattr(self, "source_basis", None)
+        if basis is None or basis.tregs != self.RegTimes(max_reg_hours)[0]:
+            basis = self.InvokeBasisOrigen(max_reg_hours, run_origen)
+        return basis
+
+    def CheckSourceBasis(self, spans = None, run_origen = True):
+        """ Error estimate of self.source_basis: the FA spans, list of
+            (cell, span), by default the max burnup ones over the whole
+            history and over the last Wmax2_hours, are run directly
+            and compared to their weighted sums of the basis.
+            spectrum_error is the max over times of the relative L1
+            spectrum difference, total_error is that of the total
+            intensity, times with zero direct total are skipped
+            (see MaxRelativeError). Results are added to the basis errors
+        """
+        basis = self.source_basis
+        tensor = self.fission_tensor
+        if spans is None:
+            spans = list()
+            for cell, span, burnup in (self.Wmax_span, self.Wmax2_span):
+                if span >= 0 and (cell, span) not in spans:
+                    spans.append((cell, span))
+        str_treg = self.RegTimes(basis.max_reg_hours)[1]
+        fns = [f"check_{cell}_{span:d}" for cell, span in spans]
+        tables = self.RunOrigenHistories(
+                    "basis_check", fns,
+                    [self.SpanHistory(cell, span).build_origen_params()
+                     for cell, span in spans],
+                    str_treg, [None] * len(spans), run_origen)
+        for (cell, span), table in zip(spans, tables):
+            direct = table.values
+            superposed = basis.sources(
+                            tensor.fissions[:, tensor.cell_idx[cell], span])
+            direct_total = direct.sum(axis = 0)
+            error = {"cell":cell, "span":span,
+                     "spectrum_error":MaxRelativeError(
+                            np.abs(superposed - direct).sum(axis = 0),
+                            direct_total),
+                     "total_error":MaxRelativeError(
+                            np.abs(superposed.sum(axis = 0) - direct_total),
+                            direct_total)}
+            basis.errors.append(error)
+            m_print.m_print("Source basis error for cell {cell} span {span}: "
+                            "spectrum {spectrum_error:.3e}, "
+                            "total {total_error:.3e}".format(**error))
+        return basis.errors
+
+    def CoreDoseRates(self, max_reg_hours, zones = range(130,150),
+                      cells = None, run_origen = True):
+        """ FACellDoseRates of every cell of the core (or of cells)
+            with the spans sources taken from the source basis.
+            Result is a dict {cell:array[zone, time]}, Sv/sec
+        """
+        basis = self.SourceBasis(max_reg_hours, run_origen)
+        tensor = self.fission_tensor
+        cells = tensor.cells if cells is None else list(cells)
+        n_spans = MCU_FA_spans
+        # Dose per unit source: [span, zone, Esrc]
+        span_dose = self.DoseResponse().apply(
+                        self.Greens.span_block(zones, n_spans))
+        # Dose of every basis source put into every span: [basis, span, zone, time]
+        basis_dose = np.einsum("szi,ait->aszt", span_dose,
+                               self.BandMap(basis.bands).gather(basis.spectra))
+        # Basis weights: [basis, cell, span]
+        weights = basis.weights(
+                    tensor.fissions[:, [tensor.cell_idx[cell] for cell in cells]])
+        return dict(zip(cells, np.einsum("acs,aszt->czt", weights, basis_dose)))
+
+    def FACellDoseRates(self, span_sources, zones):
+        # span_sources is a dict {span:ORIGEN spectrum}, span is 0..9
+        # zones is a sequence of Green registration zones e.g. 130..149
+        # Result is array[zone, time] of doze rates in the reg zones, Sv/sec
+        n_spans = len(span_sources)
+        bands = list(span_sources[0])
+        # Span spectra as array[span, band, time]
+        spectra = np.array([[span_sources[span][band] for band in bands]
+                            for span in range(n_spans)])
+        # Dose per unit source: [span, zone, Esrc]
+        span_dose = self.DoseResponse().apply(
+                        self.Greens.span_block(zones, n_spans))
+        # Spans sources: [span, Esrc, time]
+        span_src = self.BandMap(bands).gather(spectra)
+        return np.einsum("szi,sit->zt", span_dose, span_src)
+
+
+    def DoseResponse(self):
+        # Flux-to-dose operator for the Green's registered energies,
+        # built once per energy grid and interpolation mode
+        key = (tuple(self.Greens.ERegs.tolist()), type(self).NRB_interpolation)
+        if key not in type(self).dose_responses:
+            type(self).dose_responses[key] = TDoseResponse(
+                self.Greens.ERegs, type(self).NRB,
+                type(self).NRB_interpolation)
+        return type(self).dose_responses[key]
+
+    def BandMap(self, bands):
+        # ORIGEN bands to Green's incident energies mapping,
+        # built once per bands layout
+        key = (tuple(bands), tuple(self.Greens.Esrcs.tolist()))
+        if key not in type(self).band_maps:
+            band_map = TBandMap(bands, self.Greens.Esrcs)
+            if len(band_map.unmatched) > 0:
+                if type(self).strict_bands:
+                    raise OrigenBandsMismatch(band_map.unmatched)
+                m_print.m_print("No ORIGEN band for Green's energies, eV:")
+                m_print.m_print(band_map.unmatched)
+            type(self).band_maps[key] = band_map
+        return type(self).band_maps[key]
+
+    def SourceByEsrc(self, sources):
+        # ORIGEN spectrum rearranged as array[Esrc, time],
+        # no band - no source
+        bands = list(sources)
+        spectrum = np.array([sources[band] for band in bands])
+        return self.BandMap(bands).gather(spectrum)
+
+    def FADoseRates(self, axial, zones, sources):
+        # Batched FADoseRate: all the reg zones at once.
+        # axial is a dict {span:rel_burnup}, span is 0..9
+        # zones is a sequence of Green registration zones e.g. 100..149
+        # sources may be self.Wmax_src_spectrums or self.Wmax2_src_spectrums
+        # or self.Wenvelope_src_spectrums
+        # Result is array[zone, time] of doze rates in the reg zones, Sv/sec
+        # for times after reactor trip in self.tregs
+        n_spans = len(axial)
+        K_axial = np.array([axial[span] for span in range(n_spans)])
+        # Dose per unit source: [span, zone, Esrc]
+        span_dose = self.DoseResponse().apply(
+                        self.Greens.span_block(zones, n_spans))
+        return np.einsum("s,szi,it->zt", K_axial, span_dose,
+                         self.SourceByEsrc(sources))
 
     def FADoseRate(self, axial, zone, sources):
         # axial is a dict {span:rel_burnup}, span is 0..9
@@ -835,55 +1524,7 @@ class TCoreHistory(object):
         # or self.Wenvelope_src_spectrums
         # Result is the list of doze rates in the reg zone, Sv/sec
         # for times after reactor trip in self.self.tregs
-
-
-        # Registered gamma energies
-        Zones0 = list(self.Greens[1].values())[0]
-        ERegs = list(list(Zones0.values())[0].keys())
-        # m_print.m_print(ERegs)
-        # Initial zero flux in the reg zone
-        # times are kept in self.self.tregs
-        reg_fluxes = {k:[0.0]*len(self.tregs) for k in ERegs}
-
-        # Iterate over source span
-        for src in range(1, 11):
-            if src <= 5:
-                IncGamma = self.Greens[src]
-                reg_zone = zone
-            else:
-                IncGamma = self.Greens[11 - src]
-                ZoneRemoteness = zone // 10
-                ZoneHeight = zone % 10
-                reg_zone = 10 * ZoneRemoteness + (9 - ZoneHeight)
-            K_axial = axial[src-1]
-            # Iterate over incident energy
-            for Esrc in IncGamma:
-                # Check whether the incident energy is in ORIGEN range
-                for OrigenKey in sources:
-                    if OrigenKey[0] <= Esrc <= OrigenKey[1]:
-                        RegZone = IncGamma[Esrc][reg_zone]
-                        # Iterate over dissipated flux
-                        for flux in RegZone:
-                            # Accumulate gamma-flux in reg_fluxes
-                            # Iterate over registration time
-                            for n_pt, origen_out in enumerate(sources[OrigenKey]):
-                                reg_fluxes[flux][n_pt
-                                      ] += K_axial * RegZone[flux] * origen_out
-                        break
-        #m_print.m_print("Times are:")
-        #m_print.m_print(self.self.tregs)
-        #m_print.m_print("reg_fluxes are:")
-        #m_print.m_print(reg_fluxes)
-
-        # Now sum with the NRB weights to get the doze rate
-        dozeRates = [0.0] * len(self.tregs)
-        for E_NRB in type(self).NRB:
-            for Elow, EHigh in zip(ERegs[:-1], ERegs[1:]):
-                if Elow <= E_NRB <= EHigh:
-                    # Iterate over reg time
-                    for n in range(len(dozeRates)):
-                        dozeRates[n] += reg_fluxes[EHigh][n] * type(self).NRB[E_NRB] * 1e-12
-        return dozeRates
+        return self.FADoseRates(axial, [zone], sources)[0].tolist()
 
 
 def ReadStaticData(FINsListFile):
@@ -907,15 +1548,49 @@ def ReadStaticData(FINsListFile):
     fn = os.path.join(os.curdir, ConfigDIRName, MCU_detectors_fn)
     MCU_detectors_reader = DataReader.TDataReader(fn)
 
+    # Compiled algorithms cache, valid for the same MCU_FAs.txt
+    # and MCU_detectors.txt, every FIN file has its own fingerprint
+    cache_fn = os.path.join(os.curdir, MCUDIRName + AlgorithmsCacheSuffix)
+    config_fns = [os.path.join(os.curdir, ConfigDIRName, MCU_FAs_fn),
+                  os.path.join(os.curdir, ConfigDIRName, MCU_detectors_fn)]
+    cache_meta, cache_arrays = FileCache.LoadNPZ(cache_fn)
+    if (cache_meta is None
+            or cache_meta.get("version") != AlgorithmsCacheVersion
+            or not FileCache.FingerprintsMatch(cache_meta["configs"],
+                                               config_fns)):
+        cache_meta = {"version":AlgorithmsCacheVersion,
+                      "configs":FileCache.FingerprintsOf(config_fns),
+                      "FINs":dict()}
+        cache_arrays = dict()
+    cache_updated = False
+
     for alg_param in FINsReader.raw_data:
         alg_name = alg_param[alg_index]
         HCrit = alg_param[hcrit_index]
         NFAs = int(alg_param[NFAs_index])
         FINfn = alg_param[FINName_index]
         isRefAlg = alg_param[isRef_index]
-        alg = TAlgorithm(FAs_reader, detectors_eff_reader,
-                         MCU_detectors_reader,
-                         HCrit, NFAs, FINfn, isRefAlg)
+        fin_path = os.path.join(MCUDIRName, FINfn)
+        cached = cache_meta["FINs"].get(FINfn)
+        if (cached is not None and
+                FileCache.FingerprintsMatch(cached["source"], [fin_path])):
+            arrays = {name:cache_arrays[f"{cached['prefix']}{name}"]
+                      for name in cached["arrays"]}
+            alg = TAlgorithm.from_arrays(arrays, HCrit, isRefAlg)
+        else:
+            alg = TAlgorithm(FAs_reader, detectors_eff_reader,
+                             MCU_detectors_reader,
+                             HCrit, NFAs, FINfn, isRefAlg)
+            prefix = f"alg{len(cache_meta['FINs']):d}_"
+            if cached is not None:
+                prefix = cached["prefix"]
+            arrays = alg.to_arrays()
+            cache_meta["FINs"][FINfn] = {
+                "source":FileCache.FingerprintsOf([fin_path]),
+                "prefix":prefix, "arrays":list(arrays)}
+            for name, array in arrays.items():
+                cache_arrays[prefix + name] = array
+            cache_updated = True
         alg_key = (alg_name, NFAs)
         Algorithms[alg_key] = alg
         m_print.m_print(f"{FINfn} read successfully")
@@ -923,6 +1598,12 @@ def ReadStaticData(FINsListFile):
         m_print.m_print(f"key = ({alg_name}, {NFAs})")
         m_print.m_print(f"Max {MCU_FA_spans} FA spans found")
     m_print.m_print(f"{len(Algorithms)} algorithms/FIN files were read")
+    if cache_updated:
+        try:
+            FileCache.SaveNPZ(cache_fn, cache_meta, **cache_arrays)
+            m_print.m_print(f"Algorithms cache {cache_fn} saved")
+        except OSError as ex:
+            m_print.m_print(f"Algorithms cache {cache_fn} not saved: {ex}")
 
     # Now read reference detectors effectivenesses
     fn = os.path.join(os.curdir, ConfigDIRName, detectors_eff_fn)
@@ -992,14 +1673,10 @@ if __name__ == "__main__" and EXECUTE_NOW:
                 m_print.m_print(f"Max W file {maxW2_fn} is written")
             CoreHistory.InvokeOrigen(DECAY_HOURS)
             # m_print.m_print("FA surface:")
-            dose_arrays = list()
-            for reg_zone in range(130,140):
-                m_print.m_print(f"Zone {reg_zone}:")
-                dozeRates = CoreHistory.FADoseRate(CoreHistory.Wenvelope_axial, reg_zone,
-                                                   CoreHistory.Wenvelope_src_spectrums)
-                dr_uSv_hr = {t:dr*3600*1e6 for t,dr in zip(CoreHistory.tregs, dozeRates)}
-                # m_print.m_print(dr_uSv_hr)
-                dose_arrays.append([Svs*3600*1e6 for Svs in dozeRates])
+            dozeRates = CoreHistory.FADoseRates(CoreHistory.Wenvelope_axial,
+                                                range(130,140),
+                                                CoreHistory.Wenvelope_src_spectrums)
+            dose_arrays = [(Svs*3600*1e6).tolist() for Svs in dozeRates]
             fn = os.path.join(os.curdir, ResultsDIRName, "doses_envelope.txt")
             write_data_file(fn, CoreHistory.tregs, *dose_arrays)
 
@@ -0,0 +1,82 @@
+import os, shutil, sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import FA_Gamma
+import Test_plan as TP
+from tvs_dose import api as tvs_api
+
+# Stand-in scalerte: writes the decay gamma table of every deck case
+STUB_SCALERTE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "stub_scalerte.py")
+
+
+@pytest.fixture(autouse = True)
+def repo_dir(monkeypatch):
+    # Input directories are taken relative to the current one
+    monkeypatch.chdir(ROOT)
+    return ROOT
+
+
+@pytest.fixture(scope = "session")
+def algorithms():
+    os.chdir(ROOT)
+    return TP.ReadStaticData(TP.FINsListFile)
+
+
+@pytest.fixture(scope = "session")
+def greens():
+    os.chdir(ROOT)
+    return FA_Gamma.readGreenFuncs()
+
+
+@pytest.fixture(scope = "session")
+def core(algorithms, greens):
+    # Shared core history, tests must not change it
+    os.chdir(ROOT)
+    return TP.TCoreHistory(algorithms, greens)
+
+
+@pytest.fixture
+def origen_dir(tmp_path, monkeypatch):
+    """ Empty shared ORIGEN directory with the template, ORIGEN is
+        the stand-in scalerte, the cache is on
+    """
+    dir_name = tmp_path / "Origens"
+    dir_name.mkdir()
+    shutil.copy(os.path.join(ROOT, TP.OrigenDIRName, TP.template_file_name),
+                dir_name)
+    monkeypatch.setattr(TP, "OrigenDIRName", str(dir_name))
+    monkeypatch.setattr(TP, "scale_bin", [sys.executable, STUB_SCALERTE])
+    monkeypatch.setattr(TP, "ORIGEN_WORKERS", 4)
+    monkeypatch.setattr(TP, "ORIGEN_CACHE", True)
+    monkeypatch.setattr(TP, "ORIGEN_MULTI_CASE", False)
+    monkeypatch.setattr(TP, "ORIGEN_SUPERPOSITION", False)
+    return dir_name
+
+
+def make_api(monkeypatch, tmp_path, algorithms, greens,
+             config_dir = os.path.join(ROOT, TP.ConfigDIRName), **kwargs):
+    # The paths are set into the modules, they are restored after the test
+    for name in ("ConfigDIRName", "MCUDIRName", "ResultsDIRName",
+                 "OrigenDIRName", "scale_bin"):
+        monkeypatch.setattr(TP, name, getattr(TP, name))
+    monkeypatch.setattr(FA_Gamma, "MCUGreenDirName", FA_Gamma.MCUGreenDirName)
+    paths = tvs_api.Paths(config_dir = str(config_dir),
+                          mcu_fin_dir = os.path.join(ROOT, TP.MCUDIRName),
+                          greens_dir = os.path.join(ROOT, FA_Gamma.MCUGreenDirName),
+                          origen_dir = str(tmp_path / "Origens"),
+                          results_dir = str(tmp_path / "Core_FAs"),
+                          scale_bin = [sys.executable, STUB_SCALERTE])
+    plan_api = tvs_api.TestPlanAPI(paths, **kwargs)
+    plan_api._apply_paths()
+    plan_api._algorithms, plan_api._greens = algorithms, greens
+    return plan_api
+
+
+@pytest.fixture
+def plan_api(tmp_path, origen_dir, monkeypatch, algorithms, greens):
+    return make_api(monkeypatch, tmp_path, algorithms, greens)
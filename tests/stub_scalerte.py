@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Stand-in scalerte for the tests: the decay gamma source of every
+# deck case is linear in its power history, the bands are those of
+# the deck gamma=[...] grid. As in ORIGEN a case starts from the
+# composition and the time at the end of the previous one unless it
+# has mat and time start, a time before the case start fails the run.
+# The tables are written in the ORIGEN .out layout next to the deck
+
+import math, re, sys
+
+def floats(text):
+    return [float(v) for v in text.split()]
+
+def main(deck):
+    with open(file = deck, mode='r', encoding='cp1251') as deck_object:
+        text = deck_object.read()
+    bounds = floats(re.search(r"gamma=\[([^\]]*)\]", text).group(1))[::-1]
+    bands = list(zip(bounds[:-1], bounds[1:]))
+    lambdas = [0.5 / (1 + n) for n in range(len(bands))]       # 1/hr
+    amplitudes = [1e6 * (1 + n % 5) for n in range(len(bands))]
+    matches = list(re.finditer(r"case\s*\(\s*(\w+)\s*\)", text))
+    ends = [match.start() for match in matches[1:]] + [len(text)]
+    # Sources of the composition at the time now
+    sources, now, t_irrad = [0.0] * len(bands), 0.0, 0.0
+    lines = list()
+    for match, end in zip(matches, ends):
+        case, body = match.group(1), text[match.end():end]
+        t = floats(re.search(r"\bt\s*=\s*\[([^\]]*)\]", body).group(1))
+        start = re.search(r"\bstart\s*=\s*(\S+)", body)
+        start = now if start is None else float(start.group(1))
+        if t[0] < start:
+            sys.exit(f"case {case}: time {t[0]} before the start {start}")
+        if re.search(r"\bmat\s*\{", body):
+            sources = [0.0] * len(bands)
+        power = re.search(r"power = \[([^\]]*)\]", body)
+        p = [0.0] * len(t) if power is None else floats(power.group(1))
+        treg = [start] + t
+        rows = [[source * math.exp(-lam * (t2 - start)) for t2 in treg]
+                for source, lam in zip(sources, lambdas)]
+        for n, lam in enumerate(lambdas):
+            for pwr, t1, t2 in zip(p, treg, t):
+                sources[n] = (sources[n] * math.exp(-lam * (t2 - t1)) +
+                              amplitudes[n] * pwr *
+                              (1.0 - math.exp(-lam * (t2 - t1))) / lam)
+        now = t[-1]
+        if power is not None:
+            t_irrad = now
+        if not case.startswith("decay"):
+            continue
+        lines.append("=" * 100)
+        lines.append("=   Gamma source intensity (1/s) as a function of "
+                     f"time for case '{case}' (#2/2)   =")
+        lines.append("-" * 100)
+        lines.append("     boundaries (MeV)   " +
+                     "".join(f"{t_irrad + t2 - start:10.1f}hr" for t2 in treg))
+        for (E_high, E_low), row in zip(bands, rows):
+            lines.append(f" {E_high / 1e6:.3E} - {E_low / 1e6:.3E}    " +
+                         "  ".join(f"{v:.10E}" for v in row))
+        lines.append("  --------------------")
+        lines.append("                 total    " +
+                     "  ".join(f"{sum(column):.10E}" for column in zip(*rows)))
+        lines.append("=" * 100)
+    with open(file = deck[:-len(".inp")] + ".out", mode='w',
+              encoding='cp1251') as out_object:
+        out_object.write("\n".join(lines) + "\n")
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,182 @@
+# Whole core doses of tvs_dose.api: the worker processes, the source
+# basis and the store against compute_cell, ORIGEN is the stand-in scalerte
+
+import json, os, shutil
+import numpy as np
+import pytest
+
+import FA_Gamma
+import FileCache
+import OrigenRunner
+import Test_plan as TP
+from tvs_dose import api as tvs_api
+
+from conftest import ROOT, make_api
+
+CELLS = ["1-1", "5-3", "3-2", "10-5"]
+DECAY_HOURS = 320
+
+
+def assert_same_cell(res, expected, rtol = 1e-12):
+    assert res.cell == expected.cell
+    assert res.times_h == expected.times_h
+    assert sorted(res.dose_uSv_per_h_by_zone) == sorted(expected.dose_uSv_per_h_by_zone)
+    for zone, series in expected.dose_uSv_per_h_by_zone.items():
+        np.testing.assert_allclose(res.dose_uSv_per_h_by_zone[zone], series,
+                                   rtol = rtol)
+
+
+def test_iter_core_workers_and_store(plan_api):
+    expected = {cell:plan_api.compute_cell(cell, DECAY_HOURS) for cell in CELLS}
+    results = list(plan_api.iter_core(DECAY_HOURS, cells = CELLS, workers = 2))
+    assert sorted(res.cell for res in results) == sorted(CELLS)
+    for res in results:
+        assert_same_cell(res, expected[res.cell])
+        # One NDJSON line per cell
+        line = res.ndjson()
+        assert line.endswith("\n") and line.count("\n") == 1
+        record = json.loads(line)
+        assert record["cell"] == res.cell
+        assert record["times_h"] == res.times_h
+        assert record["dose_uSv_per_h_by_zone"] == {
+                str(zone):series for zone, series in
+                res.dose_uSv_per_h_by_zone.items()}
+
+    store = tvs_api.load_core_doses(plan_api.core_store_path())
+    assert store.cells == CELLS
+    assert store.zones == sorted(expected["1-1"].dose_uSv_per_h_by_zone)
+    assert store.times_h == expected["1-1"].times_h
+    assert store.dose_uSv_per_h.shape == (len(CELLS), len(store.zones),
+                                          len(store.times_h))
+    assert store.meta["decay_hours"] == DECAY_HOURS
+    assert store.meta["history_sha1"] == FileCache.ContentHash(
+                plan_api._history_path())
+    for cell in CELLS:
+        assert_same_cell(store.cell(cell), expected[cell])
+
+
+def test_iter_core_from_the_cache(plan_api):
+    list(plan_api.iter_core(DECAY_HOURS, cells = CELLS[:2], workers = 1))
+    os.remove(plan_api.core_store_path())
+    # Cells computed already are taken from the ORIGEN cache
+    results = list(plan_api.iter_core(DECAY_HOURS, run_origen = False,
+                                      cells = CELLS[:2], workers = 2,
+                                      store = False))
+    assert sorted(res.cell for res in results) == sorted(CELLS[:2])
+    assert not os.path.exists(plan_api.core_store_path())
+
+    results = plan_api.iter_core(DECAY_HOURS, run_origen = False,
+                                 cells = CELLS[2:], workers = 2)
+    with pytest.raises(OrigenRunner.OrigenNotCached):
+        next(results)
+    assert not os.path.exists(plan_api.core_store_path())
+
+
+def test_load_core_doses_missing(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        tvs_api.load_core_doses(tmp_path / tvs_api.CORE_STORE_FN)
+
+
+def test_iter_core_source_basis(plan_api, monkeypatch):
+    expected = {cell:plan_api.compute_cell(cell, DECAY_HOURS) for cell in CELLS}
+    monkeypatch.setattr(TP, "ORIGEN_SUPERPOSITION", True)
+    results = list(plan_api.iter_core(DECAY_HOURS, cells = CELLS))
+    assert [res.cell for res in results] == CELLS
+    # The stand-in sources are linear in the power history,
+    # so the superposition is exact up to rounding
+    for res in results:
+        assert_same_cell(res, expected[res.cell], rtol = 1e-8)
+    store = tvs_api.load_core_doses(plan_api.core_store_path())
+    for res in results:
+        assert_same_cell(store.cell(res.cell), res)
+
+
+@pytest.fixture
+def history_api(tmp_path, monkeypatch, algorithms, greens):
+    """ API of a Configs copy with the history files A.txt, B.txt, C.txt,
+        built TCoreHistory objects are counted in built
+    """
+    config_dir = tmp_path / "Configs"
+    shutil.copytree(os.path.join(ROOT, TP.ConfigDIRName), config_dir)
+    for name in ("A.txt", "B.txt", "C.txt"):
+        shutil.copy(os.path.join(ROOT, TP.ConfigDIRName,
+                                 TP.TCoreHistory.history_fn), config_dir / name)
+    monkeypatch.setattr(TP.TCoreHistory, "history_fn", "A.txt")
+    plan_api = make_api(monkeypatch, tmp_path, algorithms, greens, config_dir,
+                        core_cache_size = 2)
+    plan_api.built = list()
+    init = TP.TCoreHistory.__init__
+    def counting_init(self, *args):
+        plan_api.built.append(type(self).history_fn)
+        init(self, *args)
+    monkeypatch.setattr(TP.TCoreHistory, "__init__", counting_init)
+    return plan_api
+
+
+def use_history(plan_api, monkeypatch, name):
+    monkeypatch.setattr(TP.TCoreHistory, "history_fn", name)
+    return plan_api._core_history()
+
+
+def test_core_history_reused_and_evicted(history_api, monkeypatch):
+    core_a, lock_a = use_history(history_api, monkeypatch, "A.txt")
+    assert use_history(history_api, monkeypatch, "A.txt") == (core_a, lock_a)
+    core_b = use_history(history_api, monkeypatch, "B.txt")[0]
+    assert core_b is not core_a
+    assert history_api.built == ["A.txt", "B.txt"]
+
+    # A is used last, so B goes when C comes in
+    assert use_history(history_api, monkeypatch, "A.txt")[0] is core_a
+    use_history(history_api, monkeypatch, "C.txt")
+    assert len(history_api._cores) == 2
+    assert use_history(history_api, monkeypatch, "A.txt")[0] is core_a
+    assert history_api.built == ["A.txt", "B.txt", "C.txt"]
+    assert use_history(history_api, monkeypatch, "B.txt")[0] is not core_b
+    assert history_api.built == ["A.txt", "B.txt", "C.txt", "B.txt"]
+
+
+def test_core_history_follows_the_file(history_api, monkeypatch):
+    fn = history_api._history_path()
+    core = use_history(history_api, monkeypatch, "A.txt")[0]
+    hashes = list()
+    content_hash = FileCache.ContentHash
+    monkeypatch.setattr(FileCache, "ContentHash",
+                        lambda path: hashes.append(path) or content_hash(path))
+
+    # The file is hashed again only if its size or mtime changed
+    assert use_history(history_api, monkeypatch, "A.txt")[0] is core
+    assert hashes == []
+    stat = os.stat(fn)
+    os.utime(fn, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert use_history(history_api, monkeypatch, "A.txt")[0] is core
+    assert hashes == [fn]
+
+    # Another content of the same size
+    with open(fn, encoding = "utf8") as history_file:
+        text = history_file.read()
+    assert "43\t0\tP+M\t181" in text
+    with open(fn, "w", encoding = "utf8") as history_file:
+        history_file.write(text.replace("43\t0\tP+M\t181", "44\t0\tP+M\t181"))
+    os.utime(fn, ns = (stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    assert os.path.getsize(fn) == stat.st_size
+    changed = use_history(history_api, monkeypatch, "A.txt")[0]
+    assert changed is not core
+    assert (changed.last_time, core.last_time) == (44.0, 43.0)
+    # The previous version of the file is dropped
+    assert len(history_api._cores) == 1
+
+    # Appended records
+    with open(fn, "a", encoding = "utf8") as history_file:
+        history_file.write("45\t1\tP+M\t181\n")
+    appended = use_history(history_api, monkeypatch, "A.txt")[0]
+    assert appended is not changed and appended.last_time == 45.0
+    assert history_api.built == ["A.txt"] * 3
+
+
+def test_initialize_clears_core_histories(history_api, monkeypatch):
+    core = use_history(history_api, monkeypatch, "A.txt")[0]
+    history_api.initialize()
+    # The histories of the previous algorithms are not used
+    assert len(history_api._cores) == 0
+    assert use_history(history_api, monkeypatch, "A.txt")[0] is not core
+    assert history_api.built == ["A.txt", "A.txt"]
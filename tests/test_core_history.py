@@ -0,0 +1,203 @@
+# TCoreHistory appended records against the history read at once
+
+import os
+import numpy as np
+import pytest
+
+import OrigenReader
+import Test_plan as TP
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_FN = os.path.join(ROOT, TP.ConfigDIRName, TP.TCoreHistory.history_fn)
+
+
+def history_lines():
+    with open(HISTORY_FN, encoding = "utf8") as history_file:
+        lines = history_file.read().splitlines()
+    header = [n for n, line in enumerate(lines) if not line.startswith("#")][0]
+    return lines[:header + 1], lines[header + 1:]
+
+
+def history_records():
+    return [rec for chunk in TP.THistoryStream(HISTORY_FN).chunks()
+            for rec in chunk]
+
+
+@pytest.fixture
+def history_dir(tmp_path, monkeypatch):
+    """ Returns the function writing the first n_records of the history
+        into the history file of tmp_path, tmp_path becomes current
+    """
+    head, lines = history_lines()
+    (tmp_path / TP.ConfigDIRName).mkdir()
+    fn = tmp_path / TP.ConfigDIRName / TP.TCoreHistory.history_fn
+    monkeypatch.chdir(tmp_path)
+    def write_history(n_records):
+        fn.write_text("\n".join(head + lines[:n_records]) + "\n",
+                      encoding = "utf8")
+        return fn
+    return write_history
+
+
+def assert_same_products(core, full):
+    np.testing.assert_allclose(core.burnups, full.burnups, rtol = 1e-12)
+    np.testing.assert_allclose(core.burnups2, full.burnups2, rtol = 1e-12)
+    for cell, FA in full.FAs.items():
+        assert core.FAs[cell].burnup == pytest.approx(FA.burnup, rel = 1e-12)
+        assert core.FAs[cell].FA_burnup == pytest.approx(FA.FA_burnup, rel = 1e-12)
+        assert core.FAs2[cell].burnup == pytest.approx(full.FAs2[cell].burnup,
+                                                       rel = 1e-12, abs = 1e-9)
+    for name in ("Wmax_span", "Wmax2_span"):
+        assert getattr(core, name)[:2] == getattr(full, name)[:2]
+        assert getattr(core, name)[2] == pytest.approx(getattr(full, name)[2],
+                                                       rel = 1e-12)
+    for name in ("Wmax_FA", "Wmax_FA2"):
+        assert getattr(core, name)[0] == getattr(full, name)[0]
+        assert getattr(core, name)[1] == pytest.approx(getattr(full, name)[1],
+                                                       rel = 1e-12)
+    for name in ("Wmax_history", "Wmax2_history", "Wenvelope_history"):
+        history, full_history = getattr(core, name), getattr(full, name)
+        assert history.history == full_history.history
+        assert history.build_origen_params() == full_history.build_origen_params()
+    assert core.last_time == full.last_time
+
+
+# The last Wmax2_hours of n_records + 3 records must have some burnup
+# for Wmax2_history to be taken in between
+@pytest.mark.parametrize("n_records", [3, 11, 17, 29])
+def test_append_matches_full_history(history_dir, algorithms, greens, core,
+                                     n_records):
+    records = history_records()
+    fn = history_dir(n_records)
+    appended = TP.TCoreHistory(algorithms, greens)
+    # Products taken before the append are recomputed or extended
+    appended.Wmax_history, appended.Wenvelope_history, appended.burnups2
+    appended.append_history(records[n_records:n_records + 3])
+    appended.Wmax2_history
+    appended.append_history(records[n_records + 3:])
+    assert_same_products(appended, core)
+
+    # The saved history is the full one
+    saved = [rec for chunk in TP.THistoryStream(str(fn)).chunks()
+             for rec in chunk]
+    assert saved == records
+    assert_same_products(TP.TCoreHistory(algorithms, greens), core)
+
+
+def test_append_without_save(history_dir, algorithms, greens, core):
+    records = history_records()
+    fn = history_dir(20)
+    text = fn.read_text(encoding = "utf8")
+    appended = TP.TCoreHistory(algorithms, greens)
+    appended.append_history(records[20:], save = False)
+    appended.append_history([])
+    assert_same_products(appended, core)
+    assert fn.read_text(encoding = "utf8") == text
+
+
+def test_append_rejects_invalid_records(history_dir, algorithms, greens):
+    records = history_records()
+    fn = history_dir(20)
+    text = fn.read_text(encoding = "utf8")
+    appended = TP.TCoreHistory(algorithms, greens)
+    last_time = appended.last_time
+    t, N, alg, FAs = records[20]
+    with pytest.raises(TP.CoreHistoryInvalid):
+        appended.append_history([(t, N, "no such algorithm", FAs)])
+    with pytest.raises(TP.CoreHistoryInvalid):
+        appended.append_history([(t, N, alg, FAs), (t - 1, N, alg, FAs)])
+    # Nothing is taken from rejected records
+    assert appended.last_time == last_time
+    assert len(appended.history_trace) == 20
+    assert fn.read_text(encoding = "utf8") == text
+
+
+def brute_window_burnups(core, t1 = None, t2 = None):
+    # Burnups of the steps ending in (t1, t2] by the record loop
+    cells = core.fission_tensor.cells
+    burnups = np.zeros((len(cells), TP.MCU_FA_spans))
+    records = list(core.history_trace)
+    for (prev_t, _, _), (t, pwr, alg_key) in zip(records, records[1:]):
+        if (t1 is None or t > t1) and (t2 is None or t <= t2):
+            FAs = core.algorithms[alg_key].FAs
+            for n, cell in enumerate(cells):
+                for FAspan, K in FAs[cell].fissions.items():
+                    burnups[n, FAspan] += pwr * (t - prev_t) * K
+    return burnups
+
+
+WINDOWS = [(None, None), (None, 10.0), (5.0, None), (2.0, 2.5),
+           (2.5, 17.2), (17.0, 17.1), (100.0, 200.0)]
+
+
+@pytest.mark.parametrize("t1, t2", WINDOWS)
+def test_window_burnups(core, t1, t2):
+    expected = brute_window_burnups(core, t1, t2)
+    np.testing.assert_allclose(core.WindowBurnups(t1, t2), expected,
+                               rtol = 1e-12, atol = 1e-12)
+    cell, span, burnup = core.MaxBurnupSpan(t1, t2)
+    if expected.max() > 0.0:
+        assert burnup == pytest.approx(expected.max(), rel = 1e-12)
+        assert expected[core.fission_tensor.cell_idx[cell], span] == \
+                pytest.approx(burnup, rel = 1e-12)
+        FA_cell, FA_burnup = core.MaxBurnupFA(t1, t2)
+        assert FA_burnup == pytest.approx(expected.sum(axis = 1).max(), rel = 1e-12)
+    else:
+        assert (cell, span, burnup) == ("", -1, 0.0)
+        assert core.MaxBurnupFA(t1, t2) == ("", 0.0)
+
+
+def test_window_queries_match_properties(core):
+    t1 = core.last_time - TP.TCoreHistory.Wmax2_hours
+    assert core.MaxBurnupSpan() == core.Wmax_span
+    assert core.MaxBurnupSpan(t1) == core.Wmax2_span
+    assert core.MaxBurnupFA(t1) == core.Wmax_FA2
+    cell, span, burnup, history = core.MaxBurnupHistory(t1)
+    assert (cell, span, burnup) == core.Wmax2_span
+    assert history.history == core.Wmax2_history.history
+
+
+@pytest.mark.parametrize("hours", [0.5, 2.0, 7.3, 1000.0])
+@pytest.mark.parametrize("chunk", [3, TP.SLIDING_CHUNK])
+def test_max_sliding_window(core, monkeypatch, hours, chunk):
+    monkeypatch.setattr(TP, "SLIDING_CHUNK", chunk)
+    t1, t2, cell, span, burnup = core.MaxSlidingWindow(hours)
+    ends = [t for t, _, _ in core.history_trace][1:]
+    expected = max(brute_window_burnups(core, t - hours, t).max() for t in ends)
+    assert burnup == pytest.approx(expected, rel = 1e-12)
+    assert t2 in ends and t2 - t1 == pytest.approx(hours)
+    assert brute_window_burnups(core, t1, t2)[
+            core.fission_tensor.cell_idx[cell], span] == pytest.approx(burnup,
+                                                                       rel = 1e-12)
+
+
+def test_max_relative_error_skips_zero_totals():
+    diffs = np.array([1.0, 2.0, 0.0, 3.0])
+    totals = np.array([10.0, 0.0, 0.0, 60.0])
+    assert TP.MaxRelativeError(diffs, totals) == 0.1
+    assert TP.MaxRelativeError(diffs, np.zeros(4)) == 0.0
+
+
+def test_source_basis_check_with_zero_totals(algorithms, greens, monkeypatch):
+    core = TP.TCoreHistory(algorithms, greens)
+    cell, span = core.Wmax_span[:2]
+    K = core.fission_tensor.fissions[:, core.fission_tensor.cell_idx[cell], span]
+    code = int(K.argmax())
+    bands = [(1e5, 1e6), (1e6, 2e6)]
+    # The basis and the direct run differ by 10 % in the first band,
+    # the direct source is zero at the last time
+    spectra = np.array([[1.0, 2.0, 4.0], [1.0, 1.0, 1.0]])
+    direct = np.array([[1.1, 2.2, 0.0], [1.0, 1.0, 0.0]])
+    table = lambda values: OrigenReader.TOrigenTable(
+                OrigenReader.IntensityTable, "decay", "1/s",
+                *np.array(bands).T, np.arange(3.0), values, values.sum(axis = 0))
+    core.source_basis = TP.TSourceBasis([code], [K[code]], [table(spectra)],
+                                        10, [0.0, 1.0, 2.0])
+    monkeypatch.setattr(core, "RunOrigenHistories",
+                        lambda *args: [table(direct)])
+    errors = core.CheckSourceBasis([(cell, span)])
+    assert np.isfinite([errors[0]["spectrum_error"],
+                        errors[0]["total_error"]]).all()
+    assert errors[0]["spectrum_error"] == pytest.approx(0.2 / 3.2)
+    assert errors[0]["total_error"] == pytest.approx(0.2 / 3.2)
+    assert core.source_basis.error == errors[0]["spectrum_error"]
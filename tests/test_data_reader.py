@@ -0,0 +1,157 @@
+# TDataReader indexes and interpolation against plain linear scans
+
+import datetime, math, os
+import numpy as np
+import pytest
+
+import DataReader
+import Test_plan as TP
+
+DATA = """# Comment line
+RegZone\tx\ty\tt\tname
+3\t1.5\t10\t01.01.2024 00:00:00\ta
+1\t0.5\t20\t01.01.2024 01:00:00\tb
+2\t1.0\t15\t01.01.2024 03:00:00\tc
+2\t4.0\t99\t01.01.2024 06:00:00\td
+5\t2.5\t-5\t01.01.2024 07:30:00\te
+"""
+
+
+@pytest.fixture
+def reader(tmp_path):
+    fn = tmp_path / "data.txt"
+    fn.write_text(DATA, encoding = "utf8")
+    return DataReader.TDataReader(str(fn))
+
+
+def scan(records, field_index, value):
+    for rec in records:
+        if rec[field_index] == value:
+            return rec
+    raise KeyError(value)
+
+
+def reference_interpolation(records, field_index, field_data):
+    # Linear search of the first record with the greater key
+    records = sorted(records, key = lambda rec: rec[field_index])
+    for idx in range(len(records)):
+        if field_data < records[idx][field_index]:
+            break
+    if idx == 0:
+        idx = 1
+    prev_data, next_data = records[idx-1], records[idx]
+    k = ((field_data - prev_data[field_index]) /
+         (next_data[field_index] - prev_data[field_index]))
+    return [prev + k * (next - prev) if type(prev) is not str else 'string!'
+            for prev, next in zip(prev_data, next_data)]
+
+
+def test_fields_and_types(reader):
+    assert reader.fields == ["RegZone", "x", "y", "t", "name"]
+    assert reader.data_types == (float, float, float, datetime.datetime, str)
+    assert len(reader) == 5
+    assert reader.find_field_index("y") == 2
+    assert reader.find_field_index(4) == 4
+    with pytest.raises(DataReader.FieldError):
+        reader.find_field_index("z")
+    assert list(reader.column("x")) == [1.5, 0.5, 1.0, 4.0, 2.5]
+
+
+def test_index_lookups(reader):
+    for zone in (1.0, 2.0, 3.0, 5.0):
+        assert zone in reader
+        assert reader[zone] == scan(reader.raw_data, 0, zone)
+    assert reader[2.0][4] == "c"                # the first one
+    assert 4.0 not in reader
+    assert [] not in reader
+    with pytest.raises(KeyError):
+        reader[4.0]
+    with pytest.raises(KeyError):
+        reader.get_item_by_field("name", [])
+    assert reader.get_item_by_field("name", "d") == scan(reader.raw_data, 4, "d")
+
+    # Indexes follow raw_data changes
+    rec = (4.0, 0.0, 0.0, datetime.datetime(2024, 1, 2), "f")
+    reader.raw_data.append(rec)
+    assert reader[4.0] == rec
+    reader.raw_data = reader.raw_data[:2]
+    assert 2.0 not in reader and 1.0 in reader
+    del reader.raw_data[0]
+    assert 3.0 not in reader
+
+
+def test_index_of_sorted_data(reader):
+    assert reader[2.0][4] == "c"
+    reader.sort_data("y")
+    assert [rec[4] for rec in reader.raw_data] == ["e", "a", "c", "b", "d"]
+    assert reader[2.0][4] == "c"
+    reader.sort_data("x")
+    assert reader[2.0] == scan(reader.raw_data, 0, 2.0)
+
+
+@pytest.mark.parametrize("x", [-1.0, 0.5, 0.7, 1.0, 1.2, 2.5, 3.9, 4.0, 7.0])
+def test_interpolate_by_field(reader, x):
+    expected = reference_interpolation(reader.raw_data, 1, x)
+    got = reader.interpolate_by_field("x", x)
+    assert got[4] == expected[4] == 'string!'
+    assert got[3] == expected[3]
+    np.testing.assert_allclose(got[:3], expected[:3], rtol = 1e-15)
+
+
+def test_interpolate_by_string_field(reader):
+    with pytest.raises(DataReader.FieldError):
+        reader.interpolate_by_field("name", "c")
+
+
+def test_interpolate_many(reader):
+    xs = [-1.0, 0.5, 0.7, 1.2, 2.5, 4.0, 7.0]
+    values = reader.interpolate_many("x", xs)
+    assert values.shape == (len(xs), 5)
+    for row, x in zip(values, xs):
+        expected = reader.interpolate_by_field("x", x)
+        np.testing.assert_allclose(row[:3], expected[:3], rtol = 1e-12)
+        assert np.isnan(row[3:]).all()
+
+    # Datetime key is taken as seconds
+    times = [datetime.datetime(2024, 1, 1, 2), datetime.datetime(2024, 1, 1, 7)]
+    values = reader.interpolate_many("t", times)
+    np.testing.assert_allclose(values[:, 1], [0.75, 3.0])
+    np.testing.assert_allclose(values[:, 2], [17.5, 99 - 104 * 2 / 3])
+
+
+def test_interpolate_by_rec_no(reader):
+    records = reader.raw_data
+    for rec_no in (0, 0.25, 1, 2.5, 3.75):
+        idx = math.floor(rec_no)
+        k = rec_no - idx
+        got = reader.interpolate_by_rec_no(rec_no)
+        for n in range(3):
+            assert got[n] == pytest.approx(
+                        records[idx][n] + k * (records[idx+1][n] - records[idx][n]))
+        assert got[4] == 'string!'
+    assert reader.interpolate_by_rec_no(-3)[:3] == list(records[0][:3])
+    # The last record and beyond are the end of the last interval
+    assert reader.interpolate_by_rec_no(4)[:3] == list(records[4][:3])
+    assert reader.interpolate_by_rec_no(10)[:3] == list(records[4][:3])
+
+    reader.raw_data = records[:1]
+    assert reader.interpolate_by_rec_no(0.5)[:3] == list(records[0][:3])
+
+
+def test_stream_chunks(tmp_path, reader):
+    fn = tmp_path / "data.txt"
+    stream = DataReader.TDataStream(str(fn), chunk_size = 2)
+    chunks = list(stream.chunks())
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [rec for chunk in chunks for rec in chunk] == list(reader.raw_data)
+    assert list(stream) == list(reader.raw_data)
+    assert stream.fields == reader.fields
+
+
+def test_config_file_index():
+    reader = DataReader.TDataReader(
+                os.path.join(TP.ConfigDIRName, TP.MCU_FAs_fn))
+    zone_index = reader.find_field_index(DataReader.RegZoneField)
+    for rec in reader.raw_data[::97]:
+        assert reader[rec[zone_index]] == scan(reader.raw_data, zone_index,
+                                               rec[zone_index])
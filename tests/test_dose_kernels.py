@@ -0,0 +1,181 @@
+# Tensor dose kernels against the dict-based loops they replaced
+
+import math, os
+import numpy as np
+import pytest
+
+import FA_Gamma
+import OrigenReader
+import Test_plan as TP
+
+ZONES = list(range(100, 150))
+
+
+@pytest.fixture(scope = "module")
+def green_dicts():
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return FA_Gamma.readGreenDicts()
+
+
+def read_sources(fn):
+    return OrigenReader.ReadOrigenTable(
+                os.path.join(TP.OrigenDIRName, fn)).as_dict()
+
+
+def reference_fluxes(Greens, zone, spans_sources, n_times):
+    """ Registered fluxes of zone by Greens dicts, spans_sources
+        is a list of (span, K, sources) for the spans 0..9
+    """
+    Zones0 = list(Greens[1].values())[0]
+    ERegs = list(list(Zones0.values())[0].keys())
+    reg_fluxes = {E:[0.0] * n_times for E in ERegs}
+    for span, K, sources in spans_sources:
+        src = span + 1
+        if src <= 5:
+            IncGamma = Greens[src]
+            reg_zone = zone
+        else:
+            IncGamma = Greens[11 - src]
+            reg_zone = 10 * (zone // 10) + (9 - zone % 10)
+        for Esrc in IncGamma:
+            for OrigenKey in sources:
+                if OrigenKey[0] <= Esrc <= OrigenKey[1]:
+                    RegZone = IncGamma[Esrc][reg_zone]
+                    for flux in RegZone:
+                        for n_pt, origen_out in enumerate(sources[OrigenKey]):
+                            reg_fluxes[flux][n_pt] += (K * RegZone[flux] *
+                                                       origen_out)
+                    break
+    return ERegs, reg_fluxes
+
+
+def reference_dose(ERegs, reg_fluxes, n_times):
+    # NRB-99 weights put on the upper bound of the registered bin
+    dozeRates = [0.0] * n_times
+    for E_NRB, weight in TP.TCoreHistory.NRB.items():
+        for Elow, EHigh in zip(ERegs[:-1], ERegs[1:]):
+            if Elow <= E_NRB <= EHigh:
+                for n in range(n_times):
+                    dozeRates[n] += reg_fluxes[EHigh][n] * weight * 1e-12
+    return dozeRates
+
+
+def test_green_tensor_matches_dicts(greens, green_dicts):
+    for src, IncGamma in green_dicts.items():
+        for Esrc, zones in IncGamma.items():
+            for zone, fluxes in zones.items():
+                for E, flux in fluxes.items():
+                    assert greens[src][Esrc][zone][E] == flux
+    assert np.array_equal(
+            greens.data, FA_Gamma.TGreenTensor.from_dicts(green_dicts).data)
+
+
+def test_envelope_doses_match_dict_loops(core, green_dicts):
+    sources = read_sources("envelope.out")
+    n_times = len(next(iter(sources.values())))
+    axial = core.Wenvelope_axial
+    doses = core.FADoseRates(axial, ZONES, sources)
+    assert doses.shape == (len(ZONES), n_times)
+    for zone, zone_doses in zip(ZONES, doses):
+        ERegs, reg_fluxes = reference_fluxes(
+                green_dicts, zone,
+                [(span, axial[span], sources) for span in range(10)], n_times)
+        expected = reference_dose(ERegs, reg_fluxes, n_times)
+        np.testing.assert_allclose(zone_doses, expected, rtol = 1e-12)
+        np.testing.assert_allclose(core.FADoseRate(axial, zone, sources),
+                                   expected, rtol = 1e-12)
+
+
+def test_cell_doses_match_dict_loops(core, green_dicts):
+    span_sources = {span:read_sources(f"1-1_{span:d}.out")
+                    for span in range(TP.MCU_FA_spans)}
+    n_times = len(next(iter(span_sources[0].values())))
+    doses = core.FACellDoseRates(span_sources, ZONES)
+    for zone, zone_doses in zip(ZONES, doses):
+        ERegs, reg_fluxes = reference_fluxes(
+                green_dicts, zone,
+                [(span, 1.0, span_sources[span]) for span in span_sources],
+                n_times)
+        np.testing.assert_allclose(
+                zone_doses, reference_dose(ERegs, reg_fluxes, n_times),
+                rtol = 1e-12)
+
+
+def test_band_map_takes_the_band_of_every_incident_energy(core):
+    sources = read_sources("envelope.out")
+    bands = list(sources)
+    band_map = core.BandMap(bands)
+    spectra = np.array([sources[band] for band in bands])
+    gathered = band_map.gather(spectra)
+    for n, Esrc in enumerate(core.Greens.Esrcs.tolist()):
+        matching = [band for band in bands if band[0] <= Esrc <= band[1]]
+        if matching:
+            np.testing.assert_array_equal(gathered[n], sources[matching[0]])
+        else:
+            assert not gathered[n].any()
+
+
+def test_loglog_dose_response():
+    NRB = TP.TCoreHistory.NRB
+    # The geometric center of two NRB energies gets the geometric mean
+    # of their constants
+    response = TP.TDoseResponse([0.1e6, 0.15e6], NRB, "loglog")
+    assert response.weights[0] == 0.0
+    assert response.weights[1] == pytest.approx(
+                math.sqrt(NRB[0.1e6] * NRB[0.15e6]) * 1e-12, rel = 1e-12)
+    # "bins" puts both constants onto the upper boundary
+    response = TP.TDoseResponse([0.1e6, 0.15e6], NRB, "bins")
+    assert response.weights[1] == pytest.approx(
+                (NRB[0.1e6] + NRB[0.15e6]) * 1e-12, rel = 1e-12)
+
+    # K = E / 1e4 in log-log, clamped out of [1e4, 1e6]
+    response = TP.TDoseResponse([0.0, 1e4, 1e5, 1e6, 2e7],
+                                {1e4:1.0, 1e6:100.0}, "loglog")
+    np.testing.assert_allclose(response.weights,
+                               np.array([0.0, 1.0, math.sqrt(10.0),
+                                         math.sqrt(1000.0), 100.0]) * 1e-12,
+                               rtol = 1e-12)
+    fluxes = np.array([[1.0, 2.0, 3.0, 4.0, 5.0]])
+    np.testing.assert_allclose(response.apply(fluxes),
+                               fluxes @ response.weights)
+
+
+@pytest.mark.parametrize("K", [0.0, -1.0])
+def test_loglog_dose_response_rejects_non_positive_constants(K):
+    with pytest.raises(ValueError):
+        TP.TDoseResponse([1e4, 1e5], {1e4:1.0, 5e4:K, 1e6:100.0}, "loglog")
+    # The bins just add it
+    response = TP.TDoseResponse([1e4, 1e5], {1e4:1.0, 5e4:K, 1e6:100.0}, "bins")
+    assert response.weights[1] == pytest.approx((1.0 + K) * 1e-12)
+    with pytest.raises(ValueError):
+        TP.TDoseResponse([1e4, 1e5], {1e4:1.0}, "linear")
+
+
+def test_green_energy_out_of_the_bands(core, monkeypatch, capsys):
+    monkeypatch.setattr(TP.TCoreHistory, "band_maps", dict())
+    sources = read_sources("envelope.out")
+    top = max(sources, key = lambda band: band[1])
+    assert top[0] < 10e6 < top[1]
+    partial = {band:values for band, values in sources.items() if band != top}
+    Esrcs = core.Greens.Esrcs.tolist()
+
+    monkeypatch.setattr(TP.TCoreHistory, "strict_bands", True)
+    with pytest.raises(TP.OrigenBandsMismatch) as info:
+        core.BandMap(list(partial))
+    assert info.value.unmatched == [10e6]
+    assert "1.0000e+07" in str(info.value)
+
+    # By default the energy is reported and gets no source
+    monkeypatch.setattr(TP.TCoreHistory, "strict_bands", False)
+    capsys.readouterr()
+    band_map = core.BandMap(list(partial))
+    assert band_map.unmatched == [10e6]
+    assert "No ORIGEN band for Green's energies" in capsys.readouterr().out
+    gathered = core.SourceByEsrc(partial)
+    assert not gathered[Esrcs.index(10e6)].any()
+    assert gathered[Esrcs.index(8e6)].any()
+    zero_top = dict(sources)
+    zero_top[top] = [0.0] * len(sources[top])
+    np.testing.assert_allclose(
+            core.FADoseRates(core.Wenvelope_axial, ZONES, partial),
+            core.FADoseRates(core.Wenvelope_axial, ZONES, zero_top), rtol = 1e-12)
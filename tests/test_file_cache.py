@@ -0,0 +1,139 @@
+# Fingerprinted caches of the Green's functions and MCU algorithms
+
+import os, shutil
+import numpy as np
+import pytest
+
+import FA_Gamma
+import FileCache
+import Test_plan as TP
+
+
+def test_npz_round_trip(tmp_path):
+    fn = str(tmp_path / "x.npz")
+    meta = {"version":1, "names":["a", "b"]}
+    FileCache.SaveNPZ(fn, meta, a = np.arange(5.0), b = np.eye(2))
+    loaded_meta, arrays = FileCache.LoadNPZ(fn)
+    assert loaded_meta == meta
+    np.testing.assert_array_equal(arrays["a"], np.arange(5.0))
+    np.testing.assert_array_equal(arrays["b"], np.eye(2))
+    assert os.listdir(tmp_path) == ["x.npz"]
+
+
+def test_npz_missing_or_broken(tmp_path):
+    assert FileCache.LoadNPZ(str(tmp_path / "none.npz")) == (None, None)
+    (tmp_path / "broken.npz").write_bytes(b"not a zip")
+    assert FileCache.LoadNPZ(str(tmp_path / "broken.npz")) == (None, None)
+
+
+def test_fingerprints_match(tmp_path):
+    fn = str(tmp_path / "data.txt")
+    with open(fn, "w") as data_file:
+        data_file.write("1 2 3\n")
+    stored = FileCache.FingerprintsOf([fn])
+    assert FileCache.FingerprintsMatch(stored, [fn])
+    # Only mtime changed: the content hash decides
+    os.utime(fn, ns = (0, 10**9))
+    assert FileCache.FingerprintsMatch(stored, [fn])
+    with open(fn, "w") as data_file:
+        data_file.write("1 2 4\n")
+    assert not FileCache.FingerprintsMatch(stored, [fn])
+    assert not FileCache.FingerprintsMatch(stored, [fn, fn + ".other"])
+    os.remove(fn)
+    assert not FileCache.FingerprintsMatch(stored, [fn])
+
+
+@pytest.fixture
+def green_copy(tmp_path, monkeypatch, repo_dir):
+    shutil.copytree(os.path.join(repo_dir, FA_Gamma.MCUGreenDirName),
+                    tmp_path / FA_Gamma.MCUGreenDirName)
+    monkeypatch.chdir(tmp_path)
+    calls = list()
+    read_dicts = FA_Gamma.readGreenDicts
+    def counting_read_dicts():
+        calls.append(1)
+        return read_dicts()
+    monkeypatch.setattr(FA_Gamma, "readGreenDicts", counting_read_dicts)
+    return tmp_path / FA_Gamma.MCUGreenDirName, calls
+
+
+def test_green_cache_invalidation(green_copy):
+    green_dir, calls = green_copy
+    first = FA_Gamma.readGreenFuncs()
+    assert len(calls) == 1
+    assert os.path.exists(str(green_dir) + FA_Gamma.GreenCacheSuffix)
+
+    cached = FA_Gamma.readGreenFuncs()
+    assert len(calls) == 1
+    np.testing.assert_array_equal(cached.data, first.data)
+    np.testing.assert_array_equal(cached.Esrcs, first.Esrcs)
+
+    # The same content with another mtime keeps the cache
+    fin_fn = str(green_dir / "TVS_1" / "TVS_N.FIN_S0")
+    os.utime(fin_fn, ns = (0, 10**9))
+    FA_Gamma.readGreenFuncs()
+    assert len(calls) == 1
+
+    # Changed content rebuilds it
+    shutil.copyfile(green_dir / "TVS_1" / "TVS_N.FIN_S1", fin_fn)
+    changed = FA_Gamma.readGreenFuncs()
+    assert len(calls) == 2
+    assert not np.array_equal(changed.data, first.data)
+    np.testing.assert_array_equal(FA_Gamma.readGreenFuncs().data, changed.data)
+    assert len(calls) == 2
+
+
+@pytest.fixture
+def mcu_copy(tmp_path, monkeypatch, repo_dir):
+    """ Configs copy and MCU_FIN of links to the repository FIN files,
+        TAlgorithm builds (not cache reads) are counted
+    """
+    shutil.copytree(os.path.join(repo_dir, TP.ConfigDIRName),
+                    tmp_path / TP.ConfigDIRName)
+    (tmp_path / TP.MCUDIRName).mkdir()
+    for fn in os.listdir(os.path.join(repo_dir, TP.MCUDIRName)):
+        os.symlink(os.path.join(repo_dir, TP.MCUDIRName, fn),
+                   tmp_path / TP.MCUDIRName / fn)
+    monkeypatch.chdir(tmp_path)
+    builds = list()
+    init = TP.TAlgorithm.__init__
+    def counting_init(self, *args):
+        builds.append(args[5])      # FIN file name
+        init(self, *args)
+    monkeypatch.setattr(TP.TAlgorithm, "__init__", counting_init)
+    return tmp_path, builds
+
+
+def fissions_of(algorithms):
+    return {alg_key:{cell:dict(FA.fissions) for cell, FA in alg.FAs.items()}
+            for alg_key, alg in algorithms.items()}
+
+
+def test_algorithms_cache_invalidation(mcu_copy, algorithms):
+    tmp_path, builds = mcu_copy
+    first = TP.ReadStaticData(TP.FINsListFile)
+    FINs = sorted(set(builds))
+    assert len(FINs) > 1
+    assert fissions_of(first) == fissions_of(algorithms)
+
+    del builds[:]
+    assert fissions_of(TP.ReadStaticData(TP.FINsListFile)) == fissions_of(first)
+    assert builds == []
+
+    # Only the changed FIN is read again
+    fin_fn = FINs[0]
+    path = tmp_path / TP.MCUDIRName / fin_fn
+    data = path.read_bytes()
+    path.unlink()
+    path.write_bytes(data + b"\n")
+    assert fissions_of(TP.ReadStaticData(TP.FINsListFile)) == fissions_of(first)
+    assert builds == [fin_fn]
+
+    # MCU_FAs.txt change invalidates every algorithm: a repeated record
+    # does not change the zones index, only the file
+    del builds[:]
+    FAs_path = tmp_path / TP.ConfigDIRName / TP.MCU_FAs_fn
+    lines = FAs_path.read_text(encoding = "utf8").splitlines()
+    FAs_path.write_text("\n".join(lines + lines[-1:]) + "\n", encoding = "utf8")
+    assert fissions_of(TP.ReadStaticData(TP.FINsListFile)) == fissions_of(first)
+    assert sorted(set(builds)) == FINs
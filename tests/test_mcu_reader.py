@@ -0,0 +1,81 @@
+# TFINReader against the line-by-line reading of the FIN text
+
+import os, re, shutil
+import numpy as np
+import pytest
+
+import MCUReader
+import Test_plan as TP
+
+line_pattern = re.compile(
+        r"""^\s+(?P<zone>[0-9]+)
+             \s+(?P<mean>[-+]?[0-9]*[.]?[0-9]+([eE][-+]?[0-9]+)?)
+             \s+(?P<StdDev>[-+]?[0-9]*[.]?[0-9]+([eE][-+]?[0-9]+)?)
+             [\r\n]$""", re.VERBOSE)
+
+
+def read_tally_lines(fn, number):
+    """ (zones, means, stdevs) of the MIXT reaction number tally
+        of the first ZONES section, the data lines follow the header
+    """
+    tally_line = (" NUCLIDE:          MIXT, REACTION:" +
+                  f"{number:13d}, ENERGY:    0.00000E+00")
+    zones, means, stdevs = list(), list(), list()
+    in_zones = in_tally = False
+    with open(fn, encoding = "utf8") as fin_file:
+        for line in fin_file:
+            if line.startswith(" -- ZONES --"):
+                in_zones = True
+            elif in_zones and line.startswith(tally_line):
+                in_tally = True
+            elif in_tally and "Mean" in line:
+                continue
+            elif in_tally:
+                match = line_pattern.match(line)
+                if match is None:
+                    break
+                zones.append(int(match.group("zone")))
+                means.append(float(match.group("mean")))
+                stdevs.append(float(match.group("StdDev")))
+    return zones, means, stdevs
+
+
+def FIN_files():
+    return sorted(fn for fn in os.listdir(os.path.join(
+                    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    TP.MCUDIRName)) if fn.endswith(".FIN"))[:3]
+
+
+@pytest.mark.parametrize("fin_fn", FIN_files())
+@pytest.mark.parametrize("number", [3, 18])
+def test_tallies_match_text_reading(fin_fn, number):
+    fn = os.path.join(TP.MCUDIRName, fin_fn)
+    expected = read_tally_lines(fn, number)
+    assert len(expected[0]) > 0
+    with MCUReader.TFINReader(fn) as reader:
+        zones, means, stdevs = reader.read_tally("MIXT", number)
+    assert zones.tolist() == expected[0]
+    assert means.tolist() == expected[1]
+    assert stdevs.tolist() == expected[2]
+
+
+def test_index_sidecar(tmp_path):
+    fn = str(tmp_path / FIN_files()[0])
+    shutil.copy(os.path.join(TP.MCUDIRName, FIN_files()[0]), fn)
+    with MCUReader.TFINReader(fn, save_index = True) as reader:
+        R18 = reader.read_tally("MIXT", 18)
+    assert os.path.exists(fn + MCUReader.IndexSuffix)
+
+    with MCUReader.TFINReader(fn) as reader:
+        assert reader.index is not None
+        for got, expected in zip(reader.read_tally("MIXT", 18), R18):
+            np.testing.assert_array_equal(got, expected)
+        with pytest.raises(MCUReader.TallyNotFound):
+            reader.read_tally("MIXT", 999)
+
+    # The index of a changed file is not used
+    with open(fn, "ab") as fin_file:
+        fin_file.write(b"\n")
+    with MCUReader.TFINReader(fn) as reader:
+        assert reader.index is None
+        assert reader.read_tally("MIXT", 18)[1].tolist() == R18[1].tolist()
@@ -0,0 +1,76 @@
+# Multi-case ORIGEN decks (ORIGEN_MULTI_CASE) against a deck per history,
+# ORIGEN is the stand-in scalerte
+
+import os, re
+import numpy as np
+import pytest
+
+import OrigenReader
+import OrigenRunner
+import Test_plan as TP
+
+CELL = "5-3"
+DECAY_HOURS = 320
+
+
+def deck_cases(fn):
+    with open(fn, encoding = "cp1251") as deck_file:
+        return re.findall(r"case\s*\(\s*(\w+)\s*\)", deck_file.read())
+
+
+def test_multi_case_matches_single_decks(core, origen_dir, monkeypatch):
+    single = core.CellDoseRates(CELL, DECAY_HOURS)
+    tregs, single_sources = core.OrigenSources(DECAY_HOURS)
+    monkeypatch.setattr(TP, "ORIGEN_MULTI_CASE", True)
+    multi = core.CellDoseRates(CELL, DECAY_HOURS)
+    assert multi[0] == single[0]
+    for zone, series in single[1].items():
+        np.testing.assert_allclose(multi[1][zone], series, rtol = 1e-12)
+    assert core.OrigenSources(DECAY_HOURS) == (tregs, single_sources)
+
+    # The decay case of every history is numbered as the f71 is read
+    cases = deck_cases(origen_dir / (CELL + ".inp"))
+    assert cases == [f"{case}{no}" for no in range(TP.MCU_FA_spans)
+                     for case in ("irrad", "decay")]
+    for no in range(TP.MCU_FA_spans):
+        assert cases.index(f"decay{no}") + 1 == \
+                no * TP.OrigenTemplateCases + TP.OrigenDecayCase
+
+    tables = core.ParseOrigenCases(CELL + ".out", [None] * TP.MCU_FA_spans)
+    for no, table in enumerate(tables):
+        expected = OrigenReader.ReadOrigenTable(
+                        os.path.join(origen_dir, f"{CELL}_{no}.out"))
+        assert table.bands == expected.bands
+        np.testing.assert_array_equal(table.values, expected.values)
+        np.testing.assert_array_equal(table.times, expected.times)
+
+
+def test_multi_case_histories_start_at_zero(core, origen_dir, monkeypatch):
+    # Without start=0 every next history starts at the end of the previous
+    # decay case, here after the first irradiation time of the history
+    monkeypatch.setattr(TP, "TIME_SHIFT", DECAY_HOURS / 2)
+    core.CellDoseRates(CELL, DECAY_HOURS)
+    monkeypatch.setattr(TP, "ORIGEN_MULTI_CASE", True)
+    core.CellDoseRates(CELL, DECAY_HOURS)
+    monkeypatch.setattr(TP, "ORIGEN_RETRIES", 0)
+    monkeypatch.setattr(TP, "FreshOrigenCases", lambda cases: cases)
+    with pytest.raises(OrigenRunner.OrigenFailed) as info:
+        core.CellDoseRates(CELL, DECAY_HOURS)
+    assert f"{CELL}.inp (exit code 1)" in str(info.value)
+
+
+def test_fresh_origen_cases():
+    cases = ("case (irrad) {\n  time = { units=HOURS start=5 t=[ 10 ] }\n"
+             "  mat { iso { 92235 = 1.0 } }\n}\n"
+             "case (decay) {\n  time { start=0 t=[ 1 ] }\n}\n")
+    # A given start is kept
+    assert TP.FreshOrigenCases(cases) == cases
+    fresh = TP.FreshOrigenCases(cases.replace("start=5 ", ""))
+    assert fresh.startswith("case (irrad) {\n  time = { start=0 units=HOURS")
+    assert fresh.count("start=") == 2
+
+    with pytest.raises(TP.OrigenTemplateInvalid) as info:
+        TP.FreshOrigenCases(cases.replace("mat {", "pat {"))
+    assert "no mat block" in str(info.value)
+    with pytest.raises(TP.OrigenTemplateInvalid):
+        TP.FreshOrigenCases(cases.replace("time = {", "tim = {"))
@@ -0,0 +1,231 @@
+# ORIGEN output readers against the line-by-line reading of the .out
+# and against each other
+
+import glob, os, pickle, shutil
+import numpy as np
+import pytest
+
+import OrigenReader
+import Test_plan as TP
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUT_FILES = sorted(os.path.basename(fn) for fn in
+                   glob.glob(os.path.join(ROOT, TP.OrigenDIRName, "*.out")))
+
+
+def read_table_lines(fn, title):
+    """ {(Emin, Emax):values} and times of the table with the title text,
+        its continuations are joined
+    """
+    table, times = dict(), list()
+    with open(fn, encoding = "cp1251") as out_file:
+        lines = iter(out_file)
+        for line in lines:
+            if title not in line:
+                continue
+            next(lines)
+            hdr = next(lines)
+            times += [float(t[:-2]) for t in hdr.split()[2:]]
+            for line in lines:
+                if line.strip().startswith("-"):
+                    break
+                E_high, _, E_low, *values = line.split()
+                band = (1e6 * min(float(E_high), float(E_low)),
+                        1e6 * max(float(E_high), float(E_low)))
+                table.setdefault(band, []).extend(float(v) for v in values)
+    return table, times
+
+
+@pytest.fixture
+def out_copy(tmp_path):
+    fn = str(tmp_path / "envelope.out")
+    shutil.copy(os.path.join(ROOT, TP.OrigenDIRName, "envelope.out"), fn)
+    return fn
+
+
+@pytest.mark.parametrize("out_fn", OUT_FILES)
+def test_out_tables_match_text_reading(out_fn):
+    fn = os.path.join(TP.OrigenDIRName, out_fn)
+    tables = OrigenReader.ReadOrigenOut(fn, use_sidecar = False)
+    for kind, title in ((OrigenReader.IntensityTable,
+                         "Gamma source intensity (1/s)"),
+                        (OrigenReader.EnergyTable,
+                         "Gamma energy release rate (MeV/s)")):
+        for case in ("irrad", "decay"):
+            expected, times = read_table_lines(
+                    fn, f"{title} as a function of time for case '{case}'")
+            assert len(expected) > 0
+            table = tables[(kind, case)]
+            assert table.as_dict() == expected
+            assert table.times.tolist() == times
+            assert table.values.shape == (len(expected), len(times))
+
+
+def test_table_not_found(out_copy):
+    with pytest.raises(OrigenReader.OrigenTableNotFound) as info:
+        OrigenReader.ReadOrigenTable(out_copy, case = "no case")
+    ex = pickle.loads(pickle.dumps(info.value))
+    assert str(ex) == str(info.value)
+    assert (ex.file_name, ex.case) == (out_copy, "no case")
+
+
+def test_sidecar_written_only_on_request(out_copy, monkeypatch):
+    sidecar = out_copy + OrigenReader.ParsedSuffix
+    table = OrigenReader.ReadOrigenTable(out_copy)
+    assert not os.path.exists(sidecar)
+    OrigenReader.ReadOrigenTable(out_copy, write_sidecar = True)
+    assert os.path.exists(sidecar)
+
+    # The tables are taken from the sidecar without parsing
+    def no_parsing(data):
+        raise AssertionError("parsed")
+    with monkeypatch.context() as patch:
+        patch.setattr(OrigenReader, "ParseTables", no_parsing)
+        cached = OrigenReader.ReadOrigenOut(out_copy)
+        with pytest.raises(AssertionError):
+            OrigenReader.ReadOrigenOut(out_copy, use_sidecar = False)
+    assert cached.keys() == OrigenReader.ReadOrigenOut(
+                                out_copy, use_sidecar = False).keys()
+    decay = cached[(OrigenReader.IntensityTable, "decay")]
+    assert decay.as_dict() == table.as_dict()
+    assert decay.unit == table.unit == "1/s"
+    np.testing.assert_array_equal(decay.times, table.times)
+    np.testing.assert_array_equal(decay.total, table.total)
+
+
+def test_stale_sidecar_ignored(out_copy):
+    OrigenReader.ReadOrigenTable(out_copy, write_sidecar = True)
+    with open(out_copy, encoding = "cp1251") as out_file:
+        text = out_file.read()
+    # The same size, another value of the decay table
+    old = " 1.191E+01 - 8.090E+00    9.6554E-04"
+    assert old in text
+    with open(out_copy, "w", encoding = "cp1251") as out_file:
+        out_file.write(text.replace(old, old[:-10] + "1.2345E-04"))
+    table = OrigenReader.ReadOrigenTable(out_copy)
+    assert table.values[0, 0] == 1.2345E-04
+    # and is rewritten by the writer of the .out
+    assert OrigenReader.LoadParsed(out_copy) is None
+    OrigenReader.ReadOrigenTable(out_copy, write_sidecar = True)
+    assert OrigenReader.LoadParsed(out_copy)[
+                (OrigenReader.IntensityTable, "decay")].values[0, 0] == 1.2345E-04
+
+
+def test_core_writes_sidecars_of_job_outputs_only(core, out_copy):
+    origen_dir = os.path.dirname(out_copy)
+    container = dict()
+    table = core.ParseOrigenOut("envelope.out", container, origen_dir)
+    assert not os.path.exists(out_copy + OrigenReader.ParsedSuffix)
+    assert container == table.as_dict()
+    core.ParseOrigenOut("envelope.out", None, origen_dir, write_sidecar = True)
+    assert os.path.exists(out_copy + OrigenReader.ParsedSuffix)
+
+
+F71_FILES = [fn[:-len(".out")] + OrigenReader.F71Suffix for fn in OUT_FILES
+             if os.path.exists(os.path.join(ROOT, TP.OrigenDIRName, fn[:-4] +
+                                            OrigenReader.F71Suffix))]
+
+
+@pytest.mark.parametrize("f71_fn", F71_FILES)
+def test_f71_table_matches_out(f71_fn):
+    fn = os.path.join(TP.OrigenDIRName, f71_fn)
+    table = OrigenReader.ReadF71GammaTable(fn, TP.OrigenDecayCase)
+    out = OrigenReader.ReadOrigenTable(fn[:-4] + ".out")
+    assert table.bands == out.bands
+    # The .out prints 5 digits
+    np.testing.assert_allclose(table.times, out.times, atol = 0.05)
+    np.testing.assert_allclose(table.values, out.values, rtol = 1e-4)
+    np.testing.assert_allclose(table.total, out.total, rtol = 1e-4)
+
+
+def test_f71_positions():
+    fn = os.path.join(TP.OrigenDIRName, F71_FILES[0])
+    with OrigenReader.TF71Reader(fn) as reader:
+        runs = reader.case_runs()
+        assert sorted(runs) == [1, 2]
+        assert [no for case_nos in runs.values() for no in case_nos] == \
+                list(range(len(reader)))
+        position = reader[runs[2][0]]
+        assert position.case == 2
+        assert position.gamma_spectrum.shape == (len(position.gamma_bounds) - 1,)
+        with pytest.raises(AttributeError):
+            position.no_such_tag
+        # Arrays are views of the file, they go before the reader is closed
+        del position
+        nuclides, concentrations = reader.concentrations(2)
+        assert concentrations.shape == (len(nuclides), len(runs[2]))
+        with pytest.raises(OrigenReader.OrigenTableNotFound):
+            reader.gamma_table(3)
+
+
+def test_f71_appended_run(tmp_path):
+    # SCALE appends the positions of a rerun, the last run is taken
+    first, second = (os.path.join(ROOT, TP.OrigenDIRName, fn)
+                     for fn in ("max_burnup.f71", "envelope.f71"))
+    with open(first, "rb") as f71_file:
+        data = f71_file.read()
+    with open(second, "rb") as f71_file:
+        appended = f71_file.read()
+    appended = appended[appended.index(OrigenReader.F71Magic) +
+                        len(OrigenReader.F71Magic):]
+    fn = str(tmp_path / "appended.f71")
+    with open(fn, "wb") as f71_file:
+        f71_file.write(data + appended)
+    table = OrigenReader.ReadF71GammaTable(fn, TP.OrigenDecayCase)
+    expected = OrigenReader.ReadF71GammaTable(second, TP.OrigenDecayCase)
+    np.testing.assert_array_equal(table.values, expected.values)
+    np.testing.assert_array_equal(table.times, expected.times)
+
+
+def test_f71_format_errors(tmp_path):
+    fn = str(tmp_path / "bad.f71")
+    with open(fn, "wb") as f71_file:
+        f71_file.write(b"not an f71 file")
+    with pytest.raises(OrigenReader.F71FormatError):
+        OrigenReader.TF71Reader(fn)
+
+    with open(os.path.join(TP.OrigenDIRName, F71_FILES[0]), "rb") as f71_file:
+        data = f71_file.read()
+    with open(fn, "wb") as f71_file:
+        f71_file.write(data[:-10])
+    with pytest.raises(OrigenReader.F71FormatError) as info:
+        OrigenReader.TF71Reader(fn)
+    ex = pickle.loads(pickle.dumps(info.value))
+    assert str(ex) == str(info.value)
+    assert ex.reason == "block exceeds the file"
+
+
+def test_fresh_f71(tmp_path):
+    out_fn = str(tmp_path / "a.out")
+    f71_fn = str(tmp_path / "a.f71")
+    open(out_fn, "w").close()
+    assert TP.FreshF71(out_fn) is None
+    open(f71_fn, "w").close()
+    os.utime(out_fn, (2000, 2000))
+    os.utime(f71_fn, (1000, 1000))
+    assert TP.FreshF71(out_fn) is None
+    os.utime(f71_fn, (2000, 2000))
+    assert TP.FreshF71(out_fn) == f71_fn
+
+
+def test_core_reads_fresh_f71_only(core, out_copy, monkeypatch):
+    origen_dir = os.path.dirname(out_copy)
+    f71_fn = out_copy[:-4] + OrigenReader.F71Suffix
+    shutil.copy(os.path.join(ROOT, TP.OrigenDIRName, "envelope.f71"), f71_fn)
+    out = OrigenReader.ReadOrigenTable(out_copy)
+    f71 = OrigenReader.ReadF71GammaTable(f71_fn, TP.OrigenDecayCase)
+    assert not np.array_equal(out.values, f71.values)
+
+    # The .out is read by default
+    os.utime(out_copy, (1000, 1000))
+    os.utime(f71_fn, (2000, 2000))
+    table = core.ParseOrigenOut("envelope.out", None, origen_dir)
+    np.testing.assert_array_equal(table.values, out.values)
+
+    monkeypatch.setattr(TP, "ORIGEN_USE_F71", True)
+    table = core.ParseOrigenOut("envelope.out", None, origen_dir)
+    np.testing.assert_array_equal(table.values, f71.values)
+    # A .f71 older than the .out is left by another run
+    os.utime(f71_fn, (500, 500))
+    table = core.ParseOrigenOut("envelope.out", None, origen_dir)
+    np.testing.assert_array_equal(table.values, out.values)
@@ -0,0 +1,271 @@
+# ORIGEN runner: pool, job directories and the outputs cache
+# with stand-in commands instead of scalerte
+
+import os, sys, time
+import pytest
+
+import OrigenRunner
+import Test_plan as TP
+
+# The deck is sys.argv[1]: its text is copied into the .out,
+# a deck containing "fail" exits with 1 until its .n counter reaches
+# the number after it, "sleep" sleeps. Every run is counted in runs.txt
+STUB = """
+import os, re, sys, time
+deck = sys.argv[1]
+text = open(deck).read()
+base = os.path.splitext(deck)[0]
+with open(os.path.join(os.path.dirname(deck), "runs.txt"), "a") as runs:
+    runs.write(os.path.basename(deck) + "\\n")
+print("stdout of", deck)
+if "sleep" in text:
+    start = time.time()
+    time.sleep(float(re.search(r"sleep (\\S+)", text).group(1)))
+    with open(base + ".times", "w") as times:
+        times.write(f"{start} {time.time()}")
+match = re.search(r"fail (\\d+)", text)
+if match:
+    n_fn = base + ".n"
+    n = int(open(n_fn).read()) + 1 if os.path.exists(n_fn) else 1
+    open(n_fn, "w").write(str(n))
+    if n < int(match.group(1)):
+        print("failed", file = sys.stderr)
+        sys.exit(1)
+open(base + ".f71", "w").write("f71 " + text)
+open(base + ".out", "w").write("out " + text)
+"""
+
+STUB_COMMAND = [sys.executable, "-c", STUB]
+
+
+def write_deck(dir_name, name, text):
+    fn = os.path.join(dir_name, name + ".inp")
+    with open(fn, "w") as deck_file:
+        deck_file.write(text)
+    return fn
+
+
+def runs_of(dir_name):
+    fn = os.path.join(dir_name, "runs.txt")
+    if not os.path.exists(fn):
+        return []
+    with open(fn) as runs_file:
+        return runs_file.read().split()
+
+
+def read(fn):
+    with open(fn) as text_file:
+        return text_file.read()
+
+
+def test_pool_runs_decks_concurrently(tmp_path):
+    decks = [write_deck(tmp_path, f"d{n}", f"deck {n} sleep 0.3")
+             for n in range(6)]
+    pool = OrigenRunner.TOrigenPool(STUB_COMMAND, workers = 3, cwd = tmp_path)
+    results = pool.run(decks)
+    assert list(results) == decks
+    for deck, result in results.items():
+        assert result.ok and result.attempts == 1
+        assert read(deck[:-4] + ".out") == "out " + read(deck)
+        assert read(result.stdout_fn).startswith("stdout of")
+        assert read(result.stderr_fn) == ""
+    # No more than workers runs at once
+    spans = [tuple(map(float, read(deck[:-4] + ".times").split()))
+             for deck in decks]
+    running = max(len([1 for other_start, other_end in spans
+                       if other_start <= start < other_end])
+                  for start, end in spans)
+    assert 1 < running <= 3
+    assert pool.run([]) == {}
+
+
+def test_pool_failure_and_retries(tmp_path):
+    deck = write_deck(tmp_path, "d", "deck fail 3")
+    result = OrigenRunner.TOrigenPool(STUB_COMMAND, retries = 1).run_one(deck)
+    assert not result.ok
+    assert result.attempts == 2
+    assert result.reason() == "exit code 1"
+    assert read(result.stderr_fn) == "failed\n"
+    assert not os.path.exists(deck[:-4] + ".out")
+
+    # The third attempt succeeds
+    result = OrigenRunner.TOrigenPool(STUB_COMMAND, retries = 5).run_one(deck)
+    assert result.ok and result.attempts == 1
+    assert os.path.exists(deck[:-4] + ".out")
+
+
+def test_pool_timeout(tmp_path):
+    deck = write_deck(tmp_path, "d", "deck sleep 30")
+    start = time.monotonic()
+    result = OrigenRunner.TOrigenPool(STUB_COMMAND, timeout = 0.5,
+                                      retries = 1).run_one(deck)
+    assert time.monotonic() - start < 10
+    assert not result.ok and result.timed_out
+    assert result.attempts == 2
+    assert result.reason() == "timed out"
+
+
+def test_pool_command_not_found(tmp_path):
+    deck = write_deck(tmp_path, "d", "deck")
+    result = OrigenRunner.TOrigenPool(str(tmp_path / "no_scalerte"),
+                                      retries = 3).run_one(deck)
+    assert not result.ok
+    assert result.attempts == 1
+    assert result.error is not None and result.reason() == result.error
+
+
+@pytest.fixture
+def shared_dir(tmp_path):
+    (tmp_path / "template.inp").write_text("template")
+    return str(tmp_path)
+
+
+def test_job_publish_and_cleanup(shared_dir):
+    with OrigenRunner.TOrigenJob(shared_dir, "cell", "template.inp") as job:
+        assert os.path.dirname(job.dir) == os.path.join(
+                    shared_dir, OrigenRunner.JobsDIRName)
+        assert os.path.basename(job.dir).startswith("cell.")
+        assert read(job.path("template.inp")) == "template"
+        for fn in ("a.inp", "a.out", "ab.out", "b.out"):
+            with open(job.path(fn), "w") as job_file:
+                job_file.write(fn)
+        assert job.publish(["a", "b"]) == ["a.inp", "a.out", "b.out"]
+        assert sorted(os.listdir(job.dir)) == ["ab.out", "template.inp"]
+    assert not os.path.exists(job.dir)
+    assert read(os.path.join(shared_dir, "a.out")) == "a.out"
+    assert not os.path.exists(os.path.join(shared_dir, "ab.out"))
+    assert os.listdir(os.path.join(shared_dir, OrigenRunner.JobsDIRName)) == []
+
+
+def test_job_kept_on_error(shared_dir):
+    with pytest.raises(RuntimeError):
+        with OrigenRunner.TOrigenJob(shared_dir, "cell") as job:
+            raise RuntimeError("inspect me")
+    assert os.path.isdir(job.dir)
+    with pytest.raises(OrigenRunner.OrigenNotCached):
+        with OrigenRunner.TOrigenJob(shared_dir, "cell") as job:
+            raise OrigenRunner.OrigenNotCached(["cell_0"])
+    assert not os.path.exists(job.dir)
+
+
+def cached_entry(tmp_path, cache, name, text):
+    base = str(tmp_path / name)
+    for suffix in OrigenRunner.CachedSuffixes:
+        with open(base + suffix, "w") as out_file:
+            out_file.write(text + suffix)
+    key = OrigenRunner.DeckKey(text.encode())
+    cache.store(key, base)
+    return key
+
+
+def test_cache_store_and_fetch(tmp_path):
+    cache = OrigenRunner.TOrigenCache(str(tmp_path / "cache"))
+    key = cached_entry(tmp_path, cache, "a", "deck a")
+    assert sorted(os.listdir(cache.cache_dir)) == [key + ".f71", key + ".out"]
+
+    base = str(tmp_path / "fetched")
+    assert cache.fetch(key, base)
+    assert read(base + ".out") == "deck a.out"
+    assert read(base + ".f71") == "deck a.f71"
+    # The .f71 is not older than the .out, see FreshF71
+    assert os.path.getmtime(base + ".f71") >= os.path.getmtime(base + ".out")
+    assert TP.FreshF71(base + ".out") == base + ".f71"
+
+    assert not cache.fetch(OrigenRunner.DeckKey(b"other"), base)
+    # An entry without the .out is not complete
+    os.remove(cache.path(key, ".out"))
+    assert not cache.fetch(key, str(tmp_path / "none"))
+
+
+def test_cache_evicts_old_entries(tmp_path):
+    cache = OrigenRunner.TOrigenCache(str(tmp_path / "cache"), max_age = 3600)
+    old = cached_entry(tmp_path, cache, "a", "deck a")
+    new = cached_entry(tmp_path, cache, "b", "deck b")
+    long_ago = time.time() - 7200
+    os.utime(cache.path(old, ".out"), (long_ago, long_ago))
+    assert cache.evict() == 1
+    assert sorted(os.listdir(cache.cache_dir)) == [new + ".f71", new + ".out"]
+    assert cache.evict() == 0
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = OrigenRunner.TOrigenCache(str(tmp_path / "cache"))
+    keys = [cached_entry(tmp_path, cache, name, "deck " + name)
+            for name in ("a", "b", "c")]
+    for n, key in enumerate(keys):
+        os.utime(cache.path(key, ".out"), (1e9 + n, 1e9 + n))
+    entry_size = sum(os.path.getsize(cache.path(keys[0], suffix))
+                     for suffix in OrigenRunner.CachedSuffixes)
+    # Using the first entry makes the second one the least recently used
+    assert cache.fetch(keys[0], str(tmp_path / "used"))
+    cache.max_bytes = 2 * entry_size
+    assert cache.evict() == 1
+    assert not cache.fetch(keys[1], str(tmp_path / "x"))
+    assert cache.fetch(keys[0], str(tmp_path / "x"))
+    assert cache.fetch(keys[2], str(tmp_path / "x"))
+    cache.max_bytes = 0
+    assert cache.evict() == 2
+    assert os.listdir(cache.cache_dir) == []
+
+
+@pytest.fixture
+def stub_origen(origen_dir, monkeypatch):
+    monkeypatch.setattr(TP, "scale_bin", STUB_COMMAND)
+    monkeypatch.setattr(TP, "ORIGEN_RETRIES", 0)
+    return str(origen_dir)
+
+
+def decks_of(dir_name, texts):
+    return {name:OrigenRunner.DeckKey(
+                read(write_deck(dir_name, name, text)).encode('cp1251'))
+            for name, text in texts.items()}
+
+
+def test_run_origen_decks_caches_outputs(stub_origen):
+    decks = decks_of(stub_origen, {"a":"deck a", "b":"deck b"})
+    results = TP.RunOrigenDecks(decks, stub_origen)
+    assert sorted(results) == ["a.inp", "b.inp"]
+    assert sorted(runs_of(stub_origen)) == ["a.inp", "b.inp"]
+
+    # The outputs are taken from the cache without running
+    for name in decks:
+        os.remove(os.path.join(stub_origen, name + ".out"))
+    assert TP.RunOrigenDecks(decks, stub_origen, run_origen = False) == {}
+    assert sorted(runs_of(stub_origen)) == ["a.inp", "b.inp"]
+    assert read(os.path.join(stub_origen, "a.out")) == "out deck a"
+
+    # A changed deck is not in the cache
+    decks = decks_of(stub_origen, {"a":"deck a changed", "b":"deck b"})
+    with pytest.raises(OrigenRunner.OrigenNotCached) as info:
+        TP.RunOrigenDecks(decks, stub_origen, run_origen = False)
+    assert info.value.decks == ["a"]
+    assert sorted(runs_of(stub_origen)) == ["a.inp", "b.inp"]
+    TP.RunOrigenDecks(decks, stub_origen)
+    assert sorted(runs_of(stub_origen)) == ["a.inp", "a.inp", "b.inp"]
+
+
+def test_run_origen_decks_failure(stub_origen):
+    decks = decks_of(stub_origen, {"ok":"deck ok", "bad":"deck fail 100"})
+    with pytest.raises(OrigenRunner.OrigenFailed) as info:
+        TP.RunOrigenDecks(decks, stub_origen)
+    assert [os.path.basename(result.task_fn)
+            for result in info.value.failed] == ["bad.inp"]
+    assert "bad.inp (exit code 1)" in str(info.value)
+    # Only the successful deck is cached
+    with pytest.raises(OrigenRunner.OrigenNotCached) as info:
+        TP.RunOrigenDecks(decks, stub_origen, run_origen = False)
+    assert info.value.decks == ["bad"]
+
+
+def test_run_origens_repeated_decks(stub_origen):
+    for name in ("a", "b"):
+        write_deck(stub_origen, name, "deck " + name)
+    task_fns = ["a.inp", "b.inp", "a.inp", os.path.join(os.curdir, "b.inp")]
+    results = TP.RunOrigens(task_fns, stub_origen)
+    # Every deck is run once, its names share the result
+    assert sorted(runs_of(stub_origen)) == ["a.inp", "b.inp"]
+    assert list(results) == ["a.inp", "b.inp", os.path.join(os.curdir, "b.inp")]
+    assert results[os.path.join(os.curdir, "b.inp")] is results["b.inp"]
+    assert os.path.basename(results["a.inp"].task_fn) == "a.inp"
+    assert os.path.basename(results["b.inp"].task_fn) == "b.inp"
+    assert all(result.ok for result in results.values())
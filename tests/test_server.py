@@ -0,0 +1,80 @@
+# HTTP layer of tvs_dose.server: the /core NDJSON stream and the status
+# codes of the ORIGEN errors, ORIGEN is the stand-in scalerte
+
+import json, sys
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient
+
+import Test_plan as TP
+from tvs_dose import server
+
+CELLS = ["1-1", "5-3"]
+DECAY_HOURS = 320
+
+
+@pytest.fixture
+def client(plan_api, monkeypatch):
+    monkeypatch.setattr(server, "_api", plan_api)
+    return TestClient(server.app)
+
+
+def ndjson_lines(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_not_initialized(monkeypatch):
+    monkeypatch.setattr(server, "_api", None)
+    response = TestClient(server.app).post("/core", json = {})
+    assert response.status_code == 400
+
+
+def test_core_stream(client, plan_api):
+    expected = {cell:plan_api.compute_cell(cell, DECAY_HOURS) for cell in CELLS}
+    response = client.post("/core", json = {
+                "decay_hours":DECAY_HOURS, "use_scale":True,
+                "cells":CELLS, "workers":1})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    # One line per cell in the order of the cells with one worker
+    records = ndjson_lines(response)
+    assert [record["cell"] for record in records] == CELLS
+    for record in records:
+        assert record == json.loads(expected[record["cell"]].ndjson())
+
+
+def test_core_not_cached(client):
+    # Only the first cell is computed before the response
+    response = client.post("/core", json = {
+                "decay_hours":DECAY_HOURS, "use_scale":False, "cells":CELLS})
+    assert response.status_code == 409
+    detail = response.json()["detail"]
+    assert detail.startswith("No cached ORIGEN results for 1-1_0")
+    assert "5-3" not in detail
+
+
+def test_core_error_is_the_last_line(client, plan_api):
+    plan_api.compute_cell(CELLS[0], DECAY_HOURS)
+    # The second cell is not in the ORIGEN cache, the status is sent already
+    response = client.post("/core", json = {
+                "decay_hours":DECAY_HOURS, "use_scale":False,
+                "cells":CELLS, "workers":1})
+    assert response.status_code == 200
+    first, last = ndjson_lines(response)
+    assert first["cell"] == CELLS[0]
+    assert last["type"] == "OrigenNotCached"
+    assert last["error"].startswith("No cached ORIGEN")
+
+
+def test_cell_errors(client, monkeypatch):
+    request = {"cell":CELLS[0], "decay_hours":DECAY_HOURS}
+    response = client.post("/cell", json = dict(request, use_scale = False))
+    assert response.status_code == 409
+
+    monkeypatch.setattr(TP, "scale_bin",
+                        [sys.executable, "-c", "import sys; sys.exit(1)"])
+    monkeypatch.setattr(TP, "ORIGEN_RETRIES", 0)
+    response = client.post("/cell", json = dict(request, use_scale = True))
+    assert response.status_code == 502
+    assert "exit code 1" in response.json()["detail"]
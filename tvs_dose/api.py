@@ -1,7 +1,9 @@
 from __future__ import annotations
 from dataclasses import dataclass, asdict
-from typing import Dict, List
-import importlib, logging, sys, os, pathlib, math
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+import concurrent.futures, importlib, json, logging, multiprocessing, sys, os, pathlib, threading
+import numpy as np
 
 log = logging.getLogger(__name__)
 
@@ -13,12 +15,35 @@ if str(ROOT) not in sys.path:
 try:
     TestPlan = importlib.import_module("Test_plan")
     FAGamma = importlib.import_module("FA_Gamma")
+    FileCache = importlib.import_module("FileCache")
+    OrigenRunner = importlib.import_module("OrigenRunner")
 except Exception as e:
     raise ImportError(
         "Не найдены модули Test_plan.py / FA_Gamma.py. "
         f"Положите их в корень репозитория: {ROOT}"
     ) from e
 
+# Сколько построенных TCoreHistory держать в памяти
+CORE_CACHE_SIZE = 4
+# Единое хранилище доз всей активной зоны в results_dir
+CORE_STORE_FN = "core_doses.npz"
+CORE_STORE_VERSION = 1
+# Ячеек за одну свёртку при расчёте по базису источников
+CORE_CHUNK = 32
+# Настройки Test_plan, от которых зависит compute_cell (и MCU_FA_spans из
+# ReadStaticData): рабочие процессы запускаются через spawn и получают их только так
+CORE_WORKER_SETTINGS = ("MCU_FA_spans", "ConfigDIRName", "MCUDIRName", "ResultsDIRName", "OrigenDIRName",
+                        "scale_bin", "template_file_name", "TIME_SHIFT",
+                        "ORIGEN_WORKERS", "ORIGEN_TIMEOUT", "ORIGEN_RETRIES",
+                        "ORIGEN_CACHE", "ORIGEN_CACHE_MAX_BYTES", "ORIGEN_CACHE_MAX_AGE",
+                        "ORIGEN_USE_F71", "ORIGEN_MULTI_CASE",
+                        "OrigenTemplateCases", "OrigenDecayCase",
+                        "ORIGEN_SUPERPOSITION", "SUPERPOSITION_CHECK")
+# То же для атрибутов TestPlan.TCoreHistory (файл истории и окно Wmax2)
+CORE_WORKER_HISTORY_SETTINGS = ("history_fn", "Wmax2_hours")
+# Сервер многопоточный, fork из него небезопасен
+CORE_MP_CONTEXT = "spawn"
+
 
 @dataclass
 class Paths:
@@ -42,12 +67,67 @@ class CellResult:
     times_h: List[float]
     dose_uSv_per_h_by_zone: Dict[int, List[float]]
 
+    def ndjson(self) -> str:
+        """Одна строка NDJSON с результатом ячейки."""
+        return json.dumps(asdict(self), ensure_ascii=False) + "\n"
+
+
+@dataclass
+class CoreDoseMap:
+    cells: List[str]
+    zones: List[int]
+    times_h: List[float]
+    dose_uSv_per_h: np.ndarray   # [ячейка, зона, время]
+    meta: Dict
+
+    def cell(self, cell: str) -> CellResult:
+        doses = self.dose_uSv_per_h[self.cells.index(cell)]
+        return CellResult(cell=cell, times_h=list(self.times_h),
+                          dose_uSv_per_h_by_zone={z: series.tolist() for z, series in zip(self.zones, doses)})
+
+
+def load_core_doses(path) -> CoreDoseMap:
+    """Читает хранилище, записанное TestPlanAPI.iter_core."""
+    meta, arrays = FileCache.LoadNPZ(str(path))
+    if meta is None or meta.get("version") != CORE_STORE_VERSION:
+        raise FileNotFoundError(f"Не найдено хранилище доз активной зоны: {path}")
+    return CoreDoseMap(cells=meta["cells"], zones=meta["zones"],
+                       times_h=arrays["times_h"].tolist(),
+                       dose_uSv_per_h=arrays["doses"], meta=meta)
+
+
+# ——— рабочие процессы пакетного расчёта зоны ———
+_core_worker_api = None
+
+
+def _core_worker_init(paths: Paths, settings: Dict, history_settings: Dict, shared: tuple) -> None:
+    """shared — (алгоритмы, функции Грина) вызвавшего iter_core, настройки применяются поверх paths."""
+    global _core_worker_api
+    api = TestPlanAPI(paths)
+    api._apply_paths()
+    for name, value in settings.items():
+        setattr(TestPlan, name, value)
+    for name, value in history_settings.items():
+        setattr(TestPlan.TCoreHistory, name, value)
+    api._algorithms, api._greens = shared
+    _core_worker_api = api
+
+
+def _core_worker_cell(cell: str, decay_hours: float, run_origen: bool) -> CellResult:
+    return _core_worker_api.compute_cell(cell, decay_hours, run_origen=run_origen)
+
 
 class TestPlanAPI:
-    def __init__(self, paths: Paths):
+    def __init__(self, paths: Paths, core_cache_size: int = CORE_CACHE_SIZE):
         self.paths = paths
         self._algorithms = None
         self._greens = None
+        # LRU построенных историй: ключ -> (TCoreHistory, lock)
+        self._core_cache_size = core_cache_size
+        self._cores: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._cores_lock = threading.Lock()
+        # путь -> ((size, mtime_ns), sha1), чтобы не хешировать файл на каждый запрос
+        self._history_hashes: Dict[str, tuple] = {}
 
     def _apply_paths(self) -> None:
         """Подменяем глобальные пути в исходных модулях на переданные извне."""
@@ -69,6 +149,9 @@ class TestPlanAPI:
         self._apply_paths()
         self._algorithms = TestPlan.ReadStaticData(TestPlan.FINsListFile)
         self._greens = FAGamma.readGreenFuncs()
+        # Истории построены для прежних алгоритмов
+        with self._cores_lock:
+            self._cores.clear()
 
         try:
             first_alg = next(iter(self._algorithms.values()))
@@ -84,63 +167,210 @@ class TestPlanAPI:
             "fa_spans": spans,
         }
 
+    # ——— кэш TCoreHistory ———
+    def _history_hash(self, path: str) -> str:
+        """SHA-1 файла истории; пересчитывается, только если изменились размер или mtime."""
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime_ns)
+        known = self._history_hashes.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        sha1 = FileCache.ContentHash(path)
+        self._history_hashes[path] = (stamp, sha1)
+        return sha1
+
+    def _history_path(self) -> str:
+        return os.path.abspath(os.path.join(
+            os.curdir, TestPlan.ConfigDIRName, TestPlan.TCoreHistory.history_fn))
+
+    def _core_history(self) -> Tuple[object, threading.Lock]:
+        """TCoreHistory для текущего файла истории и набора алгоритмов из LRU-кэша.
+        Ключ — содержимое файла истории и идентичность алгоритмов/функций Грина,
+        так что после изменения файла история строится заново.
+        Возвращает (core, lock): под lock читаются истории мощности и строится
+        базис источников, сами расчёты ORIGEN и доз идут без него."""
+        path = self._history_path()
+        key = (path, self._history_hash(path), id(self._algorithms), id(self._greens))
+        with self._cores_lock:
+            entry = self._cores.get(key)
+            if entry is not None:
+                self._cores.move_to_end(key)
+                return entry
+
+        entry = (TestPlan.TCoreHistory(self._algorithms, self._greens), threading.Lock())
+        with self._cores_lock:
+            # Устаревшие версии того же файла больше не понадобятся
+            for old_key in [k for k in self._cores if k[0] == path and k != key]:
+                del self._cores[old_key]
+            entry = self._cores.setdefault(key, entry)
+            self._cores.move_to_end(key)
+            while len(self._cores) > self._core_cache_size:
+                self._cores.popitem(last=False)
+        return entry
+
     # ——— режим без SCALE: парсим готовые .out ———
-    def _parse_origen_without_scale(self, core, max_reg_hours: float) -> None:
-        # Восстанавливаем те же точки по времени, что и InvokeOrigen
-        N_pts = 10
-        precision = 1
-        tmax_log = math.log(max_reg_hours)
-        core.tregs = [round(math.exp(n / N_pts * tmax_log), precision) for n in range(1, N_pts + 1)]
-        core.tregs = [0.0] + core.tregs
+    def _parse_origen_without_scale(self, core, max_reg_hours: float) -> Tuple[List[float], List[Dict]]:
+        """(tregs, спектры Wmax, Wmax2, Wenvelope) из готовых .out, как у OrigenSources; core не меняется."""
+        # Те же точки по времени, что и у InvokeOrigen
+        tregs = TestPlan.TCoreHistory.RegTimes(max_reg_hours)[0]
 
         # Контейнеры для спектров
-        core.Wmax_src_spectrums = {}
-        core.Wmax2_src_spectrums = {}
-        core.Wenvelope_src_spectrums = {}
-
-        containers = [core.Wmax_src_spectrums, core.Wmax2_src_spectrums, core.Wenvelope_src_spectrums]
-        try:
-            origen_fns = list(type(core).Origen_fns)   # ["max_burnup","max_2_hours","envelope"]
-        except Exception:
-            origen_fns = ["max_burnup", "max_2_hours", "envelope"]
+        containers = [{}, {}, {}]
+        if TestPlan.ORIGEN_MULTI_CASE:
+            # Все три случая в одной колоде
+            origen_fns = [TestPlan.OrigenCoreDeck]
+        else:
+            try:
+                origen_fns = list(type(core).Origen_fns)   # ["max_burnup","max_2_hours","envelope"]
+            except Exception:
+                origen_fns = ["max_burnup", "max_2_hours", "envelope"]
 
         # ВАЖНО: внутри ParseOrigenOut путь формируется как .\Origens\ + fn,
         # поэтому сюда передаём ТОЛЬКО имя файла (basename), без директорий.
-        for fn, container in zip(origen_fns, containers):
+        for fn in origen_fns:
             full = pathlib.Path(self.paths.origen_dir) / f"{fn}.out"
             if not full.exists():
                 raise FileNotFoundError(
                     f"Не найден файл ORIGEN: {full}\n"
                     f"Ожидался в папке: {self.paths.origen_dir}"
                 )
-            core.ParseOrigenOut(f"{fn}.out", container)
+        if TestPlan.ORIGEN_MULTI_CASE:
+            core.ParseOrigenCases(f"{origen_fns[0]}.out", containers)
+        else:
+            for fn, container in zip(origen_fns, containers):
+                core.ParseOrigenOut(f"{fn}.out", container)
+        return tregs, containers
 
 
     def compute_envelope(self, decay_hours: float, run_origen: bool = True) -> EnvelopeResult:
         if self._algorithms is None or self._greens is None:
             self.initialize()
 
-        core = TestPlan.TCoreHistory(self._algorithms, self._greens)
-
+        core, lock = self._core_history()
+        with lock:
+            # Под lock только истории мощности core
+            params = core.CoreOrigenParams() if run_origen else None
+            axial = core.Wenvelope_axial
         if run_origen:
-            core.InvokeOrigen(decay_hours)
+            tregs, sources = core.OrigenSources(decay_hours, params)
         else:
-            self._parse_origen_without_scale(core, decay_hours)
+            tregs, sources = self._parse_origen_without_scale(core, decay_hours)
 
-        dose_by_zone: Dict[int, List[float]] = {}
-        for zone in range(130, 150):
-            dozeRates = core.FADoseRate(core.Wenvelope_axial, zone, core.Wenvelope_src_spectrums)
-            dose_by_zone[zone] = [Svs * 3600.0 * 1e6 for Svs in dozeRates]  # Sv/s → μSv/h
+        zones = list(range(130, 150))
+        dozeRates = core.FADoseRates(axial, zones, sources[2])
+        dose_by_zone: Dict[int, List[float]] = {
+            zone: (series * 3600.0 * 1e6).tolist() for zone, series in zip(zones, dozeRates)  # Sv/s → μSv/h
+        }
+        times_h = list(tregs)
 
-        return EnvelopeResult(times_h=core.tregs, dose_uSv_per_h_by_zone=dose_by_zone)
+        return EnvelopeResult(times_h=times_h, dose_uSv_per_h_by_zone=dose_by_zone)
 
     def compute_cell(self, cell: str, decay_hours: float, run_origen: bool = True) -> CellResult:
         if self._algorithms is None or self._greens is None:
             self.initialize()
 
-        core = TestPlan.TCoreHistory(self._algorithms, self._greens)
-        dose_arrays_Svs = core.FACellDoseRate(cell, decay_hours)
+        core, lock = self._core_history()
+        with lock:
+            # Под lock только общее состояние core: истории мощности и базис источников
+            if TestPlan.ORIGEN_SUPERPOSITION:
+                core.SourceBasis(decay_hours, run_origen)
+                params = None
+            else:
+                params = core.CellOrigenParams(cell)
+        # Без SCALE ячейка берётся из кэша результатов ORIGEN
+        tregs, dose_arrays_Svs = core.CellDoseRates(cell, decay_hours, run_origen=run_origen,
+                                                    params=params)
+        times_h = list(tregs)
         dose_by_zone: Dict[int, List[float]] = {
             z: [Svs * 3600.0 * 1e6 for Svs in series] for z, series in dose_arrays_Svs.items()
         }
-        return CellResult(cell=cell, times_h=core.tregs, dose_uSv_per_h_by_zone=dose_by_zone)
+        return CellResult(cell=cell, times_h=times_h, dose_uSv_per_h_by_zone=dose_by_zone)
+
+    # ——— вся активная зона ———
+    def core_store_path(self) -> pathlib.Path:
+        return pathlib.Path(self.paths.results_dir) / CORE_STORE_FN
+
+    def iter_core(self, decay_hours: float, run_origen: bool = True,
+                  cells: Optional[List[str]] = None, workers: int = 0,
+                  store: bool = True) -> Iterator[CellResult]:
+        """Дозы всех ТВС зоны (или только cells) по мере готовности, в порядке завершения.
+        Ячейки распределяются по workers процессам (0 — os.cpu_count(), 1 — в этом
+        процессе), на процесс в работе не больше двух ячеек, так что память ограничена.
+        С ORIGEN_SUPERPOSITION вся зона считается здесь же по базису источников.
+        Если store, после последней ячейки все результаты пишутся в core_store_path()."""
+        if self._algorithms is None or self._greens is None:
+            self.initialize()
+
+        core, lock = self._core_history()
+        cells = list(core.fission_tensor.cells) if cells is None else list(cells)
+        workers = workers if workers > 0 else (os.cpu_count() or 1)
+        if TestPlan.ORIGEN_SUPERPOSITION:
+            results = self._iter_core_basis(core, lock, cells, decay_hours, run_origen)
+        elif workers == 1 or len(cells) <= 1:
+            results = (self.compute_cell(cell, decay_hours, run_origen) for cell in cells)
+        else:
+            results = self._iter_core_workers(cells, decay_hours, run_origen, workers)
+
+        index = {cell: n for n, cell in enumerate(cells)}
+        zones = times_h = doses = None
+        for res in results:
+            if store:
+                if doses is None:
+                    zones = sorted(res.dose_uSv_per_h_by_zone)
+                    times_h = res.times_h
+                    doses = np.zeros((len(cells), len(zones), len(times_h)))
+                doses[index[res.cell]] = [res.dose_uSv_per_h_by_zone[z] for z in zones]
+            yield res
+
+        if doses is not None:
+            meta = {"version": CORE_STORE_VERSION, "decay_hours": decay_hours,
+                    "run_origen": run_origen,
+                    "history_sha1": self._history_hash(self._history_path()),
+                    "cells": cells, "zones": zones, "units": "uSv/h"}
+            FileCache.SaveNPZ(str(self.core_store_path()), meta,
+                              times_h=np.array(times_h), doses=doses)
+
+    def _iter_core_basis(self, core, lock, cells, decay_hours, run_origen):
+        zones = list(range(130, 150))   # те же зоны, что у FACellDoseRate
+        for first in range(0, len(cells), CORE_CHUNK):
+            with lock:
+                basis = core.SourceBasis(decay_hours, run_origen)
+            doses = core.CoreDoseRates(decay_hours, zones,
+                                       cells[first:first + CORE_CHUNK], run_origen)
+            times_h = list(basis.tregs)
+            for cell, series in doses.items():
+                yield CellResult(cell=cell, times_h=times_h, dose_uSv_per_h_by_zone={
+                    z: (Svs * 3600.0 * 1e6).tolist() for z, Svs in zip(zones, series)})
+
+    def _iter_core_workers(self, cells, decay_hours, run_origen, workers):
+        settings = {name: getattr(TestPlan, name) for name in CORE_WORKER_SETTINGS}
+        history_settings = {name: getattr(TestPlan.TCoreHistory, name)
+                            for name in CORE_WORKER_HISTORY_SETTINGS}
+        # Процессы scalerte делятся между рабочими
+        settings["ORIGEN_WORKERS"] = max(
+            1, (settings["ORIGEN_WORKERS"] or os.cpu_count() or 1) // workers)
+        # Алгоритмы и функции Грина этого вызова передаются каждому рабочему
+        # при запуске, общего состояния между вызовами iter_core нет
+        initargs = (self.paths, settings, history_settings, (self._algorithms, self._greens))
+        queued = iter(cells)
+        pending = set()
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context(CORE_MP_CONTEXT),
+                initializer=_core_worker_init, initargs=initargs) as executor:
+            try:
+                while True:
+                    for cell in queued:
+                        pending.add(executor.submit(_core_worker_cell, cell,
+                                                    decay_hours, run_origen))
+                        if len(pending) >= 2 * workers:
+                            break
+                    if not pending:
+                        break
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            finally:
+                # Ошибка или брошенный генератор: не ждём остальные ячейки
+                for future in pending:
+                    future.cancel()
@@ -1,7 +1,7 @@
 
 import argparse, pathlib, json
 from typing import List, Dict
-from .api import TestPlanAPI, Paths
+from .api import TestPlanAPI, Paths, OrigenRunner
 
 def save_series_csv(path: pathlib.Path, times_h: List[float], series: List[float]):
     path.parent.mkdir(parents=True, exist_ok=True)
@@ -48,6 +48,20 @@ def cmd_nt(args):
     save_series_csv(out / f"nt_cell_{args.cell}.csv", res.times_h, totals)
     print(f"N(t) CSV -> {out / f'nt_cell_{args.cell}.csv'}")
 
+def cmd_core(args):
+    api = TestPlanAPI(Paths(args.configs, args.mcu_fin, args.greens, args.origens, args.results, args.scale_bin))
+    api.initialize()
+    out = pathlib.Path(args.output); out.mkdir(parents=True, exist_ok=True)
+    fn = out / "core.ndjson"
+    n = 0
+    with open(fn, "w", encoding="utf-8") as f:
+        for res in api.iter_core(decay_hours=args.decay_hours, run_origen=bool(args.use_scale),
+                                 cells=args.cells or None, workers=args.workers):
+            f.write(res.ndjson()); f.flush()
+            n += 1
+    print(f"Core NDJSON ({n} cells) -> {fn}")
+    print(f"Core store -> {api.core_store_path()}")
+
 def cmd_nh(args):
     import math
     out = pathlib.Path(args.output); out.mkdir(parents=True, exist_ok=True)
@@ -90,13 +104,19 @@ def build_parser():
     sp = sub.add_parser("cell"); sp.add_argument("--cell", required=True); sp.add_argument("--decay-hours", type=float, default=320.0); sp.set_defaults(func=cmd_cell)
     sp = sub.add_parser("nt"); sp.add_argument("--cell", required=True); sp.add_argument("--decay-hours", type=float, default=320.0); sp.set_defaults(func=cmd_nt)
     sp = sub.add_parser("nh"); sp.add_argument("--cell", required=True); sp.set_defaults(func=cmd_nh)
+    sp = sub.add_parser("core"); sp.add_argument("--decay-hours", type=float, default=320.0); sp.add_argument("--workers", type=int, default=0); sp.add_argument("--cells", nargs="*"); sp.set_defaults(func=cmd_core)
     sp = sub.add_parser("dose"); sp.add_argument("--decay-hours", type=float, default=320.0); sp.set_defaults(func=cmd_dose)
     return p
 
 def main(argv=None):
     parser = build_parser()
     args = parser.parse_args(argv)
-    return args.func(args)
+    try:
+        return args.func(args)
+    except OrigenRunner.OrigenNotCached as ex:
+        parser.exit(2, f"{parser.prog}: error: {ex}, use --use-scale\n")
+    except OrigenRunner.OrigenFailed as ex:
+        parser.exit(1, f"{parser.prog}: error: {ex}\n")
 
 if __name__ == "__main__":
     raise SystemExit(main())
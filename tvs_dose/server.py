@@ -1,7 +1,11 @@
-from typing import Optional
+import contextlib, json, logging
+from typing import List, Optional
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from .api import TestPlanAPI, Paths
+from .api import TestPlanAPI, Paths, OrigenRunner
+
+log = logging.getLogger(__name__)
 
 app = FastAPI(title="TVS Dose API")
 
@@ -22,8 +26,24 @@ class CellReq(BaseModel):
     decay_hours: float = 320.0
     use_scale: bool = False
 
+class CoreReq(BaseModel):
+    decay_hours: float = 320.0
+    use_scale: bool = False
+    cells: Optional[List[str]] = None
+    workers: int = 0
+
 _api: Optional[TestPlanAPI] = None
 
+@contextlib.contextmanager
+def _origen_errors():
+    # Без use_scale нужных выходов ORIGEN нет в кэше - 409, сбой scalerte - 502
+    try:
+        yield
+    except OrigenRunner.OrigenNotCached as ex:
+        raise HTTPException(409, str(ex))
+    except OrigenRunner.OrigenFailed as ex:
+        raise HTTPException(502, str(ex))
+
 @app.post("/init")
 def init(req: InitReq):
     global _api
@@ -34,12 +54,36 @@ def init(req: InitReq):
 def envelope(req: EnvelopeReq):
     if _api is None:
         raise HTTPException(400, "Not initialized. Call /init first.")
-    res = _api.compute_envelope(decay_hours=req.decay_hours, run_origen=req.use_scale)
+    with _origen_errors():
+        res = _api.compute_envelope(decay_hours=req.decay_hours, run_origen=req.use_scale)
     return {"times_h": res.times_h, "dose_uSv_per_h_by_zone": res.dose_uSv_per_h_by_zone}
 
 @app.post("/cell")
 def cell(req: CellReq):
     if _api is None:
         raise HTTPException(400, "Not initialized. Call /init first.")
-    res = _api.compute_cell(cell=req.cell, decay_hours=req.decay_hours, run_origen=req.use_scale)
+    with _origen_errors():
+        res = _api.compute_cell(cell=req.cell, decay_hours=req.decay_hours, run_origen=req.use_scale)
     return {"cell": res.cell, "times_h": res.times_h, "dose_uSv_per_h_by_zone": res.dose_uSv_per_h_by_zone}
+
+@app.post("/core")
+def core(req: CoreReq):
+    if _api is None:
+        raise HTTPException(400, "Not initialized. Call /init first.")
+    results = _api.iter_core(decay_hours=req.decay_hours, run_origen=req.use_scale,
+                             cells=req.cells, workers=req.workers)
+    # Первая ячейка считается до ответа, так что холодный кэш без use_scale даёт 409
+    with _origen_errors():
+        first = next(results, None)
+    return StreamingResponse(_core_lines(first, results), media_type="application/x-ndjson")
+
+def _core_lines(first, results):
+    # После 200 ошибку можно передать только в потоке: последняя строка {"error": ...}
+    try:
+        if first is not None:
+            yield first.ndjson()
+        for res in results:
+            yield res.ndjson()
+    except Exception as ex:
+        log.exception("/core stream failed")
+        yield json.dumps({"error": str(ex), "type": type(ex).__name__}, ensure_ascii=False) + "\n"